@@ -5,19 +5,23 @@
 import os
 import sys
 import uuid
+import time
+import secrets
+import zlib
 import asyncio
 import json
 import aiofiles
 from datetime import datetime
-from typing import List, Dict, Optional
-from contextlib import asynccontextmanager
+from typing import Any, Callable, List, Dict, Optional, Tuple
+from contextlib import asynccontextmanager, contextmanager
+from dataclasses import dataclass, field
 
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
@@ -29,10 +33,25 @@ load_dotenv()
 
 # 导入自定义模块
 from config import config
-from utils.logger import setup_logging, app_logger
-from utils.api_client import poe_client, APIError, APIAuthError, APIRateLimitError
+from utils.logger import setup_logging, start_logging, stop_logging, app_logger
+from utils.api_client import poe_client, model_router, APIError, APIAuthError, APIRateLimitError
 from utils.database import db_manager
 from utils.metrics import metrics_collector, timing_middleware
+from utils.tracing import tracer
+from utils.profiler import stack_sampler, format_collapsed, ProfilerBusyError
+from utils.loop_monitor import loop_monitor
+from utils.state_backend import state_backend
+from utils.summarizer import TranscriptCompressor, session_digester
+from utils.prompt_builder import PromptBuilder, prompt_cache_tracker
+from utils.search import search_index
+from utils.checkpoint import stream_checkpoints, CheckpointPolicy
+from utils.file_store import JsonFileStore
+from utils.streaming import (
+    coalesce_chunks, stream_events, stream_registry, wants_sse, SSE_MEDIA_TYPE, NDJSON_MEDIA_TYPE, STREAM_HEADERS
+)
+from utils.transfer import (
+    iter_export_records, encode_ndjson, iter_ndjson_records, import_records, list_upload_metadata
+)
 from models.chat_models import (
     ChatRequest, DiscussionRequest, FileAttachment, Message,
     Memory, MemoryCreateRequest, MemoryUpdateRequest
@@ -41,14 +60,15 @@ from models.chat_models import (
 # 设置日志
 logger = setup_logging()
 
-# 限流器
-limiter = Limiter(key_func=get_remote_address)
+# 限流器（计数存放在共享状态后端，多worker共用同一额度）
+limiter = Limiter(key_func=get_remote_address, storage_uri=state_backend.limiter_storage_uri())
 
 # 应用生命周期管理
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用启动和关闭时的处理"""
-    # 启动时
+    # 启动时：写日志的后台线程在各worker进程内启动
+    start_logging()
     app_logger.info("🚀 Multi-Agent聊天助手启动中...")
     
     # 验证配置
@@ -59,18 +79,53 @@ async def lifespan(app: FastAPI):
         app_logger.error(f"❌ 配置验证失败: {e}")
         sys.exit(1)
     
-    # API健康检查
-    try:
-        if await poe_client.health_check():
-            app_logger.info("✅ API连接正常")
-        else:
-            app_logger.warning("⚠️ API连接异常，但服务继续启动")
-    except Exception as e:
-        app_logger.error(f"❌ API健康检查失败: {e}")
+    # API客户端在各worker进程内创建：后台线程导入SDK，启动不等待，首个请求前通常已就绪
+    client_task = asyncio.create_task(poe_client.start())
+    
+    # API健康状态由真实调用被动推导，启动时不再阻塞等待补全请求
+    if config.HEALTH_PROBE_ON_STARTUP:
+        poe_client.schedule_probe()
+        app_logger.info("🩺 已在后台发起API探测")
     
     # 创建必要的目录
     os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-    os.makedirs("logs", exist_ok=True)
+    os.makedirs(config.LOG_DIR, exist_ok=True)
+    
+    # 持续测量事件循环延迟，停顿超过阈值时记录阻塞的调用栈
+    if config.LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+    
+    # 多worker部署时各worker的计数定期汇总到共享后端
+    metrics_sync_task = None
+    if state_backend.shared:
+        app_logger.info(f"🔗 共享状态后端: {state_backend.name}")
+        if config.ARCHIVE_ENABLED:
+            app_logger.warning("⚠️ 共享状态后端下不启用会话归档")
+        metrics_sync_task = asyncio.create_task(metrics_collector.sync_shared_periodically(
+            state_backend, config.STATE_METRICS_SYNC_SECONDS
+        ))
+    
+    # 找回上次运行中断的流式回复
+    recovered = await recover_interrupted_replies()
+    if recovered:
+        app_logger.info(f"♻️ 已恢复 {recovered} 条中断的回复（标记为未完成）")
+    
+    # 搜索索引随会话写入增量更新，启动时在后台补齐差异
+    search_sync_task = None
+    if config.SEARCH_ENABLED:
+        db_manager.add_listener(search_index.on_sessions_changed)
+        search_sync_task = asyncio.create_task(search_index.sync(
+            await db_manager.load_sessions(),
+            keep=db_manager.archived_session_ids()
+        ))
+    
+    # 定期将不活跃会话移入归档
+    archive_task = None
+    if db_manager.archive is not None:
+        archive_task = asyncio.create_task(db_manager.archive_periodically(
+            config.ARCHIVE_AFTER_DAYS,
+            config.ARCHIVE_INTERVAL_HOURS * 3600
+        ))
     
     app_logger.info("✅ Multi-Agent聊天助手启动完成")
     
@@ -78,7 +133,26 @@ async def lifespan(app: FastAPI):
     
     # 关闭时
     app_logger.info("🔄 Multi-Agent聊天助手关闭中...")
+    if archive_task:
+        archive_task.cancel()
+    if config.LOOP_MONITOR_ENABLED:
+        await loop_monitor.stop()
+    await session_digester.drain()
+    await db_manager.flush()
+    if metrics_sync_task:
+        metrics_sync_task.cancel()
+        await metrics_collector.flush_shared(state_backend)
+    if config.SEARCH_ENABLED:
+        if search_sync_task and not search_sync_task.done():
+            search_sync_task.cancel()
+        await search_index.drain()
+        search_index.close()
+    if not client_task.done():
+        client_task.cancel()
+    await poe_client.close()
+    await state_backend.close()
     app_logger.info("✅ Multi-Agent聊天助手已关闭")
+    stop_logging()
 
 # 创建FastAPI应用
 app = FastAPI(
@@ -101,96 +175,114 @@ app.add_middleware(
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
-# Agent角色配置
+# Agent角色配置（fallback_models: 主模型不可用时按顺序尝试的备用模型）
 AGENTS = {
     "产品经理": {
         "name": "产品经理",
         "model": "Claude-Sonnet-4.5",
+        "fallback_models": ["GPT-5", "Gemini-3.0-Pro"],
         "system_prompt": "你是一位资深的产品经理，具有10年以上的产品设计和管理经验。你擅长需求分析、用户体验设计、产品策略制定和市场分析。请从产品角度提供专业建议。",
         "color": "#4F46E5"
     },
     "技术总监": {
         "name": "技术总监",
         "model": "Claude-Sonnet-4.5",
+        "fallback_models": ["GPT-5", "Gemini-3.0-Pro"],
         "system_prompt": "你是一位经验丰富的技术总监，精通软件架构设计、技术选型、团队管理和项目规划。请从技术可行性、架构设计、性能优化等角度提供专业意见。",
         "color": "#059669"
     },
     "市场专家": {
         "name": "市场专家",
         "model": "Gemini-3.0-Pro",
+        "fallback_models": ["Claude-Sonnet-4.5", "GPT-5"],
         "system_prompt": "你是一位资深的市场营销专家，拥有15年以上的市场策略和品牌推广经验。请从市场营销角度提供具体、可执行的专业建议和策略方案。",
         "color": "#DC2626"
     },
     "UX设计师": {
         "name": "UX设计师",
         "model": "Claude-Sonnet-4.5",
+        "fallback_models": ["GPT-5", "Gemini-3.0-Pro"],
         "system_prompt": "你是一位资深的UX设计师，拥有10年以上的用户体验设计经验，精通用户研究、交互设计、信息架构、可用性测试和设计系统构建。请从用户体验的战略高度提供深度专业建议。",
         "color": "#7C3AED"
     },
     "商业分析师": {
         "name": "商业分析师", 
         "model": "Claude-Sonnet-4.5",
+        "fallback_models": ["GPT-5", "Gemini-3.0-Pro"],
         "system_prompt": "你是一位资深的商业分析师，拥有12年以上的商业咨询和投资分析经验，精通商业模式构建、财务建模、风险量化评估和投资回报优化。请从商业价值创造的角度提供深度专业分析。",
         "color": "#EA580C"
     },
     "GPT5": {
         "name": "GPT5",
         "model": "GPT-5",
+        "fallback_models": ["Claude-Sonnet-4.5", "GPT-4o"],
         "system_prompt": "你是GPT-5，OpenAI最新的旗舰AI模型，具备统一路由系统架构，能够智能切换快速响应和深度推理模式。请为用户提供准确、专业、有深度的回答。",
         "color": "#8B5CF6"
     },
     "GPT4o": {
         "name": "GPT4o",
         "model": "GPT-4o",
+        "fallback_models": ["GPT-5"],
         "system_prompt": "你是GPT-4o，一个先进的AI助手，能够帮助用户解答各种问题，提供准确、有用和富有洞察力的回答。",
         "color": "#10B981"
     },
     "Gemini-3.0-Pro": {
         "name": "Gemini-3.0-Pro",
         "model": "Gemini-3.0-Pro",
+        "fallback_models": ["Claude-Sonnet-4.5", "GPT-5"],
         "system_prompt": "你是Gemini-3.0-Pro，Google最新的旗舰AI模型，拥有强大的多模态理解能力和超长上下文窗口。你擅长深度分析、创意思考和复杂问题解决。请提供准确、全面、有洞察力的回答。",
         "color": "#4285F4"
     },
     "Claude-Sonnet-4.5": {
         "name": "Claude-Sonnet-4.5",
         "model": "Claude-Sonnet-4.5",
+        "fallback_models": ["GPT-5", "Gemini-3.0-Pro"],
         "system_prompt": "你是Claude Sonnet 4.5，Anthropic最新的旗舰AI模型，具备卓越的推理能力、深度分析能力和创造性思维。你擅长复杂问题解决、逻辑推理、代码编写和深度对话。请提供准确、深入、有洞察力的回答。",
         "color": "#A855F7"
     },
     "GPT-Image-1": {
         "name": "GPT-Image-1",
         "model": "GPT-Image-1",
+        "fallback_models": ["Nano-Banana"],
         "system_prompt": "你是GPT-Image-1，一个强大的图像生成模型。根据用户的描述，生成高质量、富有创意的图像。请仔细理解用户的需求，并生成符合要求的图像。",
         "color": "#F59E0B"
     },
     "Perplexity-Sonar-Pro": {
         "name": "Perplexity-Sonar-Pro",
         "model": "Perplexity-Sonar-Pro",
+        "fallback_models": [],
         "system_prompt": "你是Perplexity Sonar Pro，一个强大的AI搜索模型。你能够实时搜索互联网，获取最新信息，并提供准确、全面的搜索结果。你擅长网络搜索、实时信息查询、事实验证、新闻追踪和数据收集。请基于实时搜索结果提供最新、最准确的信息和分析。",
         "color": "#06B6D4"
     },
     "Nano-Banana": {
         "name": "Nano-Banana",
         "model": "Nano-Banana",
+        "fallback_models": ["GPT-Image-1"],
         "system_prompt": "你是Nano-Banana，一个专业的图像生成模型。你擅长根据用户的描述生成富有创意、细节丰富且风格独特的图像。请仔细理解用户的视觉需求，并生成高质量的图像。",
         "color": "#FACC15"
     },
     "Sora-2-Pro": {
         "name": "Sora-2-Pro",
         "model": "Sora-2-Pro",
+        "fallback_models": [],
         "system_prompt": "你是Sora-2-Pro，OpenAI最先进的视频生成模型。你能够根据文字描述生成高质量、流畅自然的视频内容。你擅长理解复杂的场景描述、动作序列和视觉风格，创造出富有创意和电影感的视频作品。请仔细分析用户的视频需求，生成符合要求的高质量视频。",
         "color": "#EC4899"
     },
     "Hailuo-Speech-02": {
         "name": "Hailuo-Speech-02",
         "model": "Hailuo-Speech-02",
+        "fallback_models": [],
         "system_prompt": "你是Hailuo-Speech-02，海螺AI最新的语音生成模型。你能够将文字转换为自然流畅的语音，支持多种音色、情感和语速调节。你擅长理解文本的语义和情感，生成富有表现力的高质量语音。请根据用户的需求生成合适的语音内容。",
         "color": "#06B6D4"
     },
 }
 
-# 存储路径
-background_tasks_status = {}
+def agent_models(agent: Dict) -> List[str]:
+    """Agent的候选模型列表：主模型在前，备用模型按配置顺序"""
+    return [agent["model"]] + agent.get("fallback_models", [])
+
+# 所有Agent配置的模型（健康检查中尚未调用过的模型视为可用）
+CONFIGURED_MODELS = list(dict.fromkeys(model for agent in AGENTS.values() for model in agent_models(agent)))
 
 def clean_message_mentions(message: str) -> str:
     """清理消息中的@提及，避免影响实际内容处理"""
@@ -199,13 +291,155 @@ def clean_message_mentions(message: str) -> str:
     cleaned = re.sub(r'@[\w\-]+\s*', '', message)
     return cleaned.strip()
 
+def build_memory_context(memories: List[dict]) -> str:
+    """构建长期记忆上下文块（按重要程度取前10条）"""
+    # 按重要程度排序，只取重要的记忆（importance >= 3）
+    important_memories = [m for m in memories if m.get('importance', 3) >= 3]
+    important_memories.sort(key=lambda m: m.get('importance', 3), reverse=True)
+    top_memories = important_memories[:10]
+    if not top_memories:
+        return ""
+    
+    memory_items = []
+    for mem in top_memories:
+        category = getCategoryLabel(mem.get('category', 'general'))
+        memory_items.append(f"[{category}] {mem['title']}: {mem['content']}")
+    
+    return "\n\n【长期记忆】\n以下是用户的长期记忆信息，请在回答时适当参考：\n" + "\n".join(f"{i+1}. {item}" for i, item in enumerate(memory_items))
+
+def build_user_content(text: str, processed_files: List[Dict]):
+    """构建用户消息内容：包含图片时使用多模态格式，否则将文件内容拼接到文本中"""
+    from utils.file_processor import format_file_content_for_prompt
+    
+    if not any(f.get("image_base64") for f in processed_files):
+        return text + format_file_content_for_prompt(processed_files)
+    
+    content_parts = [{"type": "text", "text": text}]
+    for file_info in processed_files:
+        if file_info.get("image_base64"):
+            file_ext = file_info.get("file_type", "png")
+            content_parts.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/{file_ext};base64,{file_info['image_base64']}"}
+            })
+        elif file_info.get("content_text"):
+            text = file_info["content_text"]
+            max_length = 5000
+            if len(text) > max_length:
+                text = text[:max_length] + f"\n\n[文档过长，已截取前{max_length}字符]"
+            filename = file_info.get("filename", "未知文件")
+            content_parts[0]["text"] += f"\n\n📄 文档: {filename}\n```\n{text}\n```"
+    
+    app_logger.debug(f"使用多模态消息格式，包含 {len(content_parts) - 1} 张图片")
+    return content_parts
+
+def build_chat_messages(
+    agent: Dict,
+    memory_context: str,
+    session_data: Dict,
+    cleaned_message: str,
+    processed_files: List[Dict]
+) -> List[Dict]:
+    """按层次构建单Agent对话的消息列表：系统提示 → 记忆 → 早期摘要/历史 → 当前消息"""
+    builder = PromptBuilder(agent["model"])
+    builder.system(agent["system_prompt"]).memory(memory_context)
+    
+    # 滑出历史窗口的早期消息以摘要形式保留
+    builder.digest(session_digester.format_digest(session_data))
+    
+    # 添加最近的对话历史（除了刚添加的用户消息）
+    recent_messages = session_data["messages"][-config.CHAT_HISTORY_WINDOW:]
+    for msg in recent_messages[:-1]:
+        if msg["role"] == "user":
+            builder.history("user", msg["content"])
+        elif msg["role"] in ["assistant", "agent"]:
+            builder.history("assistant", msg["content"])
+    
+    # 当前用户消息（包含本轮附件）
+    builder.turn(build_user_content(cleaned_message, processed_files))
+    return builder.build()
+
+def build_continuation_messages(agent: Dict, memory_context: str, session_data: Dict, message_index: int) -> List[Dict]:
+    """构建继续生成中断回复的消息列表：中断前的历史 → 已生成的部分 → 继续指令"""
+    builder = PromptBuilder(agent["model"])
+    builder.system(agent["system_prompt"]).memory(memory_context)
+    builder.digest(session_digester.format_digest(session_data))
+    
+    for msg in session_data["messages"][:message_index][-config.CHAT_HISTORY_WINDOW:]:
+        if msg["role"] == "user":
+            builder.history("user", msg["content"])
+        elif msg["role"] in ["assistant", "agent"]:
+            builder.history("assistant", msg["content"])
+    
+    builder.history("assistant", session_data["messages"][message_index].get("content") or "")
+    builder.turn("你上一条回复在生成途中被中断了。请从中断处直接接着写，不要重复已输出的内容，也不要添加任何说明。")
+    return builder.build()
+
+async def save_agent_message(session_id: str, message: Dict) -> Optional[Dict]:
+    """按消息ID写入Agent回复：已存在（继续生成或检查点恢复）则替换，否则追加"""
+    def apply(session: Dict):
+        for index, existing in enumerate(session["messages"]):
+            if existing.get("id") == message["id"]:
+                session["messages"][index] = message
+                break
+        else:
+            session["messages"].append(message)
+        session["updated_at"] = datetime.now().isoformat()
+    
+    return await db_manager.modify_session(session_id, apply)
+
+async def recover_interrupted_replies() -> int:
+    """把上次运行中断的流式回复以未完成状态写回会话"""
+    recovered = 0
+    for entry in await stream_checkpoints.recover():
+        def apply(session: Dict, entry=entry):
+            for index, existing in enumerate(session["messages"]):
+                if existing.get("id") == entry["message_id"]:
+                    # 已完整保存的回复无需恢复；继续生成中断时把新文本接在原有内容之后
+                    if existing.get("status") == "incomplete":
+                        session["messages"][index] = {**existing, "content": (existing.get("content") or "") + entry["content"]}
+                    return
+            session["messages"].append({
+                "id": entry["message_id"],
+                "role": "agent",
+                "content": entry["content"],
+                "agent_name": entry["agent_name"],
+                "timestamp": entry["timestamp"],
+                "status": "incomplete"
+            })
+        
+        if entry["content"] and await db_manager.modify_session(entry["session_id"], apply):
+            recovered += 1
+    return recovered
+
+def preview_message(message: Dict, max_chars: int) -> Dict:
+    """生成消息预览：截断长文本，多模态内容只保留文本部分"""
+    content = message.get("content")
+    if isinstance(content, list):
+        text = " ".join(part.get("text", "") for part in content if part.get("type") == "text")
+        image_count = sum(1 for part in content if part.get("type") == "image_url")
+        if image_count:
+            text = f"{text} [图片 x{image_count}]".strip()
+        content = text
+    
+    preview = dict(message)
+    if isinstance(content, str) and len(content) > max_chars:
+        preview["content"] = content[:max_chars]
+        preview["truncated"] = True
+    else:
+        preview["content"] = content
+    return preview
+
 @app.middleware("http")
 async def request_middleware(request: Request, call_next):
-    """请求中间件 - 记录指标"""
+    """请求中间件 - 记录指标，API请求开启trace"""
     start_time = asyncio.get_event_loop().time()
+    path = str(request.url.path)
     
     try:
-        response = await call_next(request)
+        with tracer.span(f"{request.method} {path}", root=path.startswith("/api/"), method=request.method, path=path) as span:
+            response = await call_next(request)
+            span.set("status_code", response.status_code)
         
         # 记录成功请求
         response_time = asyncio.get_event_loop().time() - start_time
@@ -245,17 +479,28 @@ async def get_agents(request: Request):
     return {"agents": AGENTS}
 
 @app.get("/api/health")
-async def health_check():
-    """健康检查端点"""
+async def health_check(probe: bool = False):
+    """健康检查端点（读取缓存状态，不阻塞；probe=true 时在后台发起限频的主动探测）"""
     health_status = await metrics_collector.get_health_status()
     
-    # API连接检查
-    api_healthy = await poe_client.health_check()
+    # 上游状态来自各模型熔断器
+    upstream = poe_client.health_status(CONFIGURED_MODELS)
+    if probe:
+        upstream["probe_scheduled"] = poe_client.schedule_probe()
+    api_healthy = upstream["status"] != "unhealthy"
+    
+    api_status = {
+        "healthy": "connected",
+        "degraded": "degraded",
+        "unhealthy": "disconnected",
+        "unknown": "unknown"
+    }[upstream["status"]]
     
     return {
         "status": "healthy" if api_healthy and health_status["status"] != "unhealthy" else "unhealthy",
         "timestamp": datetime.now().isoformat(),
-        "api_status": "connected" if api_healthy else "disconnected",
+        "api_status": api_status,
+        "upstream": upstream,
         "system_metrics": health_status
     }
 
@@ -264,49 +509,163 @@ async def health_check():
 async def get_metrics(request: Request, hours: int = 24):
     """获取系统指标"""
     try:
-        return await metrics_collector.get_metrics_summary(hours)
+        summary = await metrics_collector.get_metrics_summary(hours)
+        summary["prompt_cache"] = prompt_cache_tracker.get_stats()
+        summary["storage"] = metrics_collector.get_commit_stats()
+        summary["streams"] = stream_registry.stats()
+        summary["pipeline"] = metrics_collector.get_stage_stats()
+        summary["event_loop"] = metrics_collector.get_loop_stats()
+        if state_backend.shared:
+            summary["cluster"] = await metrics_collector.get_shared_stats(state_backend)
+        if db_manager.archive is not None:
+            summary["archive"] = db_manager.archive.stats()
+        return summary
     except Exception as e:
         app_logger.error(f"获取指标失败: {e}")
         raise HTTPException(status_code=500, detail="获取指标失败")
 
+def require_admin(request: Request):
+    """调试接口鉴权：X-Admin-Token 或 Authorization: Bearer 与 ADMIN_TOKEN 一致；未配置令牌时接口禁用"""
+    if not config.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="调试接口未启用（未配置ADMIN_TOKEN）")
+    token = request.headers.get("x-admin-token", "")
+    authorization = request.headers.get("authorization", "")
+    if not token and authorization.lower().startswith("bearer "):
+        token = authorization[7:].strip()
+    if not secrets.compare_digest(token.encode("utf-8"), config.ADMIN_TOKEN.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="需要管理员令牌")
+
+@app.get("/api/debug/traces")
+@limiter.limit("30/minute")
+async def get_traces(request: Request, min_ms: Optional[float] = None, limit: int = 20, format: str = "json"):
+    """
+    最近的慢请求trace（仅管理员）
+    
+    Args:
+        min_ms: 只返回耗时不小于该值的trace，默认使用 TRACE_SLOW_MS
+        limit: 最多返回的trace数
+        format: json（按trace分组的span树）或 otlp（OTLP/JSON）
+    """
+    require_admin(request)
+    traces = tracer.recent(config.TRACE_SLOW_MS if min_ms is None else min_ms, max(1, min(limit, 200)))
+    if format == "otlp":
+        return tracer.to_otlp(traces)
+    return {
+        "enabled": tracer.enabled,
+        "sample_rate": tracer.sample_rate,
+        "buffered": len(tracer.traces),
+        "traces": [trace.to_dict() for trace in traces]
+    }
+
+@app.get("/api/debug/blocking")
+@limiter.limit("30/minute")
+async def get_blocking_calls(request: Request, limit: int = 20):
+    """
+    最近阻塞事件循环的调用（仅管理员）
+    
+    看门狗线程在事件循环停顿超过 LOOP_BLOCK_THRESHOLD_MS 时抓取的调用栈，
+    栈顶即为占用事件循环的同步调用
+    """
+    require_admin(request)
+    return {
+        "enabled": config.LOOP_MONITOR_ENABLED,
+        "threshold_ms": config.LOOP_BLOCK_THRESHOLD_MS,
+        "loop_lag": metrics_collector.get_loop_stats(),
+        "blocking_calls": metrics_collector.get_blocking_calls(max(1, min(limit, 50)))
+    }
+
+@app.get("/api/debug/profile")
+@limiter.limit("6/minute")
+async def profile_worker(request: Request, seconds: float = 5, format: str = "json", top: int = 50, idle: bool = False):
+    """
+    对当前worker进行栈采样（仅管理员）
+    
+    采样事件循环线程和线程池线程的调用栈，同时测量事件循环调度延迟
+    
+    Args:
+        seconds: 采样时长，上限 PROFILE_MAX_SECONDS
+        format: json（热点栈 + 循环延迟）或 collapsed（折叠栈文本，可直接生成火焰图）
+        top: json格式下返回的热点栈数量
+        idle: 是否包含空闲等待的调用栈（事件循环等待IO、线程池等待任务）
+    """
+    require_admin(request)
+    seconds = max(0.1, min(seconds, config.PROFILE_MAX_SECONDS))
+    try:
+        result = await stack_sampler.profile(seconds, interval=config.PROFILE_INTERVAL_MS / 1000, idle=idle)
+    except ProfilerBusyError:
+        raise HTTPException(status_code=409, detail="已有采样在进行中")
+    
+    stacks = result.pop("stacks")
+    if format == "collapsed":
+        return PlainTextResponse(format_collapsed(stacks))
+    result["top_stacks"] = [
+        {"stack": stack, "count": count} for stack, count in stacks.most_common(max(1, min(top, 500)))
+    ]
+    return result
+
 @app.get("/api/sessions")
 @limiter.limit("60/minute")
-async def get_sessions(request: Request):
-    """获取所有聊天会话"""
+async def get_sessions(request: Request, limit: Optional[int] = None, cursor: Optional[str] = None):
+    """分页获取聊天会话摘要（按更新时间降序）"""
     try:
-        sessions_data = await db_manager.load_sessions()
-        # 按更新时间降序排序
-        sessions_data.sort(
-            key=lambda s: s.get('updated_at', ''), 
-            reverse=True
-        )
-        
-        # 只返回会话基本信息
-        sessions_info = []
-        for session in sessions_data:
-            sessions_info.append({
-                "id": session.get("id"),
-                "title": session.get("title"),
-                "updated_at": session.get("updated_at"),
-                "created_at": session.get("created_at"),
-                "message_count": len(session.get("messages", []))
-            })
+        limit = min(max(limit or config.SESSIONS_PAGE_SIZE, 1), config.SESSIONS_PAGE_SIZE_MAX)
+        try:
+            sessions_info, next_cursor = await db_manager.list_session_summaries(limit=limit, cursor=cursor)
+        except (ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="无效的分页游标")
         
-        return {"sessions": sessions_info}
+        return {"sessions": sessions_info, "next_cursor": next_cursor}
         
+    except HTTPException:
+        raise
     except Exception as e:
         app_logger.error(f"获取会话列表失败: {e}")
         raise HTTPException(status_code=500, detail="获取会话列表失败")
 
 @app.get("/api/sessions/{session_id}")
 @limiter.limit("60/minute")
-async def get_session(request: Request, session_id: str):
-    """获取特定会话的详细信息"""
+async def get_session(
+    request: Request,
+    session_id: str,
+    limit: Optional[int] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    preview: bool = False
+):
+    """
+    获取特定会话的详细信息
+    
+    未提供分页参数时返回完整会话；提供limit/before/after/preview时按位置分页返回消息，
+    before/after为消息位置游标，preview模式下长消息被截断
+    """
     try:
-        session = await db_manager.get_session_by_id(session_id)
-        if not session:
+        if limit is None and before is None and after is None and not preview:
+            session = await db_manager.get_session_view(session_id)
+            if not session:
+                raise HTTPException(status_code=404, detail="会话不存在")
+            return {"session": session}
+        
+        limit = min(max(limit or config.MESSAGES_PAGE_SIZE, 1), config.MESSAGES_PAGE_SIZE_MAX)
+        page = await db_manager.get_session_messages(session_id, before=before, after=after, limit=limit)
+        if not page:
             raise HTTPException(status_code=404, detail="会话不存在")
-        return {"session": session}
+        
+        messages = page["messages"]
+        if preview:
+            messages = [preview_message(msg, config.MESSAGE_PREVIEW_CHARS) for msg in messages]
+        
+        start, total = page["start"], page["total"]
+        end = start + len(messages)
+        return {
+            "session": {**page["session"], "messages": messages},
+            "page": {
+                "start": start,
+                "end": end,
+                "total": total,
+                "has_more_before": start > 0,
+                "has_more_after": end < total
+            }
+        }
         
     except HTTPException:
         raise
@@ -314,204 +673,401 @@ async def get_session(request: Request, session_id: str):
         app_logger.error(f"获取会话详情失败: {e}")
         raise HTTPException(status_code=500, detail="获取会话详情失败")
 
+@app.get("/api/sessions/{session_id}/messages/{message_id}")
+@limiter.limit("120/minute")
+async def get_session_message(request: Request, session_id: str, message_id: str):
+    """获取单条完整消息（用于展开预览）"""
+    try:
+        message = await db_manager.get_session_message(session_id, message_id)
+        if not message:
+            raise HTTPException(status_code=404, detail="消息不存在")
+        return {"message": message}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        app_logger.error(f"获取消息失败: {e}")
+        raise HTTPException(status_code=500, detail="获取消息失败")
+
+@app.get("/api/search")
+@limiter.limit("60/minute")
+async def search(
+    request: Request,
+    q: str,
+    agent: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    kind: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0
+):
+    """
+    全文搜索会话标题、消息内容和Agent名称
+    
+    kind: discussion（仅讨论）/ chat（仅普通对话）；日期为ISO格式
+    """
+    if not config.SEARCH_ENABLED:
+        raise HTTPException(status_code=503, detail="搜索功能未启用")
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="搜索词不能为空")
+    if kind not in (None, "discussion", "chat"):
+        raise HTTPException(status_code=400, detail="kind 只能是 discussion 或 chat")
+    
+    try:
+        start_time = time.perf_counter()
+        result = await search_index.search(
+            q.strip(),
+            agent=agent,
+            start_date=start_date,
+            end_date=end_date,
+            kind=kind,
+            limit=min(max(limit, 1), config.SEARCH_MAX_RESULTS),
+            offset=max(offset, 0)
+        )
+        result["query"] = q
+        result["took_ms"] = round((time.perf_counter() - start_time) * 1000, 2)
+        return result
+    
+    except Exception as e:
+        app_logger.error(f"搜索失败: {e}")
+        raise HTTPException(status_code=500, detail="搜索失败")
+
+@app.get("/api/export")
+@limiter.limit("5/minute")
+async def export_data(request: Request, format: str = "ndjson", include_archived: bool = True):
+    """
+    流式导出会话、消息、记忆和上传文件元数据
+    
+    format: ndjson / ndjson.gz；导出基于请求时的会话快照，导出期间的写入不影响结果
+    """
+    if format not in ("ndjson", "ndjson.gz"):
+        raise HTTPException(status_code=400, detail="format 只能是 ndjson 或 ndjson.gz")
+    
+    try:
+        # 快照不可变，直接作为时间点视图；归档索引与快照之间不能有await，否则期间的归档会使会话重复或遗漏
+        snapshot = await db_manager.snapshot()
+        archived_reader = db_manager.archived_reader(exclude=snapshot.by_id) if include_archived else None
+        memories = await load_memories()
+        uploads = list_upload_metadata(config.UPLOAD_DIR)
+    except Exception as e:
+        app_logger.error(f"准备导出失败: {e}")
+        raise HTTPException(status_code=500, detail="导出失败")
+    
+    records = iter_export_records(snapshot.sessions, memories, uploads, archived_reader)
+    compress = format == "ndjson.gz"
+    filename = f"export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{format}"
+    app_logger.info(f"📤 开始导出: {len(snapshot.by_id)} 个会话, {len(memories)} 条记忆")
+    
+    return StreamingResponse(
+        encode_ndjson(records, compress=compress),
+        media_type="application/gzip" if compress else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def upsert_memories(memories: List[dict]) -> int:
+    """按ID幂等写入记忆"""
+    def merge(existing: List[dict]):
+        positions = {memory.get("id"): i for i, memory in enumerate(existing)}
+        for memory in memories:
+            if memory["id"] in positions:
+                existing[positions[memory["id"]]] = memory
+            else:
+                positions[memory["id"]] = len(existing)
+                existing.append(memory)
+    
+    await modify_memories(merge)
+    return len(memories)
+
+@app.post("/api/import")
+@limiter.limit("5/minute")
+async def import_data(request: Request):
+    """
+    流式导入 /api/export 生成的NDJSON（支持gzip压缩）
+    
+    会话和记忆按ID幂等写入：已存在的会话按消息ID合并，重复导入不会产生重复数据
+    """
+    try:
+        stats = await import_records(
+            iter_ndjson_records(
+                request.stream(),
+                max_line_bytes=config.IMPORT_MAX_LINE_BYTES,
+                max_total_bytes=config.IMPORT_MAX_BYTES
+            ),
+            upsert_sessions=db_manager.upsert_sessions,
+            upsert_memories=upsert_memories,
+            batch_size=config.IMPORT_BATCH_SIZE
+        )
+        return {"message": "导入完成", "stats": stats}
+    
+    except (ValueError, zlib.error) as e:
+        app_logger.error(f"导入数据格式错误: {e}")
+        raise HTTPException(status_code=400, detail=f"导入数据格式错误: {e}")
+    except Exception as e:
+        app_logger.error(f"导入失败: {e}")
+        raise HTTPException(status_code=500, detail="导入失败")
+
+# ==================== 对话流水线 ====================
+# 单Agent对话的所有入口（普通/流式/继续生成）共用同一条流水线：
+# 解析会话 → 解析附件 → 构建上下文 → 调用模型 → 持久化，各阶段耗时记入 /api/metrics 的 pipeline 统计，
+# 并作为span记入当前请求的trace
+
+@contextmanager
+def pipeline_stage(pipeline: str, stage: str, **attributes):
+    """流水线阶段：同时记录阶段耗时指标和trace span"""
+    with tracer.span(f"{pipeline}.{stage}", **attributes) as span, metrics_collector.time_stage(pipeline, stage):
+        yield span
+
+@dataclass
+class ChatTurn:
+    """一次对话请求在流水线各阶段之间传递的状态"""
+    request: ChatRequest
+    pipeline: str
+    session: Dict = field(default_factory=dict)
+    processed_files: List[Dict] = field(default_factory=list)
+    attachments: List[Dict] = field(default_factory=list)
+    agent: Dict = field(default_factory=dict)
+    messages: List[Dict] = field(default_factory=list)
+    message_id: str = ""
+    base_content: str = ""  # 继续生成时已有的部分回复
+    started_at: str = ""
+
+def validate_chat_request(chat_request: ChatRequest):
+    """基本的输入验证（继续生成中断的回复时无需新消息）"""
+    if not chat_request.message.strip() and not chat_request.continue_message_id:
+        raise HTTPException(status_code=400, detail="消息不能为空")
+    
+    if len(chat_request.message) > 10000:
+        raise HTTPException(status_code=400, detail="消息过长，请控制在10000字符以内")
+    
+    if chat_request.continue_message_id and not chat_request.session_id:
+        raise HTTPException(status_code=400, detail="继续生成需要提供会话ID")
+
+async def resolve_session(turn: ChatTurn):
+    """阶段1：获取或创建会话"""
+    chat_request = turn.request
+    if chat_request.session_id:
+        session_data = await db_manager.get_session_by_id(chat_request.session_id)
+        if not session_data:
+            raise HTTPException(status_code=404, detail="会话不存在")
+    else:
+        # 创建新会话
+        session_data = {
+            "id": str(uuid.uuid4()),
+            "title": chat_request.message[:30] + "..." if len(chat_request.message) > 30 else chat_request.message,
+            "messages": [],
+            "created_at": datetime.now().isoformat(),
+            "updated_at": datetime.now().isoformat()
+        }
+    turn.session = session_data
+
+async def resolve_files(file_ids: Optional[List[str]]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    阶段2：查找并处理上传的附件
+    
+    上传目录只扫描一次，多个附件并发处理
+    
+    Returns:
+        (处理后的文件信息, 附件显示信息)
+    """
+    if not file_ids:
+        return [], []
+    
+    from utils.file_processor import process_uploaded_file
+    
+    def locate() -> List[Tuple[str, str, str, int]]:
+        """上传文件以 file_id 加扩展名命名，返回 (file_id, 路径, 文件名, 大小)"""
+        wanted = set(file_ids)
+        by_id = {}
+        for entry in os.scandir(config.UPLOAD_DIR):
+            file_id = os.path.splitext(entry.name)[0]
+            if file_id in wanted and file_id not in by_id and entry.is_file():
+                by_id[file_id] = (file_id, entry.path, entry.name, entry.stat().st_size)
+        return [by_id[file_id] for file_id in file_ids if file_id in by_id]
+    
+    # 目录扫描和stat在线程中执行，不阻塞事件循环
+    found = await asyncio.to_thread(locate)
+    
+    async def process(path: str, filename: str, size: int):
+        with tracer.span("file.process", filename=filename, size=size):
+            return await process_uploaded_file(path, os.path.splitext(filename)[1][1:], filename)
+    
+    processed_files = await asyncio.gather(*[process(path, filename, size) for _, path, filename, size in found])
+    
+    attachments_info = []
+    for file_id, _, filename, size in found:
+        attachments_info.append({
+            "file_id": file_id,
+            "filename": filename,
+            "file_type": os.path.splitext(filename)[1][1:],
+            "file_size": size
+        })
+        app_logger.info(f"处理文件: {filename}")
+    return list(processed_files), attachments_info
+
+async def build_turn_context(turn: ChatTurn):
+    """阶段3：确定Agent，加载长期记忆并构建分层提示词"""
+    chat_request = turn.request
+    session_data = turn.session
+    with tracer.span("load_memories"):
+        memory_context = build_memory_context(await load_memories())
+    
+    if chat_request.continue_message_id:
+        # 继续生成：在未完成的回复后接着输出，完成后合并为同一条消息
+        message_index = next(
+            (i for i, m in enumerate(session_data["messages"]) if m.get("id") == chat_request.continue_message_id),
+            None
+        )
+        if message_index is None or session_data["messages"][message_index].get("status") != "incomplete":
+            raise HTTPException(status_code=404, detail="没有可继续生成的回复")
+        
+        partial_message = session_data["messages"][message_index]
+        turn.agent = AGENTS.get(partial_message.get("agent_name"), AGENTS["GPT5"])
+        turn.messages = build_continuation_messages(turn.agent, memory_context, session_data, message_index)
+        turn.message_id = partial_message["id"]
+        turn.base_content = partial_message.get("content") or ""
+        return
+    
+    # 添加用户消息
+    session_data["messages"].append({
+        "id": str(uuid.uuid4()),
+        "role": "user",
+        "content": chat_request.message,
+        "timestamp": datetime.now().isoformat(),
+        "attachments": turn.attachments if turn.attachments else None
+    })
+    session_data["updated_at"] = datetime.now().isoformat()
+    
+    # 确定使用的Agent，清理消息中的@提及（用于实际发送给AI）
+    turn.agent = AGENTS.get(chat_request.agent_name, AGENTS["GPT5"])
+    cleaned_message = clean_message_mentions(chat_request.message)
+    turn.messages = build_chat_messages(turn.agent, memory_context, session_data, cleaned_message, turn.processed_files)
+    turn.message_id = str(uuid.uuid4())
+
+async def prepare_chat_turn(chat_request: ChatRequest, pipeline: str) -> ChatTurn:
+    """执行调用模型之前的各阶段，并先行保存用户消息（生成中途重启也不会丢失提问）"""
+    validate_chat_request(chat_request)
+    turn = ChatTurn(request=chat_request, pipeline=pipeline)
+    
+    with pipeline_stage(pipeline, "resolve_session"):
+        await resolve_session(turn)
+    with pipeline_stage(pipeline, "resolve_files"):
+        turn.processed_files, turn.attachments = await resolve_files(chat_request.file_ids)
+    with pipeline_stage(pipeline, "build_context"):
+        await build_turn_context(turn)
+    
+    if not chat_request.continue_message_id:
+        with pipeline_stage(pipeline, "persist_user"):
+            await db_manager.update_session(turn.session)
+    turn.started_at = datetime.now().isoformat()
+    return turn
+
+async def persist_reply(turn: ChatTurn, content: str, status: Optional[str] = None) -> Optional[Dict]:
+    """阶段5：写入Agent回复（完整或未完成），完整回复触发会话摘要刷新"""
+    agent_message = {
+        "id": turn.message_id,
+        "role": "agent",
+        "content": turn.base_content + content,
+        "agent_name": turn.agent["name"],
+        "timestamp": turn.started_at if status else datetime.now().isoformat()
+    }
+    if status:
+        agent_message["status"] = status
+    
+    with pipeline_stage(turn.pipeline, "persist"):
+        saved = await save_agent_message(turn.session["id"], agent_message)
+    if saved and not status:
+        session_digester.schedule(saved)
+    return saved
+
+async def stream_chat_turn(turn: ChatTurn):
+    """
+    阶段4（流式）：调用模型并产生事件
+    
+    在后台任务中运行并写入重放缓冲区，客户端断开后超过宽限期无人重连才被取消；
+    生成过程中定期写检查点，被取消或失败时已生成的部分保存为未完成回复
+    """
+    # 生成span在处理函数中创建并随后台任务继承，请求返回后仍记录到同一条trace
+    span = tracer.current()
+    response_parts: List[str] = []
+    checkpointed = 0
+    policy = CheckpointPolicy(config.STREAM_CHECKPOINT_CHARS, config.STREAM_CHECKPOINT_SECONDS)
+    
+    async def finish(status: Optional[str] = None):
+        if status is None or response_parts:
+            await persist_reply(turn, "".join(response_parts), status)
+        await stream_checkpoints.end(turn.message_id)
+    
+    # 发送会话ID和消息ID
+    yield {
+        "type": "meta",
+        "session_id": turn.session["id"],
+        "message_id": turn.message_id,
+        "agent": turn.agent["name"]
+    }
+    
+    start = time.perf_counter()
+    first_token = True
+    try:
+        # 细碎的上游增量按字节数/时间窗口合并为一帧
+        async for chunk in coalesce_chunks(model_router.stream_chat_completion(
+            agent_models(turn.agent),
+            turn.messages
+        )):
+            if first_token:
+                metrics_collector.record_stage(turn.pipeline, "first_token", time.perf_counter() - start)
+                span.set("first_token_ms", round((time.perf_counter() - start) * 1000, 3))
+                first_token = False
+            response_parts.append(chunk)
+            yield {
+                "type": "content",
+                "content": chunk
+            }
+            
+            # 定期把新增文本追加到检查点日志
+            if policy.should_flush(len(chunk), time.monotonic()):
+                await stream_checkpoints.append(turn.message_id, "".join(response_parts[checkpointed:]))
+                checkpointed = len(response_parts)
+        metrics_collector.record_stage(turn.pipeline, "model", time.perf_counter() - start)
+        
+        # 保存完整的Agent回复（此时上游已完成，保存不随断线取消）
+        await asyncio.shield(finish())
+        
+        yield {
+            "type": "done",
+            "message_id": turn.message_id
+        }
+    
+    except asyncio.CancelledError:
+        # 无人重连而被取消：已生成的部分保存为未完成回复，可稍后继续生成
+        span.set("cancelled", True)
+        await asyncio.shield(finish("incomplete"))
+        raise
+    except Exception as e:
+        app_logger.error(f"流式生成失败: {e}")
+        span.set("error", str(e))
+        await asyncio.shield(finish("incomplete"))
+        yield {
+            "type": "error",
+            "error": str(e)
+        }
+    finally:
+        span.set("chars", sum(len(part) for part in response_parts))
+        span.end()
+
 @app.post("/api/chat")
 @limiter.limit("30/minute")
 async def chat(request: Request, chat_request: ChatRequest):
     """处理聊天请求"""
     try:
-        # 基本的输入验证
-        if not chat_request.message.strip():
-            raise HTTPException(status_code=400, detail="消息不能为空")
-        
-        if len(chat_request.message) > 10000:
-            raise HTTPException(status_code=400, detail="消息过长，请控制在10000字符以内")
-        
-        # 获取或创建会话
-        sessions_data = await db_manager.load_sessions()
-        session_data = None
-        
-        if chat_request.session_id:
-            session_data = await db_manager.get_session_by_id(chat_request.session_id)
-            if not session_data:
-                raise HTTPException(status_code=404, detail="会话不存在")
-        else:
-            # 创建新会话
-            session_id = str(uuid.uuid4())
-            session_data = {
-                "id": session_id,
-                "title": chat_request.message[:30] + "..." if len(chat_request.message) > 30 else chat_request.message,
-                "messages": [],
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
-        
-        # 处理上传的文件
-        processed_files = []
-        attachments_info = []
-        
-        if chat_request.file_ids:
-            from utils.file_processor import process_uploaded_file
-            
-            for file_id in chat_request.file_ids:
-                # 查找文件
-                for filename in os.listdir(config.UPLOAD_DIR):
-                    if filename.startswith(file_id):
-                        file_path = os.path.join(config.UPLOAD_DIR, filename)
-                        file_ext = os.path.splitext(filename)[1][1:]  # 去掉点号
-                        original_name = filename  # 这里简化处理，实际应该从数据库获取原始文件名
-                        
-                        # 处理文件
-                        file_info = await process_uploaded_file(file_path, file_ext, filename)
-                        processed_files.append(file_info)
-                        
-                        # 保存附件信息（用于显示）
-                        file_stat = os.stat(file_path)
-                        attachments_info.append({
-                            "file_id": file_id,
-                            "filename": filename,
-                            "file_type": file_ext,
-                            "file_size": file_stat.st_size
-                        })
-                        
-                        app_logger.info(f"处理文件: {filename} ({file_ext})")
-                        break
-        
-        # 添加用户消息（包含附件信息）
-        user_message = {
-            "id": str(uuid.uuid4()),
-            "role": "user",
-            "content": chat_request.message,
-            "timestamp": datetime.now().isoformat(),
-            "attachments": attachments_info if attachments_info else None
-        }
-        session_data["messages"].append(user_message)
-        
-        # 确定使用的Agent
-        selected_agent = AGENTS.get(chat_request.agent_name, AGENTS["GPT5"])
-        
-        # 加载长期记忆并构建上下文
-        memories = await load_memories()
-        memory_context = ""
-        
-        if memories:
-            # 按重要程度排序，只取重要的记忆（importance >= 3）
-            important_memories = [m for m in memories if m.get('importance', 3) >= 3]
-            important_memories.sort(key=lambda m: m.get('importance', 3), reverse=True)
-            
-            # 最多使用前10条重要记忆
-            top_memories = important_memories[:10]
-            
-            if top_memories:
-                memory_items = []
-                for mem in top_memories:
-                    category = getCategoryLabel(mem.get('category', 'general'))
-                    importance = '⭐' * mem.get('importance', 3)
-                    memory_items.append(f"[{category}] {mem['title']}: {mem['content']}")
-                
-                memory_context = "\n\n【长期记忆】\n以下是用户的长期记忆信息，请在回答时适当参考：\n" + "\n".join(f"{i+1}. {item}" for i, item in enumerate(memory_items))
-        
-        # 处理文件内容并添加到上下文
-        file_context = ""
-        if processed_files:
-            from utils.file_processor import format_file_content_for_prompt
-            file_context = format_file_content_for_prompt(processed_files)
-        
-        # 构建系统提示（包含记忆）
-        system_prompt = selected_agent["system_prompt"]
-        if memory_context:
-            system_prompt += memory_context
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # 添加最近的对话历史
-        recent_messages = session_data["messages"][-20:]  # 最近20条消息
-        for msg in recent_messages[:-1]:  # 除了刚添加的用户消息
-            if msg["role"] == "user":
-                messages.append({"role": "user", "content": msg["content"]})
-            elif msg["role"] in ["assistant", "agent"]:
-                messages.append({"role": "assistant", "content": msg["content"]})
-        
-        # 添加当前用户消息（包含文件内容）
-        # 检查是否有图片文件
-        has_images = any(f.get("image_base64") for f in processed_files)
-        
-        # 清理消息中的@提及（用于实际发送给AI）
-        cleaned_message = clean_message_mentions(chat_request.message)
-        
-        if has_images:
-            # 使用多模态消息格式（支持图片）
-            content_parts = [{"type": "text", "text": cleaned_message}]
-            
-            # 添加图片
-            for file_info in processed_files:
-                if file_info.get("image_base64"):
-                    image_data = file_info["image_base64"]
-                    file_ext = file_info.get("file_type", "png")
-                    mime_type = f"image/{file_ext}"
-                    
-                    # 调试信息：记录图片数据的前100个字符
-                    app_logger.info(f"📷 图片文件: {file_info.get('filename')}")
-                    app_logger.info(f"📷 文件类型: {file_ext}, MIME: {mime_type}")
-                    app_logger.info(f"📷 Base64长度: {len(image_data)} 字符")
-                    app_logger.info(f"📷 Base64前100字符: {image_data[:100]}")
-                    
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{mime_type};base64,{image_data}"
-                        }
-                    })
-                    app_logger.info(f"✅ 已添加图片到消息: {file_info.get('filename')}")
-                
-                # 添加文本文件内容
-                elif file_info.get("content_text"):
-                    text = file_info["content_text"]
-                    max_length = 5000
-                    if len(text) > max_length:
-                        text = text[:max_length] + f"\n\n[文档过长，已截取前{max_length}字符]"
-                    
-                    filename = file_info.get("filename", "未知文件")
-                    content_parts[0]["text"] += f"\n\n📄 文档: {filename}\n```\n{text}\n```"
-            
-            messages.append({"role": "user", "content": content_parts})
-            app_logger.info(f"使用多模态消息格式，包含 {len([f for f in processed_files if f.get('image_base64')])} 张图片")
-        else:
-            # 纯文本消息格式
-            current_user_message = cleaned_message
-            if file_context:
-                current_user_message += file_context
-                app_logger.info(f"已添加 {len(processed_files)} 个文件到上下文")
-            
-            messages.append({"role": "user", "content": current_user_message})
+        turn = await prepare_chat_turn(chat_request, "chat")
         
         # 调用API
         try:
-            response_content = await poe_client.chat_completion(
-                model=selected_agent["model"],
-                messages=messages
-            )
-            
-            # 添加Agent回复
-            agent_message = {
-                "id": str(uuid.uuid4()),
-                "role": "agent",
-                "content": response_content,
-                "agent_name": selected_agent["name"],
-                "timestamp": datetime.now().isoformat()
-            }
-            session_data["messages"].append(agent_message)
-            
-            # 更新会话时间
-            session_data["updated_at"] = datetime.now().isoformat()
-            
-            # 保存会话
-            await db_manager.update_session(session_data)
-            
-            return {
-                "session_id": session_data["id"],
-                "message": agent_message,
-                "agent": selected_agent["name"]
-            }
+            with pipeline_stage(turn.pipeline, "model"):
+                response_content = await model_router.chat_completion(
+                    agent_models(turn.agent),
+                    turn.messages
+                )
             
         except APIAuthError as e:
             app_logger.error(f"API认证失败: {e}")
@@ -525,198 +1081,14 @@ async def chat(request: Request, chat_request: ChatRequest):
             app_logger.error(f"API调用失败: {e}")
             raise HTTPException(status_code=503, detail="AI服务暂时不可用，请稍后再试")
         
-    except HTTPException:
-        raise
-    except Exception as e:
-        app_logger.error(f"聊天处理失败: {e}")
-        raise HTTPException(status_code=500, detail="处理聊天时发生错误")
-
-@app.post("/api/chat/stream")
-@limiter.limit("30/minute")
-async def chat_stream(request: Request, chat_request: ChatRequest):
-    """处理流式聊天请求"""
-    try:
-        # 基本的输入验证
-        if not chat_request.message.strip():
-            raise HTTPException(status_code=400, detail="消息不能为空")
-        
-        if len(chat_request.message) > 10000:
-            raise HTTPException(status_code=400, detail="消息过长，请控制在10000字符以内")
-        
-        # 获取或创建会话
-        sessions_data = await db_manager.load_sessions()
-        session_data = None
-        
-        if chat_request.session_id:
-            session_data = await db_manager.get_session_by_id(chat_request.session_id)
-            if not session_data:
-                raise HTTPException(status_code=404, detail="会话不存在")
-        else:
-            # 创建新会话
-            session_id = str(uuid.uuid4())
-            session_data = {
-                "id": session_id,
-                "title": chat_request.message[:30] + "..." if len(chat_request.message) > 30 else chat_request.message,
-                "messages": [],
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
-        
-        # 处理上传的文件
-        processed_files = []
-        attachments_info = []
-        
-        if chat_request.file_ids:
-            from utils.file_processor import process_uploaded_file
-            
-            for file_id in chat_request.file_ids:
-                # 查找文件
-                for filename in os.listdir(config.UPLOAD_DIR):
-                    if filename.startswith(file_id):
-                        file_path = os.path.join(config.UPLOAD_DIR, filename)
-                        file_ext = os.path.splitext(filename)[1][1:]
-                        
-                        # 处理文件
-                        file_info = await process_uploaded_file(file_path, file_ext, filename)
-                        processed_files.append(file_info)
-                        
-                        # 保存附件信息
-                        file_stat = os.stat(file_path)
-                        attachments_info.append({
-                            "file_id": file_id,
-                            "filename": filename,
-                            "file_type": file_ext,
-                            "file_size": file_stat.st_size
-                        })
-                        break
-        
-        # 添加用户消息
-        user_message = {
-            "id": str(uuid.uuid4()),
-            "role": "user",
-            "content": chat_request.message,
-            "timestamp": datetime.now().isoformat(),
-            "attachments": attachments_info if attachments_info else None
+        saved = await persist_reply(turn, response_content)
+        agent_message = next(m for m in saved["messages"] if m.get("id") == turn.message_id) if saved else None
+        return {
+            "session_id": turn.session["id"],
+            "message": agent_message,
+            "agent": turn.agent["name"]
         }
-        session_data["messages"].append(user_message)
-        
-        # 确定使用的Agent
-        selected_agent = AGENTS.get(chat_request.agent_name, AGENTS["GPT5"])
-        
-        # 加载长期记忆并构建上下文
-        memories = await load_memories()
-        memory_context = ""
-        
-        if memories:
-            important_memories = [m for m in memories if m.get('importance', 3) >= 3]
-            important_memories.sort(key=lambda m: m.get('importance', 3), reverse=True)
-            top_memories = important_memories[:10]
-            
-            if top_memories:
-                memory_items = []
-                for mem in top_memories:
-                    category = getCategoryLabel(mem.get('category', 'general'))
-                    memory_items.append(f"[{category}] {mem['title']}: {mem['content']}")
-                
-                memory_context = "\n\n【长期记忆】\n以下是用户的长期记忆信息，请在回答时适当参考：\n" + "\n".join(f"{i+1}. {item}" for i, item in enumerate(memory_items))
-        
-        # 处理文件内容并添加到上下文
-        file_context = ""
-        if processed_files:
-            from utils.file_processor import format_file_content_for_prompt
-            file_context = format_file_content_for_prompt(processed_files)
-        
-        # 构建系统提示
-        system_prompt = selected_agent["system_prompt"]
-        if memory_context:
-            system_prompt += memory_context
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # 添加最近的对话历史
-        recent_messages = session_data["messages"][-20:]
-        for msg in recent_messages[:-1]:
-            if msg["role"] == "user":
-                messages.append({"role": "user", "content": msg["content"]})
-            elif msg["role"] in ["assistant", "agent"]:
-                messages.append({"role": "assistant", "content": msg["content"]})
-        
-        # 添加当前用户消息
-        has_images = any(f.get("image_base64") for f in processed_files)
-        
-        # 清理消息中的@提及（用于实际发送给AI）
-        cleaned_message = clean_message_mentions(chat_request.message)
-        
-        if has_images:
-            content_parts = [{"type": "text", "text": cleaned_message}]
-            for file_info in processed_files:
-                if file_info.get("image_base64"):
-                    image_data = file_info["image_base64"]
-                    file_ext = file_info.get("file_type", "png")
-                    mime_type = f"image/{file_ext}"
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:{mime_type};base64,{image_data}"}
-                    })
-                elif file_info.get("content_text"):
-                    text = file_info["content_text"]
-                    max_length = 5000
-                    if len(text) > max_length:
-                        text = text[:max_length] + f"\n\n[文档过长，已截取前{max_length}字符]"
-                    filename = file_info.get("filename", "未知文件")
-                    content_parts[0]["text"] += f"\n\n📄 文档: {filename}\n```\n{text}\n```"
-            messages.append({"role": "user", "content": content_parts})
-        else:
-            current_user_message = cleaned_message
-            if file_context:
-                current_user_message += file_context
-            messages.append({"role": "user", "content": current_user_message})
-
-        # 生成器函数
-        async def generate():
-            full_response = ""
-            agent_message_id = str(uuid.uuid4())
-            
-            # 发送会话ID和消息ID
-            yield json.dumps({
-                "type": "meta",
-                "session_id": session_data["id"],
-                "message_id": agent_message_id,
-                "agent": selected_agent["name"]
-            }) + "\n"
-            
-            try:
-                async for chunk in poe_client.stream_chat_completion(
-                    model=selected_agent["model"],
-                    messages=messages
-                ):
-                    full_response += chunk
-                    yield json.dumps({
-                        "type": "content",
-                        "content": chunk
-                    }) + "\n"
-                
-                # 保存完整的Agent回复
-                agent_message = {
-                    "id": agent_message_id,
-                    "role": "agent",
-                    "content": full_response,
-                    "agent_name": selected_agent["name"],
-                    "timestamp": datetime.now().isoformat()
-                }
-                session_data["messages"].append(agent_message)
-                session_data["updated_at"] = datetime.now().isoformat()
-                await db_manager.update_session(session_data)
-                
-            except Exception as e:
-                app_logger.error(f"流式生成失败: {e}")
-                yield json.dumps({
-                    "type": "error",
-                    "error": str(e)
-                }) + "\n"
-
-        return StreamingResponse(generate(), media_type="application/x-ndjson")
-
+    
     except HTTPException:
         raise
     except Exception as e:
@@ -726,203 +1098,52 @@ async def chat_stream(request: Request, chat_request: ChatRequest):
 @app.post("/api/chat/stream")
 @limiter.limit("30/minute")
 async def chat_stream(request: Request, chat_request: ChatRequest):
-    """处理聊天请求（流式输出）"""
+    """处理流式聊天请求（SSE或NDJSON），也用于继续生成未完成的回复"""
     try:
-        # 基本的输入验证
-        if not chat_request.message.strip():
-            raise HTTPException(status_code=400, detail="消息不能为空")
-        
-        if len(chat_request.message) > 10000:
-            raise HTTPException(status_code=400, detail="消息过长，请控制在10000字符以内")
-        
-        # 获取或创建会话
-        sessions_data = await db_manager.load_sessions()
-        session_data = None
-        
-        if chat_request.session_id:
-            session_data = await db_manager.get_session_by_id(chat_request.session_id)
-            if not session_data:
-                raise HTTPException(status_code=404, detail="会话不存在")
-        else:
-            # 创建新会话
-            session_id = str(uuid.uuid4())
-            session_data = {
-                "id": session_id,
-                "title": chat_request.message[:30] + "..." if len(chat_request.message) > 30 else chat_request.message,
-                "messages": [],
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
-        
-        # 处理上传的文件
-        processed_files = []
-        attachments_info = []
-        
-        if chat_request.file_ids:
-            from utils.file_processor import process_uploaded_file
-            
-            for file_id in chat_request.file_ids:
-                for filename in os.listdir(config.UPLOAD_DIR):
-                    if filename.startswith(file_id):
-                        file_path = os.path.join(config.UPLOAD_DIR, filename)
-                        file_ext = os.path.splitext(filename)[1][1:]
-                        file_info = await process_uploaded_file(file_path, file_ext, filename)
-                        processed_files.append(file_info)
-                        
-                        file_stat = os.stat(file_path)
-                        attachments_info.append({
-                            "file_id": file_id,
-                            "filename": filename,
-                            "file_type": file_ext,
-                            "file_size": file_stat.st_size
-                        })
-                        break
-        
-        # 添加用户消息
-        user_message = {
-            "id": str(uuid.uuid4()),
-            "role": "user",
-            "content": chat_request.message,
-            "timestamp": datetime.now().isoformat(),
-            "attachments": attachments_info if attachments_info else None
-        }
-        session_data["messages"].append(user_message)
-        
-        # 确定使用的Agent
-        selected_agent = AGENTS.get(chat_request.agent_name, AGENTS["GPT5"])
-        
-        # 构建消息上下文（与非流式版本相同）
-        memories = await load_memories()
-        memory_context = ""
-        if memories:
-            important_memories = [m for m in memories if m.get('importance', 3) >= 3]
-            important_memories.sort(key=lambda m: m.get('importance', 3), reverse=True)
-            top_memories = important_memories[:10]
-            
-            if top_memories:
-                memory_items = []
-                for mem in top_memories:
-                    category = getCategoryLabel(mem.get('category', 'general'))
-                    memory_items.append(f"[{category}] {mem['title']}: {mem['content']}")
-                memory_context = "\n\n【长期记忆】\n以下是用户的长期记忆信息，请在回答时适当参考：\n" + "\n".join(f"{i+1}. {item}" for i, item in enumerate(memory_items))
-        
-        # 处理文件内容
-        file_context = ""
-        if processed_files:
-            from utils.file_processor import format_file_content_for_prompt
-            file_context = format_file_content_for_prompt(processed_files)
-        
-        # 构建系统提示
-        system_prompt = selected_agent["system_prompt"]
-        if memory_context:
-            system_prompt += memory_context
-        
-        messages = [{"role": "system", "content": system_prompt}]
-        
-        # 添加最近的对话历史
-        recent_messages = session_data["messages"][-20:]
-        for msg in recent_messages[:-1]:
-            if msg["role"] == "user":
-                messages.append({"role": "user", "content": msg["content"]})
-            elif msg["role"] in ["assistant", "agent"]:
-                messages.append({"role": "assistant", "content": msg["content"]})
-        
-        # 添加当前用户消息
-        has_images = any(f.get("image_base64") for f in processed_files)
-        
-        # 清理消息中的@提及（用于实际发送给AI）
-        cleaned_message = clean_message_mentions(chat_request.message)
-        
-        if has_images:
-            content_parts = [{"type": "text", "text": cleaned_message}]
-            for file_info in processed_files:
-                if file_info.get("image_base64"):
-                    image_data = file_info["image_base64"]
-                    file_ext = file_info.get("file_type", "png")
-                    mime_type = f"image/{file_ext}"
-                    content_parts.append({
-                        "type": "image_url",
-                        "image_url": {"url": f"data:{mime_type};base64,{image_data}"}
-                    })
-                elif file_info.get("content_text"):
-                    text = file_info["content_text"][:5000]
-                    filename = file_info.get("filename", "未知文件")
-                    content_parts[0]["text"] += f"\n\n📄 文档: {filename}\n```\n{text}\n```"
-            messages.append({"role": "user", "content": content_parts})
-        else:
-            current_user_message = cleaned_message
-            if file_context:
-                current_user_message += file_context
-            messages.append({"role": "user", "content": current_user_message})
-        
-        # 流式生成器函数
-        async def generate_stream():
-            accumulated_content = ""
-            try:
-                # 发送初始元数据
-                import json
-                metadata = {
-                    "type": "metadata",
-                    "session_id": session_data["id"],
-                    "agent_name": selected_agent["name"]
-                }
-                yield f"data: {json.dumps(metadata, ensure_ascii=False)}\n\n"
-                
-                # 流式调用API
-                async for chunk in poe_client.stream_chat_completion(
-                    model=selected_agent["model"],
-                    messages=messages
-                ):
-                    accumulated_content += chunk
-                    chunk_data = {
-                        "type": "content",
-                        "content": chunk
-                    }
-                    yield f"data: {json.dumps(chunk_data, ensure_ascii=False)}\n\n"
-                
-                # 保存完整的Agent回复到会话
-                agent_message = {
-                    "id": str(uuid.uuid4()),
-                    "role": "agent",
-                    "content": accumulated_content,
-                    "agent_name": selected_agent["name"],
-                    "timestamp": datetime.now().isoformat()
-                }
-                session_data["messages"].append(agent_message)
-                session_data["updated_at"] = datetime.now().isoformat()
-                await db_manager.update_session(session_data)
-                
-                # 发送完成信号
-                done_data = {
-                    "type": "done",
-                    "message_id": agent_message["id"]
-                }
-                yield f"data: {json.dumps(done_data, ensure_ascii=False)}\n\n"
-                
-            except Exception as e:
-                app_logger.error(f"流式生成失败: {e}")
-                error_data = {
-                    "type": "error",
-                    "error": str(e)
-                }
-                yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+        turn = await prepare_chat_turn(chat_request, "chat_stream")
+        await stream_checkpoints.begin(turn.message_id, turn.session["id"], turn.agent["name"], turn.started_at)
         
+        generate_span = tracer.start_span("chat_stream.generate", agent=turn.agent["name"], model=turn.agent["model"])
+        with tracer.activate(generate_span):
+            buffer = stream_registry.start(turn.message_id, stream_chat_turn(turn))
+        sse = wants_sse(request)
         return StreamingResponse(
-            generate_stream(),
-            media_type="text/event-stream",
-            headers={
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no"
-            }
+            stream_events(request, buffer.subscribe(), sse=sse),
+            media_type=SSE_MEDIA_TYPE if sse else NDJSON_MEDIA_TYPE,
+            headers=STREAM_HEADERS
         )
-        
+
     except HTTPException:
         raise
     except Exception as e:
-        app_logger.error(f"流式聊天处理失败: {e}")
+        app_logger.error(f"聊天处理失败: {e}")
         raise HTTPException(status_code=500, detail="处理聊天时发生错误")
 
+@app.get("/api/chat/stream/{message_id}")
+@limiter.limit("60/minute")
+async def resume_chat_stream(request: Request, message_id: str, last_event_id: Optional[int] = None):
+    """
+    断线续传：重放 Last-Event-ID（请求头或 last_event_id 参数）之后的事件，再衔接实时输出
+    """
+    buffer = stream_registry.get(message_id)
+    if buffer is None:
+        raise HTTPException(status_code=404, detail="流已结束或已过期，请重新加载会话")
+    
+    if last_event_id is None:
+        try:
+            last_event_id = int(request.headers.get("last-event-id", "0"))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Last-Event-ID无效")
+    if buffer.truncated and last_event_id < buffer.seq:
+        raise HTTPException(status_code=410, detail="重放缓冲已失效，请重新加载会话")
+    
+    sse = wants_sse(request)
+    return StreamingResponse(
+        stream_events(request, buffer.subscribe(after=last_event_id), sse=sse),
+        media_type=SSE_MEDIA_TYPE if sse else NDJSON_MEDIA_TYPE,
+        headers=STREAM_HEADERS
+    )
+
 @app.delete("/api/sessions/{session_id}")
 @limiter.limit("30/minute")
 async def delete_session(request: Request, session_id: str):
@@ -942,6 +1163,7 @@ async def delete_session(request: Request, session_id: str):
 
 # ==================== 长期记忆管理 API ====================
 MEMORIES_FILE = "memories.json"
+memories_store = JsonFileStore(MEMORIES_FILE)
 
 def getCategoryLabel(category: str) -> str:
     """获取分类的中文标签"""
@@ -954,22 +1176,19 @@ def getCategoryLabel(category: str) -> str:
     return labels.get(category, category)
 
 async def load_memories() -> List[dict]:
-    """加载所有记忆"""
+    """加载所有记忆（文件未被修改时使用缓存；记忆字典为共享对象，只能读取，修改使用 modify_memories）"""
     try:
-        if os.path.exists(MEMORIES_FILE):
-            async with aiofiles.open(MEMORIES_FILE, 'r', encoding='utf-8') as f:
-                content = await f.read()
-                return json.loads(content)
-        return []
+        return list(await memories_store.load())
     except Exception as e:
         app_logger.error(f"加载记忆失败: {e}")
         return []
 
-async def save_memories(memories: List[dict]):
-    """保存所有记忆"""
+async def modify_memories(mutator: Callable[[List[dict]], Any]) -> Any:
+    """在跨进程文件锁内读取最新的记忆列表，由 mutator 原地修改后原子写回，返回 mutator 的返回值"""
     try:
-        async with aiofiles.open(MEMORIES_FILE, 'w', encoding='utf-8') as f:
-            await f.write(json.dumps(memories, ensure_ascii=False, indent=2))
+        return await memories_store.modify(mutator)
+    except HTTPException:
+        raise
     except Exception as e:
         app_logger.error(f"保存记忆失败: {e}")
         raise
@@ -1018,8 +1237,6 @@ async def get_memory(request: Request, memory_id: str):
 async def create_memory(request: Request, memory_request: MemoryCreateRequest):
     """创建新记忆"""
     try:
-        memories = await load_memories()
-        
         # 创建新记忆
         new_memory = {
             "id": str(uuid.uuid4()),
@@ -1032,8 +1249,7 @@ async def create_memory(request: Request, memory_request: MemoryCreateRequest):
             "updated_at": datetime.now().isoformat()
         }
         
-        memories.append(new_memory)
-        await save_memories(memories)
+        await modify_memories(lambda memories: memories.append(new_memory))
         
         app_logger.info(f"创建记忆: {new_memory['id']}")
         return {"memory": new_memory, "message": "记忆创建成功"}
@@ -1047,27 +1263,28 @@ async def create_memory(request: Request, memory_request: MemoryCreateRequest):
 async def update_memory(request: Request, memory_id: str, memory_request: MemoryUpdateRequest):
     """更新记忆"""
     try:
-        memories = await load_memories()
-        memory = next((m for m in memories if m["id"] == memory_id), None)
-        
-        if not memory:
-            raise HTTPException(status_code=404, detail="记忆不存在")
-        
-        # 更新字段
-        if memory_request.title is not None:
-            memory["title"] = memory_request.title
-        if memory_request.content is not None:
-            memory["content"] = memory_request.content
-        if memory_request.category is not None:
-            memory["category"] = memory_request.category
-        if memory_request.tags is not None:
-            memory["tags"] = memory_request.tags
-        if memory_request.importance is not None:
-            memory["importance"] = memory_request.importance
-        
-        memory["updated_at"] = datetime.now().isoformat()
+        def apply(memories: List[dict]) -> dict:
+            memory = next((m for m in memories if m["id"] == memory_id), None)
+            
+            if not memory:
+                raise HTTPException(status_code=404, detail="记忆不存在")
+            
+            # 更新字段
+            if memory_request.title is not None:
+                memory["title"] = memory_request.title
+            if memory_request.content is not None:
+                memory["content"] = memory_request.content
+            if memory_request.category is not None:
+                memory["category"] = memory_request.category
+            if memory_request.tags is not None:
+                memory["tags"] = memory_request.tags
+            if memory_request.importance is not None:
+                memory["importance"] = memory_request.importance
+            
+            memory["updated_at"] = datetime.now().isoformat()
+            return memory
         
-        await save_memories(memories)
+        memory = await modify_memories(apply)
         
         app_logger.info(f"更新记忆: {memory_id}")
         return {"memory": memory, "message": "记忆更新成功"}
@@ -1083,14 +1300,15 @@ async def update_memory(request: Request, memory_id: str, memory_request: Memory
 async def delete_memory(request: Request, memory_id: str):
     """删除记忆"""
     try:
-        memories = await load_memories()
-        original_len = len(memories)
-        memories = [m for m in memories if m["id"] != memory_id]
-        
-        if len(memories) == original_len:
-            raise HTTPException(status_code=404, detail="记忆不存在")
+        def remove(memories: List[dict]):
+            remaining = [m for m in memories if m["id"] != memory_id]
+            
+            if len(remaining) == len(memories):
+                raise HTTPException(status_code=404, detail="记忆不存在")
+            
+            memories[:] = remaining
         
-        await save_memories(memories)
+        await modify_memories(remove)
         
         app_logger.info(f"删除记忆: {memory_id}")
         return {"message": "记忆已删除"}
@@ -1231,24 +1449,9 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
             "is_discussion": True
         }
         
-        # 处理上传的文件（如果有）
-        file_context = ""
-        processed_files = []
-        if discussion_request.file_ids:
-            from utils.file_processor import process_uploaded_file, format_file_content_for_prompt
-            
-            for file_id in discussion_request.file_ids:
-                for filename in os.listdir(config.UPLOAD_DIR):
-                    if filename.startswith(file_id):
-                        file_path = os.path.join(config.UPLOAD_DIR, filename)
-                        file_ext = os.path.splitext(filename)[1][1:]
-                        file_info = await process_uploaded_file(file_path, file_ext, filename)
-                        processed_files.append(file_info)
-                        app_logger.info(f"📎 处理讨论文件: {filename}")
-                        break
-            
-            if processed_files:
-                file_context = format_file_content_for_prompt(processed_files)
+        # 处理上传的文件（如果有），与单Agent对话共用附件解析阶段
+        with pipeline_stage("discussion", "resolve_files"):
+            processed_files, _ = await resolve_files(discussion_request.file_ids)
         
         # 添加用户问题
         user_message = {
@@ -1260,26 +1463,21 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
         session_data["messages"].append(user_message)
         
         # 加载长期记忆
-        memories = await load_memories()
-        memory_context = ""
-        if memories:
-            important_memories = [m for m in memories if m.get('importance', 3) >= 3]
-            important_memories.sort(key=lambda m: m.get('importance', 3), reverse=True)
-            top_memories = important_memories[:10]
-            
-            if top_memories:
-                memory_items = []
-                for mem in top_memories:
-                    category = getCategoryLabel(mem.get('category', 'general'))
-                    memory_items.append(f"[{category}] {mem['title']}: {mem['content']}")
-                memory_context = "\n\n【长期记忆】\n" + "\n".join(f"{i+1}. {item}" for i, item in enumerate(memory_items))
-        
-        # 构建讨论上下文（问题 + 文件 + 记忆）
-        discussion_context = discussion_request.question
-        if file_context:
-            discussion_context += file_context
-        if memory_context:
-            discussion_context += memory_context
+        memory_context = build_memory_context(await load_memories())
+        
+        # 讨论问题与附件在整个讨论中保持不变，作为可缓存的文件层
+        discussion_content = build_user_content(f"讨论问题: {discussion_request.question}", processed_files)
+        
+        # 滚动压缩：较早的轮次折叠为有界摘要，只保留最近一轮的完整发言
+        compress_history = discussion_request.compress_history
+        if compress_history is None:
+            compress_history = config.DISCUSSION_COMPRESSION
+        compressor = None
+        if compress_history:
+            compressor = TranscriptCompressor(
+                max_chars=config.DISCUSSION_DIGEST_MAX_CHARS,
+                model=config.SUMMARY_MODEL or None
+            )
         
         # 进行多轮讨论
         app_logger.info(f"🚀 开始 {discussion_request.rounds} 轮讨论...")
@@ -1287,62 +1485,34 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
         for round_num in range(1, discussion_request.rounds + 1):
             app_logger.info(f"📣 第 {round_num}/{discussion_request.rounds} 轮讨论")
             
+            # 从第3轮开始，将倒数第二轮折叠进摘要
+            if compressor and round_num >= 3:
+                fold_round = round_num - 2
+                await compressor.compress_round(fold_round, [
+                    (f"【{msg['agent_name']}】(第{msg.get('round', 1)}轮)", msg["content"])
+                    for msg in session_data["messages"][1:]
+                    if msg["role"] == "agent" and compressor.digested_rounds < msg.get("round", 1) <= fold_round
+                ])
+            
             for agent_name in discussion_request.selected_agents:
                 agent = AGENTS[agent_name]
                 app_logger.info(f"💬 {agent_name} 正在发言...")
                 
-                # 构建该专家的系统提示
-                system_prompt = agent["system_prompt"]
-                system_prompt += f"\n\n当前是多智能体讨论的第 {round_num} 轮，共 {discussion_request.rounds} 轮。"
-                system_prompt += f"\n参与讨论的专家有: {', '.join(discussion_request.selected_agents)}。"
-                system_prompt += "\n请基于讨论问题和其他专家的观点，提供你的专业见解。"
-                
-                # 构建消息历史
-                messages = [{"role": "system", "content": system_prompt}]
-                
-                # 添加问题作为初始user消息
-                # 检查是否有图片文件
-                has_images = any(f.get("image_base64") for f in processed_files)
-                
-                if has_images:
-                    # 使用多模态消息格式
-                    content_parts = [{"type": "text", "text": f"讨论问题: {discussion_request.question}"}]
-                    
-                    # 添加图片
-                    for file_info in processed_files:
-                        if file_info.get("image_base64"):
-                            image_data = file_info["image_base64"]
-                            file_ext = file_info.get("file_type", "png")
-                            mime_type = f"image/{file_ext}"
-                            
-                            content_parts.append({
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:{mime_type};base64,{image_data}"
-                                }
-                            })
-                        # 添加文本文件内容
-                        elif file_info.get("content_text"):
-                            text = file_info["content_text"]
-                            max_length = 5000
-                            if len(text) > max_length:
-                                text = text[:max_length] + f"\n\n[文档过长，已截取前{max_length}字符]"
-                            filename = file_info.get("filename", "未知文件")
-                            content_parts[0]["text"] += f"\n\n📄 文档: {filename}\n```\n{text}\n```"
-                    
-                    # 添加记忆上下文到文本部分
-                    if memory_context:
-                        content_parts[0]["text"] += memory_context
-                    
-                    messages.append({"role": "user", "content": content_parts})
-                else:
-                    # 纯文本消息
-                    messages.append({"role": "user", "content": f"讨论问题: {discussion_context}"})
+                # 分层构建：静态系统提示 → 记忆 → 讨论问题与文件 → 历史发言 → 当前轮次
+                builder = PromptBuilder(agent["model"])
+                builder.system(agent["system_prompt"]).memory(memory_context).files(discussion_content)
                 
                 # 添加之前的讨论消息（转换为user/assistant交替格式）
                 previous_messages = []
+                digest_prefix = ""
+                if compressor and compressor.digest:
+                    digest_prefix = f"【前{compressor.digested_rounds}轮讨论摘要】\n{compressor.digest}\n\n"
+                
                 for msg in session_data["messages"][1:]:  # 跳过用户的原始问题
                     if msg["role"] == "agent" and msg.get("content", "").strip():
+                        # 已折叠进摘要的轮次不再逐条发送
+                        if compressor and msg.get("round", 1) <= compressor.digested_rounds:
+                            continue
                         content = msg["content"].strip()
                         previous_messages.append({
                             "agent_name": msg["agent_name"],
@@ -1351,22 +1521,19 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
                 
                 # 将之前的发言转换为对话格式（user问 -> assistant答）
                 for i, prev_msg in enumerate(previous_messages):
-                    # 添加user消息：请{专家}发言
-                    messages.append({
-                        "role": "user",
-                        "content": f"请{prev_msg['agent_name']}提供你的专业观点。"
-                    })
+                    # 添加user消息：请{专家}发言（摘要放在第一条之前）
+                    builder.history("user", (digest_prefix if i == 0 else "") + f"请{prev_msg['agent_name']}提供你的专业观点。")
                     # 添加assistant消息：专家的回复
-                    messages.append({
-                        "role": "assistant",
-                        "content": prev_msg['content']
-                    })
+                    builder.history("assistant", prev_msg['content'])
                 
-                # 最后添加一个user消息，请求当前专家发言
-                messages.append({
-                    "role": "user",
-                    "content": f"现在请{agent_name}基于以上讨论，提供你的专业见解。"
-                })
+                # 轮次信息属于易变内容，放在最后的user消息中，避免破坏系统提示前缀
+                builder.turn(
+                    (digest_prefix if not previous_messages else "")
+                    + f"当前是多智能体讨论的第 {round_num} 轮，共 {discussion_request.rounds} 轮。"
+                    + f"参与讨论的专家有: {', '.join(discussion_request.selected_agents)}。\n"
+                    + f"现在请{agent_name}基于讨论问题和其他专家的观点，提供你的专业见解。"
+                )
+                messages = builder.build()
                 
                 # 调用AI
                 try:
@@ -1375,11 +1542,11 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
                     if len(messages) > 1:
                         last_msg = messages[-1]
                         app_logger.debug(f"🔍 最后一条消息角色: {last_msg['role']}, 内容长度: {len(last_msg['content'])}")
-                        app_logger.debug(f"🔍 最后一条消息内容前100字: {last_msg['content'][:100]}")
+                        app_logger.debug(f"🔍 最后一条消息内容前100字: {last_msg['content'][:100]}", extra={"sample": True})
                     
-                    response_content = await poe_client.chat_completion(
-                        model=agent["model"],
-                        messages=messages
+                    response_content = await model_router.chat_completion(
+                        agent_models(agent),
+                        messages
                     )
                     
                     # 清理响应内容：去除首尾空白
@@ -1439,8 +1606,8 @@ async def start_discussion(request: Request, discussion_request: DiscussionReque
 请使用清晰的结构和markdown格式呈现。"""
             
             try:
-                summary_response = await poe_client.chat_completion(
-                    model=summary_agent["model"],
+                summary_response = await model_router.chat_completion(
+                    agent_models(summary_agent),
                     messages=[
                         {"role": "system", "content": "你是一位专业的会议记录者，擅长总结和提炼讨论要点。"},
                         {"role": "user", "content": summary_prompt}
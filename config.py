@@ -20,19 +20,120 @@ class Config:
     UPLOAD_DIR: str = os.getenv("UPLOAD_DIR", "uploads")
     MAX_FILE_SIZE: int = int(os.getenv("MAX_FILE_SIZE", str(10 * 1024 * 1024)))  # 10MB
     SESSIONS_FILE: str = os.getenv("SESSIONS_FILE", "chat_sessions.json")
+    SESSIONS_PAGE_SIZE: int = int(os.getenv("SESSIONS_PAGE_SIZE", "50"))  # 会话列表每页数量
+    SESSIONS_PAGE_SIZE_MAX: int = int(os.getenv("SESSIONS_PAGE_SIZE_MAX", "200"))
+    MESSAGES_PAGE_SIZE: int = int(os.getenv("MESSAGES_PAGE_SIZE", "100"))  # 会话消息每页数量
+    MESSAGES_PAGE_SIZE_MAX: int = int(os.getenv("MESSAGES_PAGE_SIZE_MAX", "500"))
+    MESSAGE_PREVIEW_CHARS: int = int(os.getenv("MESSAGE_PREVIEW_CHARS", "500"))  # 预览模式下消息截断长度
+    
+    # 会话持久化配置
+    DB_DURABILITY: str = os.getenv("DB_DURABILITY", "group").lower()  # sync / group / async
+    DB_GROUP_COMMIT_MS: int = int(os.getenv("DB_GROUP_COMMIT_MS", "50"))  # 组提交合并窗口
+    
+    # 会话归档配置
+    ARCHIVE_ENABLED: bool = os.getenv("ARCHIVE_ENABLED", "True").lower() == "true"
+    ARCHIVE_DIR: str = os.getenv("ARCHIVE_DIR", "archive")
+    ARCHIVE_AFTER_DAYS: int = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # 超过多少天未更新的会话移入归档
+    ARCHIVE_INTERVAL_HOURS: float = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "6"))
+    
+    # 数据导入导出配置
+    IMPORT_BATCH_SIZE: int = int(os.getenv("IMPORT_BATCH_SIZE", "100"))  # 导入时每批写入的会话数
+    IMPORT_MAX_LINE_BYTES: int = int(os.getenv("IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024)))  # 单条记录（一行）的最大字节数
+    IMPORT_MAX_BYTES: int = int(os.getenv("IMPORT_MAX_BYTES", str(1024 * 1024 * 1024)))  # 解压后的导入数据总量上限
+    
+    # 全文搜索配置
+    SEARCH_ENABLED: bool = os.getenv("SEARCH_ENABLED", "True").lower() == "true"
+    SEARCH_INDEX_FILE: str = os.getenv("SEARCH_INDEX_FILE", "search_index.db")
+    SEARCH_MAX_RESULTS: int = int(os.getenv("SEARCH_MAX_RESULTS", "100"))
     
     # 模型配置
     DEFAULT_MAX_TOKENS: int = int(os.getenv("DEFAULT_MAX_TOKENS", "4000"))
     DEFAULT_TEMPERATURE: float = float(os.getenv("DEFAULT_TEMPERATURE", "0.3"))
     
+    # 流式传输配置
+    STREAM_HEARTBEAT_SECONDS: float = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))  # 空闲时心跳间隔，防止代理断开空闲连接
+    STREAM_DISCONNECT_POLL_SECONDS: float = float(os.getenv("STREAM_DISCONNECT_POLL_SECONDS", "1.0"))  # 客户端断线检测间隔
+    STREAM_FLUSH_MAX_BYTES: int = int(os.getenv("STREAM_FLUSH_MAX_BYTES", "512"))  # 合并上游增量：单帧最大字节数
+    STREAM_FLUSH_MAX_MS: float = float(os.getenv("STREAM_FLUSH_MAX_MS", "40"))  # 合并上游增量：单帧最长等待毫秒数，0为不合并
+    STREAM_RESUME_GRACE_SECONDS: float = float(os.getenv("STREAM_RESUME_GRACE_SECONDS", "5"))  # 客户端全部断开后等待重连多久才取消生成（期间仍消耗上游token）
+    STREAM_REPLAY_TTL_SECONDS: int = int(os.getenv("STREAM_REPLAY_TTL_SECONDS", "300"))  # 生成完成后重放缓冲保留时长
+    STREAM_REPLAY_MAX_BYTES: int = int(os.getenv("STREAM_REPLAY_MAX_BYTES", str(32 * 1024 * 1024)))  # 所有重放缓冲合计内存上限
+    STREAM_CHECKPOINT_FILE: str = os.getenv("STREAM_CHECKPOINT_FILE", "stream_checkpoints.jsonl")  # 生成中回复的检查点日志
+    STREAM_CHECKPOINT_CHARS: int = int(os.getenv("STREAM_CHECKPOINT_CHARS", "800"))  # 累计多少新字符写一次检查点
+    STREAM_CHECKPOINT_SECONDS: float = float(os.getenv("STREAM_CHECKPOINT_SECONDS", "3"))  # 最长多少秒写一次检查点
+    
+    # 共享状态配置（多worker部署）
+    STATE_BACKEND: str = os.getenv("STATE_BACKEND", "memory")  # memory：单进程；sqlite：同一台机器的多个worker；redis：多台机器
+    STATE_SQLITE_PATH: str = os.getenv("STATE_SQLITE_PATH", "state.db")
+    STATE_REDIS_URL: str = os.getenv("STATE_REDIS_URL", "redis://localhost:6379/0")
+    STATE_KEY_PREFIX: str = os.getenv("STATE_KEY_PREFIX", "multi_agent_chat:")  # redis键前缀，多个应用共用一个实例时区分
+    STATE_SYNC_INTERVAL_MS: int = int(os.getenv("STATE_SYNC_INTERVAL_MS", "200"))  # 读取会话时检查其他worker写入的最短间隔
+    STATE_LOCK_TIMEOUT_SECONDS: float = float(os.getenv("STATE_LOCK_TIMEOUT_SECONDS", "30"))  # 跨进程会话锁的最长持有/等待时间
+    STATE_METRICS_SYNC_SECONDS: float = float(os.getenv("STATE_METRICS_SYNC_SECONDS", "5"))  # 本worker计数汇总到共享后端的间隔
+    
+    # 日志配置
+    LOG_LEVEL: str = os.getenv("LOG_LEVEL", "INFO")  # DEBUG=True 时固定为DEBUG
+    LOG_DIR: str = os.getenv("LOG_DIR", "logs")
+    LOG_FORMAT: str = os.getenv("LOG_FORMAT", "json")  # 文件日志格式：json（每行一条结构化记录）或 text
+    LOG_ROTATION: str = os.getenv("LOG_ROTATION", "auto")  # time：每天午夜轮转；size：超过 LOG_MAX_BYTES 时轮转；external：交给logrotate等外部工具；auto：单进程为time，多worker为external
+    LOG_MAX_BYTES: int = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+    LOG_BACKUP_COUNT: int = int(os.getenv("LOG_BACKUP_COUNT", "14"))  # 保留的历史日志文件数
+    LOG_PAYLOAD_SAMPLE_RATE: float = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))  # 请求/响应结构等大段调试日志的采样比例
+    
+    # 请求追踪配置
+    TRACING_ENABLED: bool = os.getenv("TRACING_ENABLED", "True").lower() == "true"
+    TRACE_SAMPLE_RATE: float = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # 记录完整trace的请求比例
+    TRACE_BUFFER_SIZE: int = int(os.getenv("TRACE_BUFFER_SIZE", "200"))  # 内存中保留的最近trace数
+    TRACE_MAX_SPANS: int = int(os.getenv("TRACE_MAX_SPANS", "256"))  # 单个trace最多记录的span数
+    TRACE_SLOW_MS: float = float(os.getenv("TRACE_SLOW_MS", "1000"))  # /api/debug/traces 默认只返回超过该耗时的trace
+    TRACE_EXPORT_FILE: str = os.getenv("TRACE_EXPORT_FILE", "")  # 为空时不导出；否则按OTLP JSON逐行追加
+    
+    # 调试接口配置
+    ADMIN_TOKEN: str = os.getenv("ADMIN_TOKEN", "")  # 调试接口（trace、采样分析）的访问令牌，为空时禁用这些接口
+    PROFILE_MAX_SECONDS: int = int(os.getenv("PROFILE_MAX_SECONDS", "30"))  # 单次采样分析最长时长
+    PROFILE_INTERVAL_MS: float = float(os.getenv("PROFILE_INTERVAL_MS", "5"))  # 栈采样间隔
+    
+    # 事件循环监控配置
+    LOOP_MONITOR_ENABLED: bool = os.getenv("LOOP_MONITOR_ENABLED", "True").lower() == "true"
+    LOOP_MONITOR_INTERVAL_MS: float = float(os.getenv("LOOP_MONITOR_INTERVAL_MS", "100"))  # 延迟测量间隔
+    LOOP_BLOCK_THRESHOLD_MS: float = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))  # 事件循环停顿超过该值时记录阻塞调用栈
+    
     # 重试配置
     MAX_RETRIES: int = int(os.getenv("MAX_RETRIES", "3"))
     RETRY_DELAY: float = float(os.getenv("RETRY_DELAY", "2.0"))
     
+    # 模型路由与熔断配置
+    ROUTER_HEDGE_ENABLED: bool = os.getenv("ROUTER_HEDGE_ENABLED", "False").lower() == "true"
+    ROUTER_HEDGE_DELAY_MS: int = int(os.getenv("ROUTER_HEDGE_DELAY_MS", "4000"))  # 多久没有首个token就发起对冲请求
+    BREAKER_WINDOW_SECONDS: int = int(os.getenv("BREAKER_WINDOW_SECONDS", "60"))
+    BREAKER_MIN_CALLS: int = int(os.getenv("BREAKER_MIN_CALLS", "5"))
+    BREAKER_ERROR_RATE: float = float(os.getenv("BREAKER_ERROR_RATE", "0.5"))
+    BREAKER_CONSECUTIVE_FAILURES: int = int(os.getenv("BREAKER_CONSECUTIVE_FAILURES", "3"))
+    BREAKER_COOLDOWN_SECONDS: int = int(os.getenv("BREAKER_COOLDOWN_SECONDS", "30"))
+    BREAKER_SLOW_CALL_SECONDS: float = float(os.getenv("BREAKER_SLOW_CALL_SECONDS", "30"))
+    
+    # 健康检查配置
+    HEALTH_PROBE_MODEL: str = os.getenv("HEALTH_PROBE_MODEL", "GPT-4o")
+    HEALTH_PROBE_INTERVAL: int = int(os.getenv("HEALTH_PROBE_INTERVAL", "300"))  # 主动探测最小间隔（秒）
+    HEALTH_PROBE_ON_STARTUP: bool = os.getenv("HEALTH_PROBE_ON_STARTUP", "False").lower() == "true"
+    
     # 限流配置
     RATE_LIMIT_REQUESTS: int = int(os.getenv("RATE_LIMIT_REQUESTS", "100"))
     RATE_LIMIT_WINDOW: int = int(os.getenv("RATE_LIMIT_WINDOW", "60"))  # 秒
     
+    # 上下文压缩配置
+    SUMMARY_MODEL: str = os.getenv("SUMMARY_MODEL", "")  # 为空时使用本地抽取式摘要
+    DISCUSSION_COMPRESSION: bool = os.getenv("DISCUSSION_COMPRESSION", "False").lower() == "true"
+    DISCUSSION_DIGEST_MAX_CHARS: int = int(os.getenv("DISCUSSION_DIGEST_MAX_CHARS", "1500"))
+    CHAT_HISTORY_WINDOW: int = int(os.getenv("CHAT_HISTORY_WINDOW", "20"))  # 发送给模型的最近消息数
+    SESSION_DIGEST_ENABLED: bool = os.getenv("SESSION_DIGEST_ENABLED", "True").lower() == "true"
+    SESSION_DIGEST_MAX_CHARS: int = int(os.getenv("SESSION_DIGEST_MAX_CHARS", "2000"))
+    SESSION_DIGEST_MIN_BATCH: int = int(os.getenv("SESSION_DIGEST_MIN_BATCH", "6"))  # 累计多少条新消息后刷新摘要
+    
+    # 提示词缓存配置
+    PROMPT_CACHE_BREAKPOINT_MODELS: str = os.getenv("PROMPT_CACHE_BREAKPOINT_MODELS", "")  # 支持cache_control的模型前缀，逗号分隔，如 Claude
+    PROMPT_CACHE_TTL: int = int(os.getenv("PROMPT_CACHE_TTL", "300"))  # 上游缓存有效期（秒），用于估算命中率
+    
     @classmethod
     def validate(cls) -> bool:
         """验证配置是否有效"""
@@ -55,6 +55,7 @@ class ChatRequest(BaseModel):
     agent_name: Optional[str] = None
     session_id: Optional[str] = None
     file_ids: Optional[List[str]] = None  # 附加的文件ID列表
+    continue_message_id: Optional[str] = None  # 继续生成该条未完成的回复
 
 class DiscussionRequest(BaseModel):
     question: str
@@ -63,6 +64,7 @@ class DiscussionRequest(BaseModel):
     selected_agents: List[str] = []
     session_id: Optional[str] = None
     file_ids: Optional[List[str]] = None  # 讨论附件文件ID列表
+    compress_history: Optional[bool] = None  # 是否压缩较早轮次，默认跟随配置
 
 class AgentConfig(BaseModel):
     """Agent配置"""
@@ -71,6 +73,7 @@ class AgentConfig(BaseModel):
     system_prompt: str
     color: str
     type: Optional[str] = None  # search, normal
+    fallback_models: Optional[List[str]] = []  # 备用模型，按顺序尝试
 
 class Memory(BaseModel):
     """长期记忆"""
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+启动性能基准脚本
+在全新的子进程中测量导入 app_optimized 和执行 lifespan 启动的耗时，
+并检查体积较大的依赖没有在导入时被加载、导入时没有启动后台线程（线程应在各worker的 lifespan 中启动，预fork时不会被继承）；超过阈值时以非零状态退出，可用于CI防止启动变慢
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+# 只应在首次使用时导入的模块
+DEFERRED_MODULES = ["openai", "pdfplumber", "docx", "PIL"]
+
+# 子进程：测量导入和 lifespan 启动，最后一行输出JSON结果
+CHILD_CODE = """
+import sys, time, json, asyncio
+start = time.perf_counter()
+import app_optimized
+import_ms = (time.perf_counter() - start) * 1000
+sys.stderr.write("BENCH-IMPORTED\\n")
+loaded = [name for name in {deferred!r} if name in sys.modules]
+import threading
+threads = [thread.name for thread in threading.enumerate() if thread is not threading.main_thread()]
+
+async def boot():
+    start = time.perf_counter()
+    async with app_optimized.app.router.lifespan_context(app_optimized.app):
+        boot_ms = (time.perf_counter() - start) * 1000
+    return boot_ms
+
+boot_ms = asyncio.run(boot())
+print("BENCH " + json.dumps({{"import_ms": import_ms, "boot_ms": boot_ms, "loaded": loaded, "threads": threads}}))
+"""
+
+def run_once(project_root: Path, workdir: Path) -> dict:
+    """在隔离的工作目录中启动一个子进程测量一次"""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = str(project_root) + os.pathsep + env.get("PYTHONPATH", "")
+    env.setdefault("POE_API_KEY", "bench-placeholder")
+    env["HEALTH_PROBE_ON_STARTUP"] = "false"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD_CODE.format(deferred=DEFERRED_MODULES)],
+        cwd=workdir,
+        env=env,
+        capture_output=True,
+        text=True
+    )
+    lines = [line for line in result.stdout.splitlines() if line.startswith("BENCH ")]
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(f"子进程启动失败:\n{result.stderr[-2000:]}")
+    
+    measurement = json.loads(lines[-1][len("BENCH "):])
+    measurement["imports"] = parse_importtime(result.stderr)
+    return measurement
+
+def parse_importtime(stderr: str) -> list:
+    """解析 -X importtime 输出，返回 (自身耗时us, 模块名) 列表（只统计导入应用阶段，不含启动后在后台导入的模块）"""
+    imports = []
+    for line in stderr.splitlines():
+        if line == "BENCH-IMPORTED":
+            break
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        try:
+            self_us, _, name = line[len("import time:"):].split("|")
+            imports.append((int(self_us), name.strip()))
+        except ValueError:
+            continue
+    return imports
+
+def main():
+    parser = argparse.ArgumentParser(description="测量应用导入和启动耗时")
+    parser.add_argument("--runs", type=int, default=5, help="重复次数（取中位数）")
+    parser.add_argument("--max-import-ms", type=float, default=1000, help="导入耗时上限（毫秒）")
+    parser.add_argument("--max-boot-ms", type=float, default=1000, help="lifespan 启动耗时上限（毫秒）")
+    parser.add_argument("--top", type=int, default=10, help="显示自身耗时最多的模块数")
+    args = parser.parse_args()
+    
+    project_root = Path(__file__).parent.parent.resolve()
+    
+    print(f"⏱️ 启动基准测试（{args.runs} 次）...")
+    with tempfile.TemporaryDirectory() as tmp:
+        # 独立的工作目录，不读写项目中的会话、记忆和检查点文件
+        workdir = Path(tmp)
+        (workdir / "static").symlink_to(project_root / "static")
+        (workdir / "uploads").mkdir()
+        runs = [run_once(project_root, workdir) for _ in range(args.runs)]
+    
+    import_ms = statistics.median(run["import_ms"] for run in runs)
+    boot_ms = statistics.median(run["boot_ms"] for run in runs)
+    loaded = sorted({name for run in runs for name in run["loaded"]})
+    threads = sorted({name for run in runs for name in run["threads"]})
+    
+    print(f"   导入耗时: {import_ms:.0f}ms（上限 {args.max_import_ms:.0f}ms）")
+    print(f"   启动耗时: {boot_ms:.0f}ms（上限 {args.max_boot_ms:.0f}ms）")
+    
+    slowest = sorted(runs[-1]["imports"], reverse=True)[:args.top]
+    print(f"   自身耗时最多的 {len(slowest)} 个模块:")
+    for self_us, name in slowest:
+        print(f"      {self_us / 1000:8.1f}ms  {name}")
+    
+    failures = []
+    if import_ms > args.max_import_ms:
+        failures.append(f"导入耗时 {import_ms:.0f}ms 超过上限 {args.max_import_ms:.0f}ms")
+    if boot_ms > args.max_boot_ms:
+        failures.append(f"启动耗时 {boot_ms:.0f}ms 超过上限 {args.max_boot_ms:.0f}ms")
+    if loaded:
+        failures.append(f"以下模块应在首次使用时导入，却在导入应用时被加载: {', '.join(loaded)}")
+    if threads:
+        failures.append(f"导入应用时启动了后台线程: {', '.join(threads)}")
+    
+    if failures:
+        for failure in failures:
+            print(f"❌ {failure}")
+        sys.exit(1)
+    print("✅ 启动性能符合要求")
+
+if __name__ == "__main__":
+    main()
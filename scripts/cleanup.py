@@ -4,10 +4,14 @@
 清理临时文件、缓存文件和不需要的文件
 """
 import os
+import time
 import shutil
 import glob
 from pathlib import Path
 
+# 运行中的服务正在写入的临时文件（原子写入的中间文件）不能删除，只清理超过该时长的
+TEMP_FILE_MIN_AGE_SECONDS = 3600
+
 def cleanup_project():
     """清理项目"""
     project_root = Path(__file__).parent.parent
@@ -40,8 +44,9 @@ def cleanup_project():
         from datetime import datetime, timedelta
         cutoff_date = datetime.now() - timedelta(days=7)
         
-        for log_file in logs_dir.glob("*.log"):
-            if log_file.stat().st_mtime < cutoff_date.timestamp():
+        # 包括轮转后的历史文件：app.log.2026-01-01（按时间）、app.log.1（按大小）
+        for log_file in logs_dir.glob("*.log*"):
+            if log_file.is_file() and log_file.stat().st_mtime < cutoff_date.timestamp():
                 log_file.unlink()
                 print(f"   删除旧日志: {log_file.name}")
     
@@ -55,8 +60,11 @@ def cleanup_project():
         "**/*~",
     ]
     
+    temp_cutoff = time.time() - TEMP_FILE_MIN_AGE_SECONDS
     for pattern in temp_patterns:
         for path in project_root.glob(pattern):
+            if pattern == "**/*.tmp" and path.stat().st_mtime > temp_cutoff:
+                continue
             if path.name not in ["test_image_processing.py", "test_discussion_fix.py"]:  # 保护重要测试文件
                 path.unlink()
                 print(f"   删除临时文件: {path.relative_to(project_root)}")
@@ -4,6 +4,11 @@ class MultiAgentChat {
         this.selectedAgent = null;
         this.agents = {};
         this.sessions = [];
+        this.sessionsNextCursor = null; // 会话列表下一页游标
+        this.loadingMoreSessions = false;
+        this.messagesPageSize = 100; // 每次加载的消息数量
+        this.messagesStart = 0; // 当前已加载消息的起始位置
+        this.loadingOlderMessages = false;
         this.mentionDropdownVisible = false;
         this.selectedMentionIndex = -1;
         this.lastUserMessage = null;
@@ -69,9 +74,29 @@ class MultiAgentChat {
             const response = await fetch('/api/sessions');
             const data = await response.json();
             this.sessions = data.sessions;
+            this.sessionsNextCursor = data.next_cursor || null;
         } catch (error) {
             console.error('❌ 加载会话失败:', error);
             this.sessions = [];
+            this.sessionsNextCursor = null;
+        }
+    }
+
+    async loadMoreSessions() {
+        // 滚动到底部时加载下一页会话
+        if (!this.sessionsNextCursor || this.loadingMoreSessions) return;
+        this.loadingMoreSessions = true;
+        try {
+            const response = await fetch(`/api/sessions?cursor=${encodeURIComponent(this.sessionsNextCursor)}`);
+            const data = await response.json();
+            const knownIds = new Set(this.sessions.map(s => s.id));
+            this.sessions = this.sessions.concat(data.sessions.filter(s => !knownIds.has(s.id)));
+            this.sessionsNextCursor = data.next_cursor || null;
+            this.renderSessions();
+        } catch (error) {
+            console.error('❌ 加载更多会话失败:', error);
+        } finally {
+            this.loadingMoreSessions = false;
         }
     }
 
@@ -106,6 +131,22 @@ class MultiAgentChat {
             }
         });
 
+        // 会话列表滚动到底部时加载更多
+        const sessionsList = document.getElementById('sessions-list');
+        sessionsList.addEventListener('scroll', () => {
+            if (sessionsList.scrollTop + sessionsList.clientHeight >= sessionsList.scrollHeight - 50) {
+                this.loadMoreSessions();
+            }
+        });
+
+        // 消息区域滚动到顶部时加载更早的消息
+        const messagesContainer = document.getElementById('messages-container');
+        messagesContainer.addEventListener('scroll', () => {
+            if (messagesContainer.scrollTop < 50) {
+                this.loadOlderMessages();
+            }
+        });
+
         // 自动调整输入框高度和处理@提及
         input.addEventListener('input', (e) => {
             this.autoResizeTextarea();
@@ -692,8 +733,9 @@ class MultiAgentChat {
             this.currentSessionId = realSessionId;
             this.renderSessions(); // 更新选中状态
 
-            const response = await fetch(`/api/sessions/${realSessionId}`);
-            const data = await response.json();
+            // 只加载最近一页消息，更早的消息在滚动到顶部时按需加载
+            let response = await fetch(`/api/sessions/${realSessionId}?limit=${this.messagesPageSize}`);
+            let data = await response.json();
             
             // 检查是否为讨论会话（使用新的标记字段）
             const isDiscussionSession = data.session.title.includes('讨论:') || 
@@ -702,9 +744,16 @@ class MultiAgentChat {
             console.log(`加载会话: ${data.session.title}, 是否讨论会话: ${isDiscussionSession}`);
             
             if (isDiscussionSession) {
+                // 讨论会话需要完整消息来汇总进度和总结
+                if (data.page && data.page.has_more_before) {
+                    response = await fetch(`/api/sessions/${realSessionId}`);
+                    data = await response.json();
+                }
+                this.messagesStart = 0;
                 this.renderDiscussionSession(data.session.messages);
             } else {
-            this.renderMessages(data.session.messages);
+                this.messagesStart = data.page ? data.page.start : 0;
+                this.renderMessages(data.session.messages);
             }
             
             // 隐藏欢迎消息
@@ -717,6 +766,33 @@ class MultiAgentChat {
         }
     }
 
+    async loadOlderMessages() {
+        // 向上滚动时加载更早的一页消息，保持当前阅读位置
+        if (!this.currentSessionId || this.messagesStart <= 0 || this.loadingOlderMessages) return;
+        this.loadingOlderMessages = true;
+        const sessionId = this.currentSessionId;
+        try {
+            const response = await fetch(`/api/sessions/${sessionId}?before=${this.messagesStart}&limit=${this.messagesPageSize}`);
+            const data = await response.json();
+            if (sessionId !== this.currentSessionId) return;
+            
+            const container = document.getElementById('messages-container');
+            const existingNodes = Array.from(container.childNodes);
+            const previousHeight = container.scrollHeight;
+            const previousTop = container.scrollTop;
+            
+            this.renderMessages(data.session.messages);
+            existingNodes.forEach(node => container.appendChild(node));
+            container.scrollTop = container.scrollHeight - previousHeight + previousTop;
+            
+            this.messagesStart = data.page.start;
+        } catch (error) {
+            console.error('加载更早消息失败:', error);
+        } finally {
+            this.loadingOlderMessages = false;
+        }
+    }
+
     renderMessages(messages) {
         const container = document.getElementById('messages-container');
         container.innerHTML = '';
@@ -1126,6 +1202,20 @@ class MultiAgentChat {
             contentDiv.appendChild(attachmentsDiv);
         }
 
+        // 生成中断的回复：提供继续生成入口
+        if (message.status === 'incomplete') {
+            const incompleteDiv = document.createElement('div');
+            incompleteDiv.className = 'message-incomplete';
+            incompleteDiv.innerHTML = '<span>⚠️ 回复生成中断</span>';
+            
+            const continueBtn = document.createElement('button');
+            continueBtn.textContent = '继续生成';
+            continueBtn.addEventListener('click', () => this.continueMessage(message, incompleteDiv));
+            incompleteDiv.appendChild(continueBtn);
+            
+            contentDiv.appendChild(incompleteDiv);
+        }
+
         // 组装消息
         messageDiv.appendChild(avatarDiv);
         messageDiv.appendChild(contentDiv);
@@ -1508,12 +1598,32 @@ class MultiAgentChat {
         }
     }
 
+    // 继续生成中断的回复，完成后重新加载会话以显示合并后的完整回复
+    async continueMessage(message, incompleteDiv) {
+        incompleteDiv.remove();
+        this.showTypingIndicator(message.agent_name);
+        try {
+            await this.sendMessageStream({
+                message: '',
+                agent_name: message.agent_name,
+                session_id: this.currentSessionId,
+                continue_message_id: message.id
+            }, message.agent_name);
+            await this.loadSession(this.currentSessionId);
+        } catch (error) {
+            console.error('继续生成失败:', error);
+            this.hideTypingIndicator();
+            this.showError('继续生成失败，请重试');
+        }
+    }
+
     async sendMessageStream(sendData, agentName) {
         try {
             const response = await fetch('/api/chat/stream', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream'
                 },
                 body: JSON.stringify(sendData)
             });
@@ -1543,15 +1653,40 @@ class MultiAgentChat {
             const messageTextDiv = messageElement.querySelector('.message-text');
 
             // 读取流
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
+            let reader = response.body.getReader();
+            let decoder = new TextDecoder();
             let buffer = '';
             let accumulatedContent = '';
+            let finished = false; // 已收到done事件并完成渲染
+            let serverMessageId = null; // 服务端消息ID，用于断线续传
+            let lastEventId = 0;
+            let resumeAttempts = 0;
 
             while (true) {
-                const { done, value } = await reader.read();
+                let done, value;
+                try {
+                    ({ done, value } = await reader.read());
+                } catch (readError) {
+                    // 连接中断：凭消息ID和最后事件ID重新接入，服务端会补发错过的内容
+                    if (!serverMessageId || resumeAttempts >= 3) throw readError;
+                    resumeAttempts++;
+                    await new Promise(resolve => setTimeout(resolve, 1000 * resumeAttempts));
+                    const resumed = await fetch(`/api/chat/stream/${serverMessageId}`, {
+                        headers: {
+                            'Accept': 'text/event-stream',
+                            'Last-Event-ID': String(lastEventId)
+                        }
+                    });
+                    if (!resumed.ok) throw readError;
+                    reader = resumed.body.getReader();
+                    decoder = new TextDecoder();
+                    buffer = '';
+                    continue;
+                }
                 
                 if (done) {
+                    if (finished) break;
+                    
                     // 流结束，完成最终渲染
                     if (accumulatedContent && window.renderEnhancedMarkdown) {
                         window.renderEnhancedMarkdown(accumulatedContent, messageTextDiv);
@@ -1573,6 +1708,15 @@ class MultiAgentChat {
                 for (const line of lines) {
                     if (!line.trim()) continue;
                     
+                    // 记录事件ID，断线续传时作为 Last-Event-ID
+                    if (line.startsWith('id:')) {
+                        lastEventId = parseInt(line.slice(3).trim(), 10) || lastEventId;
+                        continue;
+                    }
+                    
+                    // SSE的注释（心跳）和事件类型行无需解析
+                    if (line.startsWith(':') || line.startsWith('event:') || line.startsWith('retry:')) continue;
+                    
                     try {
                         // 兼容两种格式：SSE (data: {...}) 和 NDJSON ({...})
                         let jsonStr = line;
@@ -1581,11 +1725,13 @@ class MultiAgentChat {
                         }
                         
                         const data = JSON.parse(jsonStr);
+                        if (data.seq) lastEventId = data.seq;
                         
                         // 兼容两种元数据类型
                         if (data.type === 'metadata' || data.type === 'meta') {
                             // 更新会话ID和Agent名称
                             this.currentSessionId = data.session_id;
+                            serverMessageId = data.message_id || serverMessageId;
                             const agentName = data.agent_name || data.agent;
                             streamMessage.agent_name = agentName;
                             
@@ -1631,6 +1777,7 @@ class MultiAgentChat {
                             // 刷新会话列表
                             await this.loadSessions();
                             this.renderSessions();
+                            finished = true;
                         } else if (data.type === 'error') {
                             console.error('流式输出错误:', data.error);
                             messageTextDiv.innerHTML = `<div class="error-message">❌ 生成失败: ${data.error}</div>`;
@@ -1683,6 +1830,7 @@ class MultiAgentChat {
 
     createNewChat() {
         this.currentSessionId = null;
+        this.messagesStart = 0;
         this.selectedAgent = null;
         
         // 清除Agent选中状态
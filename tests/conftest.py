@@ -0,0 +1,13 @@
+"""
+测试公共配置
+测试直接导入项目模块，不依赖 pytest 异步插件：协程在各测试内用 asyncio.run 执行
+"""
+import os
+import sys
+from pathlib import Path
+
+# 导入 config 前设置必需的环境变量，测试不会真正请求上游
+os.environ.setdefault("POE_API_KEY", "test-key")
+os.environ.setdefault("STATE_BACKEND", "memory")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,81 @@
+"""
+上游调用测试：熔断器半开探测名额、健康状态和对冲请求的清理
+"""
+import asyncio
+
+import pytest
+
+from config import config
+from utils.api_client import CircuitBreaker, CircuitBreakerRegistry, ModelRouter
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(config.BREAKER_CONSECUTIVE_FAILURES):
+        breaker.record_failure(RuntimeError("boom"))
+    assert breaker.state == "open"
+
+def expire_cooldown(breaker: CircuitBreaker):
+    breaker._opened_at -= config.BREAKER_COOLDOWN_SECONDS + 1
+
+def test_half_open_allows_one_trial_and_releases_it_when_abandoned():
+    breaker = CircuitBreaker("m")
+    open_breaker(breaker)
+    assert not breaker.is_available()
+    
+    expire_cooldown(breaker)
+    # 查看状态不占用探测名额
+    assert breaker.is_available()
+    assert breaker.is_available()
+    
+    trial = breaker.claim_trial()
+    assert trial is not None
+    assert breaker.claim_trial() is None
+    assert not breaker.is_available()
+    
+    # 请求被取消、没有记录结果时归还名额
+    breaker.release_trial(trial)
+    assert breaker.is_available()
+
+def test_health_reports_expired_cooldown_as_half_open():
+    registry = CircuitBreakerRegistry()
+    open_breaker(registry.get("a"))
+    assert registry.health()["status"] == "unhealthy"
+    
+    expire_cooldown(registry.get("a"))
+    health = registry.health()
+    assert health["models"] == {"a": "half_open"}
+    assert health["status"] == "healthy"
+
+def test_health_counts_configured_but_unused_models_as_available():
+    registry = CircuitBreakerRegistry()
+    assert registry.health(["a", "b"])["status"] == "unknown"
+    
+    open_breaker(registry.get("a"))
+    health = registry.health(["a", "b"])
+    assert health["status"] == "degraded"
+    assert health["models"] == {"a": "open", "b": "closed"}
+
+class FakeClient:
+    """按模型名决定延迟的假客户端，记录已结束的请求"""
+    
+    def __init__(self, delays):
+        self.delays = delays
+        self.finished = []
+    
+    async def _complete_once(self, model, messages, **kwargs):
+        try:
+            await asyncio.sleep(self.delays[model])
+            return model
+        finally:
+            self.finished.append(model)
+    
+    chat_completion = _complete_once
+
+def test_hedged_loser_is_finished_before_returning(monkeypatch):
+    monkeypatch.setattr(config, "ROUTER_HEDGE_DELAY_MS", 10)
+    client = FakeClient({"slow-primary": 10, "fast-backup": 0.05})
+    router = ModelRouter(client)
+    
+    result = asyncio.run(router.chat_completion(["slow-primary", "fast-backup"], [], hedge=True))
+    
+    assert result == "fast-backup"
+    assert sorted(client.finished) == ["fast-backup", "slow-primary"]
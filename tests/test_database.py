@@ -0,0 +1,218 @@
+"""
+会话存储测试：写时复制快照、会话锁内读-改-写、组提交、跨进程文件锁、归档与恢复
+"""
+import json
+import asyncio
+import multiprocessing
+from datetime import datetime, timedelta
+
+import pytest
+
+from utils.archive import SessionArchive
+from utils.database import DatabaseManager
+
+def new_session(session_id: str, **fields):
+    return {"id": session_id, "messages": [], "updated_at": datetime.now().isoformat(), **fields}
+
+def appender(message_id: str):
+    return lambda session: session["messages"].append({"id": message_id, "role": "user", "content": message_id})
+
+def read_file(path) -> dict:
+    return {session["id"]: session for session in json.loads(path.read_text(encoding="utf-8"))}
+
+def test_published_snapshot_is_never_mutated(tmp_path):
+    async def run():
+        db = DatabaseManager(str(tmp_path / "s.json"))
+        await db.modify_session("s", appender("m1"), default=lambda: new_session("s"))
+        before = await db.snapshot()
+        session = before.by_id["s"]
+        
+        await db.modify_session("s", appender("m2"))
+        after = await db.snapshot()
+        
+        assert after is not before
+        assert [m["id"] for m in session["messages"]] == ["m1"]
+        assert [m["id"] for m in after.by_id["s"]["messages"]] == ["m1", "m2"]
+        # 未修改的会话视图为零拷贝
+        assert await db.get_session_view("s") is after.by_id["s"]
+    
+    asyncio.run(run())
+
+@pytest.mark.parametrize("durability", DatabaseManager.DURABILITY_MODES)
+def test_concurrent_modifications_of_one_session_are_not_lost(tmp_path, durability):
+    path = tmp_path / "s.json"
+    
+    async def run():
+        db = DatabaseManager(str(path), durability=durability, group_commit_ms=5)
+        await asyncio.gather(*(
+            db.modify_session("s", appender(f"m{i}"), default=lambda: new_session("s"))
+            for i in range(50)
+        ))
+        await db.flush()
+        return await db.get_session_view("s")
+    
+    session = asyncio.run(run())
+    assert len(session["messages"]) == 50
+    assert session["version"] == 50
+    assert len(read_file(path)["s"]["messages"]) == 50
+
+def test_update_session_merges_a_stale_copy(tmp_path):
+    async def run():
+        db = DatabaseManager(str(tmp_path / "s.json"))
+        await db.modify_session("s", appender("m1"), default=lambda: new_session("s"))
+        stale = await db.get_session_by_id("s")
+        
+        await db.modify_session("s", appender("other"))
+        stale["messages"].append({"id": "mine", "role": "user", "content": "mine"})
+        await db.update_session(stale)
+        
+        assert stale["version"] == 3
+        return await db.get_session_view("s")
+    
+    session = asyncio.run(run())
+    assert [m["id"] for m in session["messages"]] == ["m1", "other", "mine"]
+
+def test_group_commit_batches_writes_and_persists_before_returning(tmp_path):
+    path = tmp_path / "s.json"
+    
+    async def run():
+        db = DatabaseManager(str(path), durability="group", group_commit_ms=20)
+        writes = []
+        write_data = db._write_data
+        db._write_data = lambda sessions: writes.append(len(sessions)) or write_data(sessions)
+        
+        await asyncio.gather(*(
+            db.modify_session(f"s{i}", appender("m"), default=lambda i=i: new_session(f"s{i}"))
+            for i in range(20)
+        ))
+        # 返回时已经落盘
+        assert len(read_file(path)) == 20
+        return writes
+    
+    writes = asyncio.run(run())
+    assert 1 <= len(writes) < 20
+
+def test_async_durability_returns_before_writing_and_flush_persists(tmp_path):
+    path = tmp_path / "s.json"
+    
+    async def run():
+        db = DatabaseManager(str(path), durability="async", group_commit_ms=50)
+        await db.modify_session("s", appender("m1"), default=lambda: new_session("s"))
+        assert not path.exists()
+        await db.flush()
+    
+    asyncio.run(run())
+    assert [m["id"] for m in read_file(path)["s"]["messages"]] == ["m1"]
+
+# ==================== 多进程 ====================
+
+def _append_from_process(path: str, durability: str, worker: int, count: int):
+    async def run():
+        db = DatabaseManager(path, durability=durability, group_commit_ms=5)
+        for i in range(count):
+            await db.modify_session("shared", appender(f"{worker}-{i}"), default=lambda: new_session("shared"))
+            await db.modify_session(f"own{worker}", appender(f"{worker}-{i}"), default=lambda: new_session(f"own{worker}"))
+        await db.flush()
+    asyncio.run(run())
+
+def _start_processes(target, args_list):
+    # 从主线程 fork：在工作线程中 fork 的子进程退出时状态异常
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=target, args=args) for args in args_list]
+    for process in processes:
+        process.start()
+    return processes
+
+def _join_processes(processes):
+    for process in processes:
+        process.join(60)
+        assert process.exitcode == 0
+
+def _run_processes(target, args_list):
+    _join_processes(_start_processes(target, args_list))
+
+@pytest.mark.parametrize("durability", DatabaseManager.DURABILITY_MODES)
+def test_same_session_across_processes_keeps_every_write(tmp_path, durability):
+    path = tmp_path / "s.json"
+    _run_processes(_append_from_process, [(str(path), durability, worker, 10) for worker in range(3)])
+    
+    data = read_file(path)
+    message_ids = [m["id"] for m in data["shared"]["messages"]]
+    assert len(message_ids) == 30
+    assert len(set(message_ids)) == 30
+    assert all(len(data[f"own{worker}"]["messages"]) == 10 for worker in range(3))
+
+def test_session_index_sees_sessions_written_by_other_processes(tmp_path):
+    path = tmp_path / "s.json"
+    
+    async def run():
+        db = DatabaseManager(str(path))
+        await db.modify_session("local", appender("m"), default=lambda: new_session("local"))
+        first, _ = await db.list_session_summaries()
+        processes = _start_processes(_append_from_process, [(str(path), "sync", 7, 1)])
+        await asyncio.to_thread(_join_processes, processes)
+        second, _ = await db.list_session_summaries()
+        return {s["id"] for s in first}, {s["id"] for s in second}
+    
+    first, second = asyncio.run(run())
+    assert first == {"local"}
+    assert second == {"local", "shared", "own7"}
+
+# ==================== 归档 ====================
+
+def _archived_db(tmp_path) -> DatabaseManager:
+    return DatabaseManager(str(tmp_path / "s.json"), archive=SessionArchive(str(tmp_path / "archive")))
+
+def test_rehydrate_does_not_overwrite_a_concurrent_write(tmp_path):
+    old = (datetime.now() - timedelta(days=90)).isoformat()
+    
+    async def run():
+        db = _archived_db(tmp_path)
+        await db.modify_session("s", appender("m1"), default=lambda: new_session("s", updated_at=old))
+        assert await db.archive_inactive_sessions(days=30) == 1
+        assert db.archive.contains("s")
+        
+        # 恢复与写入并发：写入不能被归档中的旧副本覆盖
+        await asyncio.gather(
+            db.get_session_view("s"),
+            db.modify_session("s", appender("m2")),
+            db.get_session_view("s")
+        )
+        return db, await db.get_session_view("s")
+    
+    db, session = asyncio.run(run())
+    assert [m["id"] for m in session["messages"]] == ["m1", "m2"]
+    assert not db.archive.contains("s")
+
+def test_rehydrated_session_is_not_archived_again_immediately(tmp_path):
+    old = (datetime.now() - timedelta(days=90)).isoformat()
+    
+    async def run():
+        db = _archived_db(tmp_path)
+        await db.modify_session("s", appender("m1"), default=lambda: new_session("s", updated_at=old))
+        await db.archive_inactive_sessions(days=30)
+        session = await db.get_session_view("s")
+        assert session["updated_at"] == old
+        return await db.archive_inactive_sessions(days=30)
+    
+    assert asyncio.run(run()) == 0
+
+def test_archived_reader_skips_sessions_in_the_snapshot(tmp_path):
+    old = (datetime.now() - timedelta(days=90)).isoformat()
+    
+    async def run():
+        db = _archived_db(tmp_path)
+        for session_id in ("a", "b"):
+            await db.modify_session(session_id, appender("m"), default=lambda s=session_id: new_session(s, updated_at=old))
+        await db.archive_inactive_sessions(days=30)
+        await db.get_session_view("a")
+        
+        # 模拟归档写入后、从热存储移除前的中间状态
+        await db.archive.archive([db._snapshot.by_id["a"]])
+        snapshot = await db.snapshot()
+        reader = db.archived_reader(exclude=snapshot.by_id)
+        return set(snapshot.by_id), [session["id"] async for session in reader()]
+    
+    hot, archived = asyncio.run(run())
+    assert hot == {"a"}
+    assert archived == ["b"]
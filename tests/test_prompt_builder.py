@@ -0,0 +1,50 @@
+"""
+分层提示词测试：消息角色交替、缓存断点和前缀命中统计
+"""
+import pytest
+
+from config import config
+from utils.prompt_builder import PrefixCacheTracker, PromptBuilder, strip_cache_breakpoints
+import utils.prompt_builder as prompt_builder
+
+FILES = [{"type": "text", "text": "讨论问题: 如何设计缓存?"}, {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}]
+
+@pytest.fixture
+def tracker(monkeypatch):
+    tracker = PrefixCacheTracker()
+    monkeypatch.setattr(prompt_builder, "prompt_cache_tracker", tracker)
+    return tracker
+
+def discussion_prompt(model: str, history=()):
+    builder = PromptBuilder(model).system("系统提示").memory("记忆").files(FILES)
+    for role, content in history:
+        builder.history(role, content)
+    return builder.turn("现在请你发言").build()
+
+@pytest.mark.parametrize("history", [(), (("user", "请产品经理发言"), ("assistant", "产品经理的观点"))])
+def test_files_layer_never_produces_consecutive_user_messages(tracker, history):
+    roles = [message["role"] for message in discussion_prompt("GPT-5", history)]
+    assert all(not (a == b == "user") for a, b in zip(roles, roles[1:]))
+    assert roles[0] == "system" and roles[1] == "user"
+
+def test_merged_files_message_keeps_its_cache_breakpoint(tracker, monkeypatch):
+    monkeypatch.setattr(config, "PROMPT_CACHE_BREAKPOINT_MODELS", "Claude")
+    history = (("user", "请产品经理发言"), ("assistant", "产品经理的观点"))
+    files_message = discussion_prompt("Claude-Sonnet-4.5", history)[1]
+    
+    parts = files_message["content"]
+    assert parts[len(FILES) - 1]["cache_control"] == {"type": "ephemeral"}
+    assert parts[len(FILES)]["text"].endswith("请产品经理发言")
+    
+    stripped = strip_cache_breakpoints([files_message])[0]
+    assert all("cache_control" not in part for part in stripped["content"])
+
+def test_repeated_prefix_is_counted_as_cache_hit(tracker):
+    history = [("user", "请产品经理发言"), ("assistant", "产品经理的观点")]
+    discussion_prompt("GPT-5", history)
+    discussion_prompt("GPT-5", history + [("user", "请技术总监发言"), ("assistant", "技术总监的观点")])
+    
+    stats = tracker.get_stats()["GPT-5"]
+    assert stats["builds"] == 2
+    assert stats["hit_builds"] == 1
+    assert stats["layer_hits"] == {"history": 1}
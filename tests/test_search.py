@@ -0,0 +1,78 @@
+"""
+全文搜索测试：短词走bigram索引、日期边界和片段转义
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from utils.search import SearchIndex
+
+SESSION = {
+    "id": "s1",
+    "title": "缓存方案",
+    "version": 1,
+    "messages": [
+        {"id": "m1", "role": "user", "content": "我们讨论<script>alert(1)</script>缓存设计", "timestamp": "2026-10-19T15:30:00"},
+        {"id": "m2", "role": "assistant", "content": "AI 可以用 LRU 淘汰", "timestamp": "2026-10-18T09:00:00", "agent_name": "技术总监"}
+    ]
+}
+
+@pytest.fixture
+def index(tmp_path):
+    search_index = SearchIndex(str(tmp_path / "search.db"))
+    search_index._apply({"s1": SESSION})
+    yield search_index
+    search_index.close()
+
+def search(index, query, **filters):
+    return asyncio.run(index.search(query, **filters))["results"]
+
+def message_ids(results):
+    return [result["message_id"] for result in results if result["type"] == "message"]
+
+@pytest.mark.parametrize("query, expected", [
+    ("缓存", ["m1"]),
+    ("计", ["m1"]),
+    ("ai", ["m2"]),
+    ("讨论 设计", ["m1"]),
+    ("LRU 淘汰", ["m2"])
+])
+def test_short_terms_are_matched(index, query, expected):
+    assert message_ids(search(index, query)) == expected
+
+def test_short_terms_use_the_bigram_index(index):
+    plan = " ".join(
+        row[-1] for row in index._connect().execute(
+            "EXPLAIN QUERY PLAN SELECT rowid FROM search_bigrams WHERE search_bigrams MATCH ?", ('"缓存"',)
+        )
+    )
+    assert "VIRTUAL TABLE INDEX" in plan
+    assert search(index, "缓存")[0]["snippet"].count("<mark>缓存</mark>") == 1
+
+def test_date_only_end_bound_includes_the_whole_day(index):
+    assert message_ids(search(index, "缓存", end_date="2026-10-19")) == ["m1"]
+    assert message_ids(search(index, "缓存", end_date="2026-10-18")) == []
+    assert message_ids(search(index, "缓存", end_date="2026-10-19T12:00:00")) == []
+
+@pytest.mark.parametrize("query", ["缓存", "讨论<script>", "alert"])
+def test_snippets_escape_user_text(index, query):
+    snippet = search(index, query)[0]["snippet"]
+    assert "<script>" not in snippet
+    assert "&lt;script&gt;" in snippet or "alert" in snippet
+    assert snippet.replace("<mark>", "").replace("</mark>", "").count("<") == 0
+
+def test_existing_index_is_backfilled_with_bigrams(tmp_path):
+    path = str(tmp_path / "search.db")
+    old = SearchIndex(path)
+    old._apply({"s1": SESSION})
+    old.close()
+    conn = sqlite3.connect(path)
+    conn.execute("DELETE FROM search_bigrams")
+    conn.execute("PRAGMA user_version = 0")
+    conn.commit()
+    conn.close()
+    
+    upgraded = SearchIndex(path)
+    assert message_ids(search(upgraded, "缓存")) == ["m1"]
+    upgraded.close()
@@ -0,0 +1,104 @@
+"""
+流式传输测试：增量合并、重放缓冲续传和被放弃生成的取消
+"""
+import asyncio
+
+import pytest
+
+from config import config
+from utils.streaming import ReplayBuffer, ReplayGapError, StreamRegistry, coalesce_chunks
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+def test_coalesce_merges_small_chunks():
+    async def upstream():
+        for chunk in ["a", "b", "c"]:
+            yield chunk
+    
+    assert asyncio.run(collect(coalesce_chunks(upstream(), max_bytes=1000, max_ms=1000))) == ["abc"]
+
+def test_coalesce_flushes_buffered_text_before_upstream_error():
+    received = []
+    
+    async def upstream():
+        yield "部分"
+        yield "回复"
+        raise RuntimeError("upstream failed")
+    
+    async def run():
+        async for chunk in coalesce_chunks(upstream(), max_bytes=1000, max_ms=1000):
+            received.append(chunk)
+    
+    with pytest.raises(RuntimeError):
+        asyncio.run(run())
+    assert received == ["部分回复"]
+
+def test_resume_replays_events_after_last_seen():
+    async def run():
+        buffer = ReplayBuffer("m")
+        for i in range(5):
+            buffer.append({"type": "content", "content": str(i)})
+        buffer.finish()
+        return [seq for seq, _ in await collect(buffer.subscribe(after=3))]
+    
+    assert asyncio.run(run()) == [4, 5]
+
+def test_resume_after_truncation_reports_gap():
+    async def run():
+        buffer = ReplayBuffer("m")
+        buffer.append({"type": "content", "content": "x"})
+        buffer.drop_events()
+        await collect(buffer.subscribe(after=0))
+    
+    with pytest.raises(ReplayGapError):
+        asyncio.run(run())
+
+async def endless():
+    i = 0
+    while True:
+        await asyncio.sleep(0.01)
+        i += 1
+        yield {"type": "content", "content": str(i)}
+
+def test_abandoned_stream_without_delivered_events_is_cancelled_immediately(monkeypatch):
+    monkeypatch.setattr(config, "STREAM_RESUME_GRACE_SECONDS", 30)
+    
+    async def slow_start():
+        await asyncio.sleep(10)
+        yield {"type": "content", "content": "never"}
+    
+    async def run():
+        buffer = StreamRegistry(ttl=60, max_bytes=1 << 20).start("m", slow_start())
+        subscription = buffer.subscribe()
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(subscription.__anext__(), 0.05)
+        await subscription.aclose()
+        await asyncio.sleep(0)
+        return buffer.task.done()
+    
+    assert asyncio.run(run())
+
+def test_abandoned_stream_is_cancelled_after_grace_unless_resumed(monkeypatch):
+    monkeypatch.setattr(config, "STREAM_RESUME_GRACE_SECONDS", 0.1)
+    
+    async def run():
+        registry = StreamRegistry(ttl=60, max_bytes=1 << 20)
+        buffer = registry.start("m", endless())
+        
+        async def read_one(after=0):
+            async for seq, _ in buffer.subscribe(after):
+                return seq
+        
+        last = await read_one()
+        await asyncio.sleep(0.05)
+        # 宽限期内重连：生成继续，从断点续传
+        resumed = await read_one(last)
+        assert resumed == last + 1
+        await asyncio.sleep(0.05)
+        assert not buffer.task.done()
+        
+        await asyncio.sleep(0.2)
+        return buffer.task.done()
+    
+    assert asyncio.run(run())
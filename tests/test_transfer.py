@@ -0,0 +1,69 @@
+"""
+导入导出测试：NDJSON分块解析、gzip识别、大小上限和往返导入
+"""
+import gzip
+import json
+import asyncio
+
+import pytest
+
+from utils.transfer import encode_ndjson, import_records, iter_export_records, iter_ndjson_records
+
+async def chunked(data: bytes, size: int):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+def parse(data: bytes, chunk_size: int, **limits):
+    async def run():
+        return [record async for record in iter_ndjson_records(chunked(data, chunk_size), **limits)]
+    return asyncio.run(run())
+
+RECORDS = [{"type": "memory", "memory": {"id": str(i), "content": "记忆" * (i % 5)}} for i in range(40)]
+PAYLOAD = b"\n".join(json.dumps(record, ensure_ascii=False).encode("utf-8") for record in RECORDS)
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 4096])
+@pytest.mark.parametrize("compress", [False, True])
+def test_records_survive_any_chunking(chunk_size, compress):
+    data = gzip.compress(PAYLOAD) if compress else PAYLOAD
+    assert parse(data, chunk_size) == RECORDS
+
+def test_long_line_is_parsed_from_small_chunks():
+    record = {"type": "memory", "memory": {"id": "big", "content": "x" * (8 * 1024 * 1024)}}
+    assert parse(json.dumps(record).encode() + b"\n", 4096) == [record]
+
+def test_line_without_newline_over_the_limit_is_rejected():
+    with pytest.raises(ValueError):
+        parse(b"x" * 1000, 100, max_line_bytes=500)
+
+def test_decompression_bomb_is_rejected():
+    with pytest.raises(ValueError):
+        parse(gzip.compress(b"\n" * 20_000_000), 65536, max_total_bytes=1_000_000, decompress_step=65536)
+
+@pytest.mark.parametrize("line", [b"[]", b"1", b'"text"'])
+def test_non_object_record_is_rejected(line):
+    with pytest.raises(ValueError):
+        parse(line + b"\n", 10)
+
+def test_export_import_round_trip():
+    sessions = [{"id": "s1", "title": "会话", "messages": [{"id": "m1", "content": "你好"}, {"id": "m2", "content": "再见"}]}]
+    memories = [{"id": "k1", "content": "偏好"}]
+    imported_sessions, imported_memories = [], []
+    
+    async def upsert_sessions(batch):
+        imported_sessions.extend(batch)
+        return len(batch)
+    
+    async def upsert_memories(batch):
+        imported_memories.extend(batch)
+        return len(batch)
+    
+    async def run():
+        exported = b"".join([
+            chunk async for chunk in encode_ndjson(iter_export_records(sessions, memories, []), compress=True, chunk_size=16)
+        ])
+        return await import_records(iter_ndjson_records(chunked(exported, 5)), upsert_sessions, upsert_memories)
+    
+    stats = asyncio.run(run())
+    assert stats["sessions"] == 1 and stats["messages"] == 2 and stats["memories"] == 1
+    assert imported_sessions[0]["messages"] == sessions[0]["messages"]
+    assert imported_memories == memories
@@ -1,12 +1,16 @@
 """
 API客户端工具模块
 """
+import os
+import time
 import asyncio
 import logging
-from typing import Dict, List, Optional, Tuple
-import openai
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, Iterable, List, Optional, Tuple
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from config import config
+from utils.prompt_builder import prompt_cache_tracker, supports_cache_breakpoints, strip_cache_breakpoints
+from utils.state_backend import state_backend
 
 logger = logging.getLogger(__name__)
 
@@ -22,30 +26,274 @@ class APIAuthError(APIError):
     """API认证错误"""
     pass
 
+def _describe_messages(messages: List[Dict]) -> List[Dict]:
+    """消息结构摘要：每条消息的角色，文本长度或多模态各部分的类型和长度"""
+    described = []
+    for msg in messages:
+        content = msg.get('content')
+        if isinstance(content, list):
+            parts = [
+                {"type": part.get('type'), "chars": len(part.get('text', ''))} if part.get('type') == 'text'
+                else {"type": part.get('type')}
+                for part in content
+            ]
+            described.append({"role": msg.get('role'), "parts": parts})
+        else:
+            described.append({"role": msg.get('role'), "chars": len(content or '')})
+    return described
+
+class CircuitBreaker:
+    """
+    单个模型的熔断器
+    
+    根据滑动窗口内的错误率、连续失败次数和慢调用判断模型是否可用：
+        closed    - 正常放行
+        open      - 熔断中，冷却期内拒绝请求
+        half_open - 冷却期结束，放行一个探测请求
+    
+    路由选择候选模型时只用 is_available() 查看状态；真正发出请求时才用 claim_trial()
+    占用半开状态的探测名额，请求没有记录成功或失败（被取消、认证失败）时由 release_trial() 归还
+    """
+    
+    def __init__(self, model: str):
+        self.model = model
+        self.state = "closed"
+        self._calls: Deque[Tuple[float, bool, Optional[float]]] = deque()
+        self._consecutive_failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_owner: Optional[object] = None  # 占用半开探测名额的请求
+        self.last_error: Optional[str] = None
+        self.last_success_at: Optional[float] = None
+        self.last_failure_at: Optional[float] = None
+    
+    def _prune(self, now: float):
+        """移除窗口外的调用记录"""
+        window = config.BREAKER_WINDOW_SECONDS
+        while self._calls and now - self._calls[0][0] > window:
+            self._calls.popleft()
+    
+    def _refresh(self):
+        """冷却期结束时从 open 转为 half_open"""
+        if self.state == "open" and time.monotonic() - self._opened_at >= config.BREAKER_COOLDOWN_SECONDS:
+            self.state = "half_open"
+            self._trial_owner = None
+    
+    def current_state(self) -> str:
+        """当前状态（冷却期已结束的熔断显示为 half_open，与路由判断一致）"""
+        self._refresh()
+        return self.state
+    
+    def is_available(self) -> bool:
+        """是否可以向该模型发送请求（只查看状态，不占用探测名额）"""
+        self._refresh()
+        return self.state == "closed" or (self.state == "half_open" and self._trial_owner is None)
+    
+    def claim_trial(self) -> Optional[object]:
+        """
+        请求即将发出时调用：半开状态且探测名额空闲时占用名额
+        
+        Returns:
+            名额令牌（交给 release_trial 归还），未占用名额时为None
+        """
+        self._refresh()
+        if self.state != "half_open" or self._trial_owner is not None:
+            return None
+        self._trial_owner = object()
+        return self._trial_owner
+    
+    def release_trial(self, token: Optional[object]):
+        """请求结束时调用：该请求占用的名额尚未因记录结果而释放时归还（其他请求的名额不受影响）"""
+        if token is not None and self._trial_owner is token:
+            self._trial_owner = None
+    
+    def record_success(self, latency: float):
+        """记录成功调用（流式调用记录首token延迟）"""
+        now = time.monotonic()
+        self._prune(now)
+        
+        # 慢调用按失败计入错误率，但不触发连续失败熔断
+        slow = latency > config.BREAKER_SLOW_CALL_SECONDS
+        self._calls.append((now, not slow, latency))
+        self.last_success_at = time.time()
+        self._consecutive_failures = 0
+        
+        if self.state == "half_open":
+            logger.info(f"🟢 模型恢复，关闭熔断: {self.model}")
+            self.state = "closed"
+            self._calls.clear()
+            self._calls.append((now, True, latency))
+        self._trial_owner = None
+        self._evaluate(now)
+    
+    def record_failure(self, error: Exception, latency: Optional[float] = None):
+        """记录失败调用"""
+        now = time.monotonic()
+        self._prune(now)
+        self._calls.append((now, False, latency))
+        self._consecutive_failures += 1
+        self.last_error = str(error)[:200]
+        self.last_failure_at = time.time()
+        self._trial_owner = None
+        
+        if self.state == "half_open":
+            self._open(now)
+            return
+        self._evaluate(now)
+    
+    def _evaluate(self, now: float):
+        """根据统计决定是否熔断"""
+        if self.state != "closed":
+            return
+        
+        if self._consecutive_failures >= config.BREAKER_CONSECUTIVE_FAILURES:
+            self._open(now)
+            return
+        
+        if len(self._calls) >= config.BREAKER_MIN_CALLS:
+            failures = sum(1 for _, ok, _ in self._calls if not ok)
+            if failures / len(self._calls) >= config.BREAKER_ERROR_RATE:
+                self._open(now)
+    
+    def _open(self, now: float):
+        """打开熔断"""
+        self.state = "open"
+        self._opened_at = now
+        logger.warning(f"🔴 模型熔断: {self.model}, 最近错误: {self.last_error}")
+    
+    def snapshot(self) -> Dict:
+        """当前熔断状态与统计"""
+        now = time.monotonic()
+        self._prune(now)
+        latencies = sorted(lat for _, ok, lat in self._calls if ok and lat is not None)
+        calls = len(self._calls)
+        failures = sum(1 for _, ok, _ in self._calls if not ok)
+        return {
+            "model": self.model,
+            "state": self.current_state(),
+            "calls": calls,
+            "error_rate": failures / calls if calls else 0.0,
+            "p50_latency": latencies[len(latencies) // 2] if latencies else None,
+            "p95_latency": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else None,
+            "consecutive_failures": self._consecutive_failures,
+            "last_error": self.last_error,
+            "last_success_at": self.last_success_at,
+            "last_failure_at": self.last_failure_at
+        }
+
+class CircuitBreakerRegistry:
+    """按模型管理熔断器"""
+    
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+    
+    def get(self, model: str) -> CircuitBreaker:
+        if model not in self._breakers:
+            self._breakers[model] = CircuitBreaker(model)
+        return self._breakers[model]
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        return {model: breaker.snapshot() for model, breaker in self._breakers.items()}
+    
+    def health(self, models: Iterable[str] = ()) -> Dict:
+        """
+        根据各模型熔断状态汇总上游健康度（不发起任何请求）
+        
+        Args:
+            models: 已配置的模型，尚未调用过的视为可用（closed）
+        """
+        states = {model: breaker.current_state() for model, breaker in self._breakers.items()}
+        for model in models:
+            states.setdefault(model, "closed")
+        open_models = [model for model, state in states.items() if state == "open"]
+        
+        if not self._breakers:
+            status = "unknown"  # 尚无调用数据
+        elif len(open_models) == len(states):
+            status = "unhealthy"
+        elif open_models:
+            status = "degraded"
+        else:
+            status = "healthy"
+        
+        return {
+            "status": status,
+            "models": states,
+            "open_models": open_models
+        }
+
+# 全局熔断器注册表
+circuit_breakers = CircuitBreakerRegistry()
+
+# openai SDK 导入耗时约1秒，推迟到首次创建客户端时（lifespan 中在线程里预先导入）
+openai = None
+
+def _import_openai():
+    global openai
+    if openai is None:
+        import openai as module
+        openai = module
+    return openai
+
+def _map_api_error(e: Exception) -> APIError:
+    """将openai异常转换为本模块的异常类型"""
+    if isinstance(e, APIError):
+        return e
+    _import_openai()
+    if isinstance(e, openai.AuthenticationError):
+        return APIAuthError("API密钥无效或过期")
+    if isinstance(e, openai.RateLimitError):
+        return APIRateLimitError("API请求频率超限")
+    if isinstance(e, openai.APIError):
+        if "403" in str(e):
+            return APIAuthError("API访问被拒绝，请检查密钥权限")
+        return APIError(f"API调用失败: {e}")
+    return APIError(f"请求失败: {e}")
+
 class EnhancedPoeClient:
     """增强的Poe API客户端"""
     
     def __init__(self):
-        self.client = openai.OpenAI(
-            api_key=config.POE_API_KEY,
-            base_url=config.POE_BASE_URL,
-        )
-        self._request_count = 0
-        self._last_reset = asyncio.get_event_loop().time()
-    
-    def _check_rate_limit(self):
-        """检查请求限流"""
-        current_time = asyncio.get_event_loop().time()
-        
-        # 重置计数器
-        if current_time - self._last_reset > config.RATE_LIMIT_WINDOW:
-            self._request_count = 0
-            self._last_reset = current_time
-        
-        if self._request_count >= config.RATE_LIMIT_REQUESTS:
+        self._client = None
+        self._client_pid: Optional[int] = None
+        self._probe_task: Optional[asyncio.Task] = None
+        self._last_probe_started: Optional[float] = None
+        self._last_probe: Optional[Dict] = None
+    
+    @property
+    def client(self):
+        """
+        底层 AsyncOpenAI 客户端，在使用它的进程中首次访问时创建；
+        预fork部署下父进程创建的客户端（及其连接池）不会被worker继承使用
+        """
+        if self._client is None or self._client_pid != os.getpid():
+            self._client = _import_openai().AsyncOpenAI(
+                api_key=config.POE_API_KEY,
+                base_url=config.POE_BASE_URL,
+            )
+            self._client_pid = os.getpid()
+        return self._client
+    
+    async def start(self):
+        """
+        返回本进程的客户端；openai SDK 尚未导入时先在线程中导入，不阻塞事件循环
+        （lifespan 中在后台预先调用，每次请求前调用的开销可忽略）
+        """
+        if openai is None:
+            await asyncio.to_thread(_import_openai)
+        return self.client
+    
+    async def close(self):
+        """关闭本进程创建的客户端连接池"""
+        client, self._client = self._client, None
+        if client is not None and self._client_pid == os.getpid():
+            await client.close()
+    
+    async def _check_rate_limit(self):
+        """检查请求限流（固定时间窗口，计数保存在共享状态后端，所有worker共用同一额度）"""
+        window = int(time.time() // config.RATE_LIMIT_WINDOW)
+        count = await state_backend.incr(f"ratelimit:upstream:{window}", ttl=config.RATE_LIMIT_WINDOW * 2)
+        if count > config.RATE_LIMIT_REQUESTS:
             raise APIRateLimitError("请求频率过高，请稍后再试")
-        
-        self._request_count += 1
     
     async def stream_chat_completion(
         self,
@@ -56,12 +304,18 @@ class EnhancedPoeClient:
         **kwargs
     ):
         """流式聊天完成API调用"""
+        await self._check_rate_limit()
+        client = await self.start()
+        breaker = circuit_breakers.get(model)
+        trial = breaker.claim_trial()
+        start_time = time.monotonic()
+        first_token_latency = None
+        response = None
+        
         try:
-            self._check_rate_limit()
-            
-            logger.info(f"🔍 准备流式调用API: {model}")
+            logger.debug(f"🔍 准备流式调用API: {model}")
             
-            response = self.client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=max_tokens or config.DEFAULT_MAX_TOKENS,
@@ -70,22 +324,34 @@ class EnhancedPoeClient:
                 **kwargs
             )
             
-            for chunk in response:
-                if chunk.choices[0].delta.content:
+            async for chunk in response:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first_token_latency is None:
+                        first_token_latency = time.monotonic() - start_time
                     yield chunk.choices[0].delta.content
             
+            breaker.record_success(first_token_latency if first_token_latency is not None else time.monotonic() - start_time)
             logger.info(f"✅ 流式API调用完成: {model}")
-            
+        
+        except (asyncio.CancelledError, GeneratorExit):
+            # 调用方取消（如对冲请求落败），不计入熔断统计
+            raise
         except Exception as e:
             logger.error(f"流式调用失败: {e}")
-            raise APIError(f"流式请求失败: {e}")
+            breaker.record_failure(e, time.monotonic() - start_time)
+            error = _map_api_error(e)
+            if type(error) is APIError:
+                error = APIError(f"流式请求失败: {e}")
+            raise error
+        finally:
+            breaker.release_trial(trial)
+            if response is not None:
+                try:
+                    await response.close()
+                except Exception:
+                    pass
 
-    @retry(
-        stop=stop_after_attempt(config.MAX_RETRIES),
-        wait=wait_exponential(multiplier=1, min=1, max=10),
-        retry=retry_if_exception_type((APIRateLimitError, ConnectionError))
-    )
-    async def chat_completion(
+    async def _complete_once(
         self,
         model: str,
         messages: List[Dict],
@@ -93,28 +359,22 @@ class EnhancedPoeClient:
         temperature: float = None,
         **kwargs
     ) -> str:
-        """聊天完成API调用"""
+        """单次聊天完成调用（不重试），结果计入模型熔断统计"""
+        await self._check_rate_limit()
+        breaker = circuit_breakers.get(model)
+        client = await self.start()  # 同时确保下面匹配异常类型时 openai 已导入
+        trial = breaker.claim_trial()
+        start_time = time.monotonic()
+        
         try:
-            self._check_rate_limit()
-            
-            # 调试：记录消息结构
-            logger.info(f"🔍 准备调用API: {model}")
-            logger.info(f"🔍 消息数量: {len(messages)}")
-            for i, msg in enumerate(messages):
-                logger.info(f"🔍 消息 {i}: role={msg.get('role')}, content类型={type(msg.get('content'))}")
-                if isinstance(msg.get('content'), list):
-                    logger.info(f"🔍   多模态消息，包含 {len(msg['content'])} 个部分")
-                    for j, part in enumerate(msg['content']):
-                        part_type = part.get('type')
-                        logger.info(f"🔍     部分 {j}: type={part_type}")
-                        if part_type == 'image_url':
-                            url = part.get('image_url', {}).get('url', '')
-                            logger.info(f"🔍       图片URL前50字符: {url[:50]}")
-                        elif part_type == 'text':
-                            text = part.get('text', '')
-                            logger.info(f"🔍       文本长度: {len(text)}, 前100字符: {text[:100]}")
+            # 调试：记录消息结构（只记角色、类型和长度，不记内容；按 LOG_PAYLOAD_SAMPLE_RATE 采样）
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    f"🔍 准备调用API: {model}，消息数量: {len(messages)}",
+                    extra={"sample": True, "model": model, "messages": _describe_messages(messages)}
+                )
             
-            response = self.client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model=model,
                 messages=messages,
                 max_tokens=max_tokens or config.DEFAULT_MAX_TOKENS,
@@ -124,41 +384,298 @@ class EnhancedPoeClient:
             )
             
             content = response.choices[0].message.content or ""
+            breaker.record_success(time.monotonic() - start_time)
+            
+            # 记录上游返回的前缀缓存命中情况
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                details = getattr(usage, "prompt_tokens_details", None)
+                prompt_cache_tracker.record_upstream_usage(
+                    model, usage.prompt_tokens, getattr(details, "cached_tokens", 0) or 0
+                )
+            
             logger.info(f"✅ API调用成功: {model}, 返回内容长度: {len(content)}")
-            logger.info(f"✅ 返回内容前200字符: {content[:200]}")
             return content
-            
+        
+        except asyncio.CancelledError:
+            raise
+        
         except openai.AuthenticationError as e:
             logger.error(f"API认证失败: {e}")
             raise APIAuthError("API密钥无效或过期")
-            
+        
         except openai.RateLimitError as e:
             logger.warning(f"API限流: {e}")
+            breaker.record_failure(e, time.monotonic() - start_time)
             raise APIRateLimitError("API请求频率超限")
-            
+        
         except openai.APIError as e:
             logger.error(f"API错误: {e}")
+            breaker.record_failure(e, time.monotonic() - start_time)
             if "403" in str(e):
                 raise APIAuthError("API访问被拒绝，请检查密钥权限")
             raise APIError(f"API调用失败: {e}")
-            
+        
         except Exception as e:
             logger.error(f"未知错误: {e}")
+            breaker.record_failure(e, time.monotonic() - start_time)
             raise APIError(f"请求失败: {e}")
+        
+        finally:
+            breaker.release_trial(trial)
     
-    async def health_check(self) -> bool:
-        """API健康检查"""
+    @retry(
+        stop=stop_after_attempt(config.MAX_RETRIES),
+        wait=wait_exponential(multiplier=1, min=1, max=10),
+        retry=retry_if_exception_type((APIRateLimitError, ConnectionError))
+    )
+    async def chat_completion(
+        self,
+        model: str,
+        messages: List[Dict],
+        max_tokens: int = None,
+        temperature: float = None,
+        **kwargs
+    ) -> str:
+        """聊天完成API调用"""
+        return await self._complete_once(model, messages, max_tokens, temperature, **kwargs)
+    
+    def health_status(self, models: Iterable[str] = ()) -> Dict:
+        """上游健康状态：由近期真实调用结果的熔断状态推导（models 为已配置的模型），附带最近一次主动探测结果"""
+        return {
+            **circuit_breakers.health(models),
+            "last_probe": self._last_probe
+        }
+    
+    def schedule_probe(self) -> bool:
+        """
+        限频的主动探测：距上次探测超过 HEALTH_PROBE_INTERVAL 时在后台发起一次极小的补全请求，
+        结果计入熔断统计。返回是否发起了探测。
+        """
+        now = time.monotonic()
+        if self._probe_task and not self._probe_task.done():
+            return False
+        if self._last_probe_started is not None and now - self._last_probe_started < config.HEALTH_PROBE_INTERVAL:
+            return False
+        
+        self._last_probe_started = now
+        self._probe_task = asyncio.create_task(self._probe())
+        return True
+    
+    async def _probe(self):
+        """执行一次主动探测"""
+        start_time = time.monotonic()
         try:
-            await self.chat_completion(
-                model="GPT-4o",
-                messages=[{"role": "user", "content": "test"}],
-                max_tokens=10
+            await self._complete_once(
+                model=config.HEALTH_PROBE_MODEL,
+                messages=[{"role": "user", "content": "ping"}],
+                max_tokens=1
             )
-            return True
+            ok, error = True, None
         except Exception as e:
+            ok, error = False, str(e)[:200]
             logger.error(f"健康检查失败: {e}")
-            return False
+        
+        self._last_probe = {
+            "model": config.HEALTH_PROBE_MODEL,
+            "ok": ok,
+            "error": error,
+            "latency": time.monotonic() - start_time,
+            "at": time.time()
+        }
+    
+    async def health_check(self) -> bool:
+        """API健康检查（被动：不消耗配额）"""
+        return self.health_status()["status"] != "unhealthy"
+
+class _StreamAttempt:
+    """一次流式尝试：后台任务把上游分片写入队列，便于对冲和取消"""
+    
+    def __init__(self, client: EnhancedPoeClient, model: str, messages: List[Dict], kwargs: Dict):
+        self.model = model
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._pump(client, messages, kwargs))
+    
+    async def _pump(self, client: EnhancedPoeClient, messages: List[Dict], kwargs: Dict):
+        stream = client.stream_chat_completion(model=self.model, messages=messages, **kwargs)
+        try:
+            async for chunk in stream:
+                self.queue.put_nowait(("chunk", chunk))
+            self.queue.put_nowait(("done", None))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.queue.put_nowait(("error", e))
+        finally:
+            await stream.aclose()
+    
+    async def cancel(self):
+        """取消该尝试并关闭上游连接"""
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except BaseException:
+            pass
+
+class ModelRouter:
+    """
+    模型路由层
+    
+    按顺序尝试候选模型（主模型 + 备用模型），跳过熔断中的模型；
+    开启对冲时，若主请求在指定时间内没有返回首个token（非流式为完整结果），
+    则向下一个候选模型发起对冲请求，先返回者胜出，另一个请求被取消。
+    """
+    
+    def __init__(self, client: EnhancedPoeClient):
+        self.client = client
+    
+    def candidates(self, models: List[str]) -> List[str]:
+        """过滤熔断中的模型；全部熔断时仍尝试主模型（只查看状态，探测名额在请求实际发出时占用）"""
+        unique = list(dict.fromkeys(m for m in models if m))
+        available = [m for m in unique if circuit_breakers.get(m).is_available()]
+        if not available and unique:
+            logger.warning(f"⚠️ 所有候选模型均处于熔断状态，强制尝试主模型: {unique[0]}")
+            return unique[:1]
+        return available
+    
+    @staticmethod
+    def _messages_for(model: str, messages: List[Dict]) -> List[Dict]:
+        """备用模型不支持缓存断点时移除断点标记"""
+        return messages if supports_cache_breakpoints(model) else strip_cache_breakpoints(messages)
+    
+    @staticmethod
+    def _hedge_delay(hedge: Optional[bool]) -> Optional[float]:
+        enabled = config.ROUTER_HEDGE_ENABLED if hedge is None else hedge
+        return config.ROUTER_HEDGE_DELAY_MS / 1000 if enabled else None
+    
+    async def chat_completion(
+        self,
+        models: List[str],
+        messages: List[Dict],
+        hedge: Optional[bool] = None,
+        **kwargs
+    ) -> str:
+        """带备用模型与对冲的非流式调用"""
+        pending = self.candidates(models)
+        hedge_delay = self._hedge_delay(hedge)
+        active: Dict[asyncio.Task, str] = {}
+        last_error: Optional[Exception] = None
+        
+        try:
+            while pending or active:
+                if not active:
+                    model = pending.pop(0)
+                    # 没有其他候选时保留原有的重试策略
+                    call = self.client._complete_once if pending else self.client.chat_completion
+                    active[asyncio.create_task(
+                        call(model, self._messages_for(model, messages), **kwargs)
+                    )] = model
+                
+                timeout = hedge_delay if hedge_delay is not None and pending and len(active) == 1 else None
+                done, _ = await asyncio.wait(active.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                
+                if not done:
+                    # 主请求超过对冲延迟仍未完成，发起对冲请求
+                    model = pending.pop(0)
+                    logger.info(f"🔀 对冲请求: {list(active.values())[0]} 未在 {hedge_delay}s 内返回，追加 {model}")
+                    active[asyncio.create_task(
+                        self.client._complete_once(model, self._messages_for(model, messages), **kwargs)
+                    )] = model
+                    continue
+                
+                for task in done:
+                    model = active.pop(task)
+                    try:
+                        result = task.result()
+                    except APIAuthError:
+                        raise
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"🔀 模型 {model} 调用失败，尝试下一个候选: {e}")
+                        continue
+                    if model != models[0]:
+                        logger.info(f"🔀 已由备用模型 {model} 完成请求")
+                    return result
+        finally:
+            # 等待落选的请求结束，连接和熔断探测名额随之释放，取消后的异常也在此取回
+            for task in active:
+                task.cancel()
+            if active:
+                await asyncio.gather(*active, return_exceptions=True)
+        
+        raise last_error if isinstance(last_error, APIError) else APIError(f"所有候选模型均调用失败: {last_error}")
+    
+    async def stream_chat_completion(
+        self,
+        models: List[str],
+        messages: List[Dict],
+        hedge: Optional[bool] = None,
+        **kwargs
+    ) -> AsyncIterator[str]:
+        """带备用模型与对冲的流式调用，首个token返回前可切换模型，之后固定在胜出模型上"""
+        pending = self.candidates(models)
+        hedge_delay = self._hedge_delay(hedge)
+        active: List[_StreamAttempt] = []
+        last_error: Optional[Exception] = None
+        winner: Optional[_StreamAttempt] = None
+        first_item = None
+        
+        try:
+            while winner is None:
+                if not active:
+                    if not pending:
+                        raise last_error if isinstance(last_error, APIError) else APIError(f"所有候选模型均调用失败: {last_error}")
+                    model = pending.pop(0)
+                    active.append(_StreamAttempt(self.client, model, self._messages_for(model, messages), kwargs))
+                
+                getters = {asyncio.ensure_future(attempt.queue.get()): attempt for attempt in active}
+                timeout = hedge_delay if hedge_delay is not None and pending and len(active) == 1 else None
+                done, not_done = await asyncio.wait(getters.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for getter in not_done:
+                    getter.cancel()
+                
+                if not done:
+                    model = pending.pop(0)
+                    logger.info(f"🔀 对冲请求: {active[0].model} 未在 {hedge_delay}s 内返回首个token，追加 {model}")
+                    active.append(_StreamAttempt(self.client, model, self._messages_for(model, messages), kwargs))
+                    continue
+                
+                for getter in done:
+                    attempt = getters[getter]
+                    kind, value = getter.result()
+                    if kind == "error":
+                        active.remove(attempt)
+                        last_error = value
+                        if isinstance(value, APIAuthError):
+                            raise value
+                        logger.warning(f"🔀 模型 {attempt.model} 首个token前失败，尝试下一个候选: {value}")
+                    elif winner is None:
+                        winner, first_item = attempt, (kind, value)
+                    else:
+                        # 同时到达的另一路结果放回队列，随落败请求一起丢弃
+                        attempt.queue.put_nowait((kind, value))
+            
+            # 取消落败的对冲请求
+            for attempt in active:
+                if attempt is not winner:
+                    await attempt.cancel()
+            active = [winner]
+            if winner.model != models[0]:
+                logger.info(f"🔀 已由备用模型 {winner.model} 响应流式请求")
+            
+            kind, value = first_item
+            while kind == "chunk":
+                yield value
+                kind, value = await winner.queue.get()
+            if kind == "error":
+                raise value
+        finally:
+            for attempt in active:
+                await attempt.cancel()
 
 # 全局客户端实例
 poe_client = EnhancedPoeClient()
 
+# 全局模型路由
+model_router = ModelRouter(poe_client)
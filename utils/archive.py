@@ -0,0 +1,153 @@
+"""
+会话归档模块
+将不活跃的会话按月写入gzip压缩的JSONL分段文件，并维护一个小型偏移索引，
+读取时只需解压单个会话所在的数据块
+"""
+import os
+import gzip
+import asyncio
+import logging
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from utils import fast_json
+from utils.file_store import atomic_write
+
+logger = logging.getLogger(__name__)
+
+class SessionArchive:
+    """
+    冷存储会话归档
+    
+    每个会话作为独立的gzip成员追加到 sessions-YYYY-MM.jsonl.gz（多成员gzip文件可被标准工具整体解压），
+    index.json 记录 会话ID → 分段文件、偏移、长度及会话摘要
+    """
+    
+    def __init__(self, archive_dir: str):
+        self.archive_dir = Path(archive_dir)
+        self.index_file = self.archive_dir / "index.json"
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+        self._lock = asyncio.Lock()
+    
+    def _load_index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self._index = fast_json.loads(f.read())
+            except FileNotFoundError:
+                self._index = {}
+            except Exception as e:
+                logger.error(f"读取归档索引失败: {e}")
+                self._index = {}
+        return self._index
+    
+    def _save_index(self):
+        atomic_write(self.index_file, fast_json.dumpb(self._index))
+    
+    @staticmethod
+    def _segment_name(session: Dict[str, Any]) -> str:
+        """按会话最后更新的月份分段"""
+        month = str(session.get("updated_at") or session.get("created_at") or "")[:7]
+        if len(month) != 7:
+            month = "unknown"
+        return f"sessions-{month}.jsonl.gz"
+    
+    @staticmethod
+    def _summary(session: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "id": session.get("id"),
+            "title": session.get("title"),
+            "created_at": session.get("created_at"),
+            "updated_at": session.get("updated_at"),
+            "message_count": len(session.get("messages", [])),
+            "is_discussion": bool(session.get("is_discussion")),
+            "archived": True
+        }
+    
+    def _write(self, sessions: List[Dict[str, Any]]):
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        index = self._load_index()
+        
+        by_segment: Dict[str, List[Dict[str, Any]]] = {}
+        for session in sessions:
+            by_segment.setdefault(self._segment_name(session), []).append(session)
+        
+        for segment, items in by_segment.items():
+            with open(self.archive_dir / segment, 'ab') as f:
+                for session in items:
+                    block = gzip.compress(fast_json.dumpb(session, default=str) + b"\n")
+                    offset = f.tell()
+                    f.write(block)
+                    index[session["id"]] = {
+                        "segment": segment,
+                        "offset": offset,
+                        "length": len(block),
+                        **self._summary(session)
+                    }
+                f.flush()
+                os.fsync(f.fileno())
+        
+        self._save_index()
+    
+    def _read(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._load_index().get(session_id)
+        if not entry:
+            return None
+        return self._read_entry(entry)
+    
+    def _read_entry(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        with open(self.archive_dir / entry["segment"], 'rb') as f:
+            f.seek(entry["offset"])
+            block = f.read(entry["length"])
+        return fast_json.loads(gzip.decompress(block))
+    
+    def _remove(self, session_ids: List[str]):
+        index = self._load_index()
+        removed = [session_id for session_id in session_ids if index.pop(session_id, None)]
+        if removed:
+            self._save_index()
+    
+    async def archive(self, sessions: List[Dict[str, Any]]):
+        """将会话写入归档（写入并同步到磁盘后才返回）"""
+        if not sessions:
+            return
+        async with self._lock:
+            await asyncio.to_thread(self._write, sessions)
+    
+    async def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """读取归档会话，不存在时返回None"""
+        async with self._lock:
+            return await asyncio.to_thread(self._read, session_id)
+    
+    async def remove(self, session_ids: List[str]):
+        """从索引中移除会话（分段文件中的数据块成为不可达的空间）"""
+        async with self._lock:
+            await asyncio.to_thread(self._remove, session_ids)
+    
+    async def read_entry(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """按索引条目读取会话（条目中的数据块在移出索引后仍保留在分段文件中）"""
+        return await asyncio.to_thread(self._read_entry, entry)
+    
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        """当前索引条目的副本，可作为导出等操作的时间点视图"""
+        return dict(self._load_index())
+    
+    def contains(self, session_id: str) -> bool:
+        return session_id in self._load_index()
+    
+    def summaries(self) -> List[Dict[str, Any]]:
+        """所有归档会话的摘要"""
+        return [
+            {key: entry.get(key) for key in ("id", "title", "created_at", "updated_at", "message_count", "is_discussion", "archived")}
+            for entry in self._load_index().values()
+        ]
+    
+    def stats(self) -> Dict[str, Any]:
+        """归档统计"""
+        index = self._load_index()
+        segments: Dict[str, int] = {}
+        for entry in index.values():
+            segments[entry["segment"]] = segments.get(entry["segment"], 0) + 1
+        return {
+            "archived_sessions": len(index),
+            "segments": segments
+        }
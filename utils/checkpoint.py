@@ -0,0 +1,195 @@
+"""
+流式回复检查点模块
+生成过程中把新增文本追加写入日志文件（只追加，不重写会话数据），
+进程重启后据此找回中断的回复，以未完成状态写回会话
+"""
+import os
+import asyncio
+import logging
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from config import config
+from utils import fast_json
+from utils.file_store import try_lock_fd
+
+logger = logging.getLogger(__name__)
+
+class StreamCheckpointJournal:
+    """
+    流式回复的追加日志
+    
+    每条记录为一行JSON：begin（开始生成）、delta（新增文本）、end（回复已写入会话）。
+    所有进行中的回复都结束后截断日志，文件大小只与当前在途的回复有关。
+    
+    每个进程写自己的日志文件（<名称>.<pid>-<随机后缀>.jsonl）并在存活期间持有其文件锁；
+    恢复时只接管未被加锁的日志，即已退出进程留下的，不会误读其他 worker 正在写的回复
+    """
+    
+    def __init__(self, journal_file: str):
+        self.base_file = Path(journal_file)
+        self.journal_file: Optional[Path] = None  # 首次写入时确定，fork出的worker各自生成
+        self._fd: Optional[int] = None
+        self._open: set = set()
+        self._lock = asyncio.Lock()
+    
+    def _ensure_fd(self) -> int:
+        """
+        打开并锁定本进程的日志：先在临时名称下创建并加锁再改名，
+        其他进程扫描时不会看到尚未加锁的日志文件；锁随描述符保持到进程退出
+        """
+        if self._fd is None:
+            self.journal_file = self.base_file.with_name(
+                f"{self.base_file.stem}.{os.getpid()}-{uuid.uuid4().hex[:8]}{self.base_file.suffix}"
+            )
+            self.journal_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = self.journal_file.with_name(f".{self.journal_file.name}.{uuid.uuid4().hex}.tmp")
+            fd = os.open(temp_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                try_lock_fd(fd)
+                os.replace(temp_path, self.journal_file)
+            except BaseException:
+                os.close(fd)
+                os.unlink(temp_path)
+                raise
+            self._fd = fd
+        return self._fd
+    
+    def _append(self, records: List[Dict[str, Any]], truncate: bool = False):
+        fd = self._ensure_fd()
+        if truncate:
+            os.ftruncate(fd, 0)
+            return
+        # 只刷新到操作系统缓冲，进程崩溃不丢数据；不逐条fsync以保持追加廉价
+        os.write(fd, b"".join(fast_json.dumpb(record) + b"\n" for record in records))
+    
+    async def _write(self, record: Dict[str, Any]):
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._append, [record])
+            except Exception as e:
+                logger.warning(f"写入流式检查点失败: {e}")
+    
+    async def begin(self, message_id: str, session_id: str, agent_name: str, timestamp: str):
+        """记录开始生成一条回复"""
+        self._open.add(message_id)
+        await self._write({
+            "op": "begin",
+            "message_id": message_id,
+            "session_id": session_id,
+            "agent_name": agent_name,
+            "timestamp": timestamp
+        })
+    
+    async def append(self, message_id: str, text: str):
+        """记录自上次检查点以来新增的文本"""
+        if text:
+            await self._write({"op": "delta", "message_id": message_id, "text": text})
+    
+    async def end(self, message_id: str):
+        """回复（完整或未完成）已写入会话"""
+        self._open.discard(message_id)
+        async with self._lock:
+            try:
+                await asyncio.to_thread(
+                    self._append,
+                    [{"op": "end", "message_id": message_id}],
+                    not self._open
+                )
+            except Exception as e:
+                logger.warning(f"写入流式检查点失败: {e}")
+    
+    def _journal_files(self) -> List[Path]:
+        """本目录下所有进程的日志（包括旧版本的单一日志文件）"""
+        directory = self.base_file.parent
+        files = list(directory.glob(f"{self.base_file.stem}.*{self.base_file.suffix}"))
+        if self.base_file.exists():
+            files.append(self.base_file)
+        return files
+    
+    def _claim(self, path: Path) -> List[bytes]:
+        """
+        接管一个已退出进程的日志：加锁成功（写入者已不在）且文件仍在目录中时读出全部内容并删除；
+        加锁失败说明写入进程仍存活，跳过
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return []
+        try:
+            # 链接数为0说明另一个进程刚接管并删除了它
+            if not try_lock_fd(fd) or os.fstat(fd).st_nlink == 0:
+                return []
+            with os.fdopen(os.dup(fd), 'rb') as f:
+                lines = f.readlines()
+            os.unlink(path)
+            return lines
+        finally:
+            os.close(fd)
+    
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        pending: Dict[str, Dict[str, Any]] = {}
+        for path in self._journal_files():
+            for line in self._claim(path):
+                try:
+                    record = fast_json.loads(line)
+                except ValueError:
+                    # 崩溃时可能留下不完整的最后一行
+                    continue
+                message_id = record.get("message_id")
+                op = record.get("op")
+                if op == "begin":
+                    pending[message_id] = {**record, "parts": []}
+                elif op == "delta" and message_id in pending:
+                    pending[message_id]["parts"].append(record.get("text", ""))
+                elif op == "end":
+                    pending.pop(message_id, None)
+        return pending
+    
+    async def recover(self) -> List[Dict[str, Any]]:
+        """
+        读取已退出进程中断的回复，并删除这些进程的日志
+        
+        Returns:
+            中断回复列表，每项包含 message_id、session_id、agent_name、timestamp、content
+        """
+        async with self._lock:
+            pending = await asyncio.to_thread(self._read)
+        
+        interrupted = []
+        for entry in pending.values():
+            interrupted.append({
+                "message_id": entry["message_id"],
+                "session_id": entry.get("session_id"),
+                "agent_name": entry.get("agent_name"),
+                "timestamp": entry.get("timestamp"),
+                "content": "".join(entry["parts"])
+            })
+        if interrupted:
+            logger.warning(f"⚠️ 发现 {len(interrupted)} 条中断的流式回复")
+        return interrupted
+    
+    def in_flight(self) -> int:
+        return len(self._open)
+
+class CheckpointPolicy:
+    """按字符数或时间间隔决定何时写检查点"""
+    
+    def __init__(self, max_chars: int, max_seconds: float):
+        self.max_chars = max_chars
+        self.max_seconds = max_seconds
+        self._pending = 0
+        self._last = None
+    
+    def should_flush(self, added: int, now: float) -> bool:
+        if self._last is None:
+            self._last = now
+        self._pending += added
+        if self._pending >= self.max_chars or now - self._last >= self.max_seconds:
+            self._pending = 0
+            self._last = now
+            return True
+        return False
+
+# 全局流式检查点日志
+stream_checkpoints = StreamCheckpointJournal(config.STREAM_CHECKPOINT_FILE)
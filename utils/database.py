@@ -2,40 +2,127 @@
 数据库管理模块
 """
 import json
+import time
+import base64
+import bisect
 import asyncio
+import inspect
+import weakref
+import contextlib
 import aiofiles
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple, Callable, Collection
 from dataclasses import asdict
 import logging
 from datetime import timedelta
+from config import config
+from utils import fast_json
+from utils.metrics import metrics_collector
+from utils.archive import SessionArchive
+from utils.file_store import FileLock, KeyedFileLock, atomic_write
+from utils.state_backend import StateBackend, state_backend
 
 logger = logging.getLogger(__name__)
 
+class SessionSnapshot:
+    """
+    会话数据的不可变快照
+    
+    每次写入都基于当前快照构建新版本并整体替换，已发布的快照及其中的会话字典不再被修改，
+    读者可以不加锁地共享同一份快照
+    """
+    
+    __slots__ = ("version", "by_id")
+    
+    def __init__(self, version: int, by_id: Dict[str, Dict[str, Any]]):
+        self.version = version
+        self.by_id = by_id
+    
+    @property
+    def sessions(self) -> List[Dict[str, Any]]:
+        return list(self.by_id.values())
+
 class DatabaseManager:
     """数据库管理器"""
     
-    def __init__(self, db_file: str = "chat_sessions.json"):
+    DURABILITY_MODES = ("sync", "group", "async")
+    
+    def __init__(
+        self,
+        db_file: str = "chat_sessions.json",
+        durability: str = "sync",
+        group_commit_ms: int = 50,
+        archive: Optional[SessionArchive] = None,
+        backend: Optional[StateBackend] = None,
+        sync_interval_ms: int = 200,
+        lock_timeout: float = 30
+    ):
+        """
+        Args:
+            db_file: 会话数据文件
+            durability: 持久化模式
+                sync  - 每次写入立即落盘后返回
+                group - 合并时间窗口内的写入，落盘后返回
+                async - 写入发布到内存后立即返回，后台合并落盘
+            group_commit_ms: group/async模式的合并窗口（毫秒）
+            archive: 冷存储归档，提供时不活跃会话可移入归档并在访问时自动恢复
+            backend: 共享状态后端；为多进程共享的后端时会话存放在后端中而不是本地文件，
+                     各worker按修订号增量同步其他worker的写入，会话锁同时持有跨进程锁
+            sync_interval_ms: 共享模式下读取时检查其他worker写入的最短间隔
+            lock_timeout: 共享模式下跨进程会话锁的最长持有/等待时间（秒）
+        """
+        if durability not in self.DURABILITY_MODES:
+            raise ValueError(f"不支持的持久化模式: {durability}")
+        
         self.db_file = Path(db_file)
-        self._lock = asyncio.Lock()
-        self._cache: Optional[List[ChatSession]] = None
+        self.durability = durability
+        self.group_commit_window = group_commit_ms / 1000
+        self.archive = archive
+        self._lock = asyncio.Lock()  # 保护快照发布
+        self._write_lock = asyncio.Lock()  # 串行化文件写入
+        self._snapshot: Optional[SessionSnapshot] = None
+        self._persisted_version = 0
+        self._dirty: set = set()  # 尚未落盘的会话ID
+        self._commit_task: Optional[asyncio.Task] = None
+        self._listeners: List[Callable[[Dict[str, Optional[Dict[str, Any]]]], None]] = []
         self._cache_time: Optional[datetime] = None
         self._cache_ttl = 300  # 5分钟缓存
-    
-    async def _ensure_file_exists(self):
-        """确保数据库文件存在"""
-        if not self.db_file.exists():
-            await self._write_data([])
+        
+        # 文件模式的跨进程保护：写入持有文件锁，锁文件中的代数每次写入递增，
+        # 代数与快照加载/写入时不同说明其他进程改过文件
+        self._file_lock = FileLock(self.db_file)
+        self._file_generation: Optional[int] = None
+        # 文件模式的跨进程会话锁，持有期间完成该会话的读-改-写并落盘
+        self._session_file_lock = KeyedFileLock(self.db_file.with_name(self.db_file.name + ".sessions.lock"))
+        self._deferred_releases: set = set()  # async模式下等待落盘后释放会话锁的任务
+        
+        # 会话摘要索引：列表接口只读取索引，不触碰消息内容
+        self.index_file = self.db_file.with_suffix('.index.json')
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+        self._index_order: List[Tuple[str, str]] = []  # (updated_at, id) 升序
+        
+        # 会话级锁，锁对象不再被引用时自动回收
+        self._session_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+        
+        # 共享模式：后端中 sessions 哈希表保存会话，sessions:rev 保存各会话的修订号，
+        # sessions:generation 在每次提交后递增，代数未变时无需比对修订号
+        self.backend = backend if backend is not None and backend.shared else None
+        self.sync_interval = sync_interval_ms / 1000
+        self.lock_timeout = lock_timeout
+        self._generation = 0  # 已同步到的共享代数
+        self._revisions: Dict[str, int] = {}  # 会话ID → 本地快照中该会话的修订号
+        self._synced_at = 0.0
+        self._sync_lock = asyncio.Lock()
     
     async def _read_data(self) -> List[Dict[str, Any]]:
         """读取原始数据"""
-        await self._ensure_file_exists()
-        
         try:
             async with aiofiles.open(self.db_file, 'r', encoding='utf-8') as f:
                 content = await f.read()
-                return json.loads(content) if content.strip() else []
+                return fast_json.loads(content) if content.strip() else []
+        except FileNotFoundError:
+            return []
         except json.JSONDecodeError as e:
             logger.error(f"JSON解析错误: {e}")
             # 备份损坏的文件
@@ -47,125 +134,967 @@ class DatabaseManager:
             logger.error(f"读取数据失败: {e}")
             return []
     
-    async def _write_data(self, data: List[Dict[str, Any]]):
-        """写入数据"""
+    def _write_data(self, data: List[Dict[str, Any]]) -> int:
+        """写入数据（须持有文件锁），返回写入后的文件代数"""
         try:
-            # 先写入临时文件
-            temp_file = self.db_file.with_suffix('.tmp')
-            async with aiofiles.open(temp_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, ensure_ascii=False, indent=2, default=str))
-            
-            # 原子性替换
-            temp_file.replace(self.db_file)
+            atomic_write(self.db_file, fast_json.dumpb(data, indent=True, default=str))
             logger.debug(f"数据写入成功: {len(data)} 条记录")
-            
+            return self._file_lock.bump()
         except Exception as e:
             logger.error(f"写入数据失败: {e}")
             raise
     
+    async def _write_file(self, snapshot: SessionSnapshot, dirty: set) -> bool:
+        """
+        在文件锁内写入快照
+        
+        其他进程在此期间写过文件时，以磁盘上的最新内容为基础，只覆盖本进程修改过的会话，
+        不会抹掉其他进程的写入
+        
+        Returns:
+            是否合并了其他进程的写入（合并后本地快照需要重新加载）
+        """
+        async with self._file_lock:
+            generation = self._file_lock.generation()
+            sessions = snapshot.sessions
+            merged = self._file_generation is not None and generation != self._file_generation
+            if merged:
+                by_id = {s.get('id'): s for s in await self._read_data()}
+                for session_id in dirty:
+                    session = snapshot.by_id.get(session_id)
+                    if session is None:
+                        by_id.pop(session_id, None)
+                    else:
+                        by_id[session_id] = session
+                sessions = list(by_id.values())
+                logger.info(f"会话文件已被其他进程修改 (代数 {self._file_generation} → {generation})，合并 {len(dirty)} 个会话后写入")
+            
+            new_generation = await asyncio.to_thread(self._write_data, sessions)
+            # 合并写入时保留旧代数，下次读取时重新加载以获得其他进程的会话
+            self._file_generation = generation if merged else new_generation
+            return merged
+    
+    def _modified_externally(self) -> bool:
+        """其他进程是否在快照加载/上次写入之后改过会话文件（本进程写入期间不检查）"""
+        if self._file_generation is None or self._write_lock.locked():
+            return False
+        return self._file_lock.generation() != self._file_generation
+    
+    @staticmethod
+    def _same_session(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+        return (
+            a.get("version") == b.get("version")
+            and a.get("updated_at") == b.get("updated_at")
+            and len(a.get("messages", [])) == len(b.get("messages", []))
+        )
+    
     def _is_cache_valid(self) -> bool:
         """检查缓存是否有效"""
-        if self._cache is None or self._cache_time is None:
+        if self._snapshot is None or self._cache_time is None:
             return False
         
         return (datetime.now() - self._cache_time).total_seconds() < self._cache_ttl
     
-    async def load_sessions(self) -> List[Dict[str, Any]]:
-        """加载会话列表"""
+    @staticmethod
+    def _copy_session(session: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        写时复制：复制会话字典和消息列表（消息本身按引用共享）
+        
+        已发布快照中的消息不会被原地修改，因此共享消息对象是安全的
+        """
+        copied = dict(session)
+        if "messages" in copied:
+            copied["messages"] = list(copied["messages"])
+        return copied
+    
+    def session_lock(self, session_id: str):
+        """
+        获取会话级锁（async with 使用），同一会话的读-改-写串行执行，不同会话互不阻塞
+        
+        同时持有跨进程锁：共享模式下在获得锁后同步其他worker的写入；
+        文件模式下在获得锁后载入其他进程的写入，并在释放前等到本会话的修改落盘
+        """
+        lock = self._session_locks.get(session_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._session_locks[session_id] = lock
+        if self.backend is None:
+            return self._file_session_lock(lock, session_id)
+        return self._shared_session_lock(lock, session_id)
+    
+    @contextlib.asynccontextmanager
+    async def _file_session_lock(self, lock: asyncio.Lock, session_id: str):
+        async with contextlib.AsyncExitStack() as stack:
+            await stack.enter_async_context(lock)
+            await stack.enter_async_context(self._session_file_lock.hold(session_id))
+            await self._load_external_writes()
+            yield
+            
+            # sync模式下本会话的修改在发布时已经落盘
+            if self.durability == "sync" or not self._has_unpersisted():
+                return
+            version = self._snapshot.version
+            if self.durability == "async":
+                # 调用方不等待落盘，锁在后台提交完成后释放，其他进程获得锁时读到的一定是最新版本
+                task = asyncio.create_task(self._release_after_persist(stack.pop_all(), version))
+                self._deferred_releases.add(task)
+                task.add_done_callback(self._deferred_releases.discard)
+                task.add_done_callback(self._on_commit_done)
+                return
+            await self._wait_persisted(version)
+    
+    async def _release_after_persist(self, held: contextlib.AsyncExitStack, version: int):
+        async with held:
+            await self._wait_persisted(version)
+    
+    @contextlib.asynccontextmanager
+    async def _shared_session_lock(self, lock: asyncio.Lock, session_id: str):
+        async with lock:
+            async with self.backend.lock(f"lock:session:{session_id}", timeout=self.lock_timeout, wait=self.lock_timeout):
+                await self._sync(force=True)
+                yield
+    
+    def add_listener(self, listener: Callable[[Dict[str, Optional[Dict[str, Any]]]], None]):
+        """
+        注册会话变更监听器（如搜索索引）
+        
+        监听器在新快照发布后同步调用，参数为 会话ID → 新会话（None表示删除），不应执行耗时操作
+        """
+        self._listeners.append(listener)
+    
+    def _notify(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        for listener in self._listeners:
+            try:
+                listener(changes)
+            except Exception as e:
+                logger.error(f"会话变更监听器执行失败: {e}")
+    
+    def _has_unpersisted(self) -> bool:
+        """内存快照是否有尚未写入文件的版本"""
+        return self._snapshot is not None and self._persisted_version < self._snapshot.version
+    
+    async def snapshot(self) -> SessionSnapshot:
+        """获取当前会话快照（只读，零拷贝）"""
+        if self.backend is not None:
+            if self._snapshot is None:
+                await self._sync(force=True)
+            elif time.monotonic() - self._synced_at >= self.sync_interval:
+                await self._sync()
+            return self._snapshot
+        
+        snapshot = self._snapshot
+        if snapshot is not None and (self._is_cache_valid() or self._has_unpersisted()) and not self._modified_externally():
+            return snapshot
+        return await self._load_snapshot()
+    
+    async def _load_external_writes(self):
+        """
+        持有跨进程会话锁后载入其他进程的写入
+        
+        与 _modified_externally 不同，本进程写入期间同样检查：其他进程对该会话的修改必须在读-改-写之前载入
+        """
+        if self._snapshot is None or self._file_lock.generation() != self._file_generation:
+            await self._load_snapshot(force=True)
+    
+    async def _load_snapshot(self, force: bool = False) -> SessionSnapshot:
+        """从文件重新加载快照，尚未落盘的本地修改优先"""
+        changes: Dict[str, Optional[Dict[str, Any]]] = {}
         async with self._lock:
-            if self._is_cache_valid():
+            if not force and self._snapshot is not None and (self._is_cache_valid() or self._has_unpersisted()) and not self._modified_externally():
                 logger.debug("使用缓存数据")
-                return self._cache.copy()
+                return self._snapshot
             
+            generation = self._file_lock.generation()
             try:
                 data = await self._read_data()
-                
-                # 更新缓存
-                self._cache = data
-                self._cache_time = datetime.now()
-                
-                logger.info(f"加载了 {len(data)} 个会话")
-                return data
-                
             except Exception as e:
                 logger.error(f"加载会话失败: {e}")
-                return []
+                data = []
+            
+            by_id = {s.get('id'): s for s in data}
+            previous = self._snapshot.by_id if self._snapshot else None
+            if previous is not None:
+                # 尚未写入文件的本地修改优先；内容未变的会话沿用原对象
+                for session_id in self._dirty:
+                    if session_id in previous:
+                        by_id[session_id] = previous[session_id]
+                    else:
+                        by_id.pop(session_id, None)
+                for session_id, session in by_id.items():
+                    old = previous.get(session_id)
+                    if old is not None and (old is session or self._same_session(old, session)):
+                        by_id[session_id] = old
+                    else:
+                        changes[session_id] = session
+                changes.update({session_id: None for session_id in previous if session_id not in by_id})
+            
+            version = self._snapshot.version + 1 if self._snapshot else 1
+            self._snapshot = SessionSnapshot(version, by_id)
+            if not self._dirty:
+                self._persisted_version = version
+            self._file_generation = generation
+            self._cache_time = datetime.now()
+            self._rebuild_index(self._snapshot.sessions)
+            snapshot = self._snapshot
+            
+            logger.info(f"加载了 {len(by_id)} 个会话")
+        
+        if changes:
+            self._notify(changes)
+        return snapshot
     
-    async def save_sessions(self, sessions: List[Dict[str, Any]]):
-        """保存会话列表"""
-        async with self._lock:
-            try:
-                await self._write_data(sessions)
-                
-                # 更新缓存
-                self._cache = sessions.copy()
-                self._cache_time = datetime.now()
+    # ==================== 共享模式同步 ====================
+    
+    async def _sync(self, force: bool = False):
+        """
+        从共享后端同步其他worker的写入
+        
+        先读代数再读修订号：读取期间完成的提交会使代数继续增大，下次同步时一定会被发现
+        """
+        async with self._sync_lock:
+            if not force and self._snapshot is not None and time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            
+            generation = int(await self.backend.get("sessions:generation") or 0)
+            self._synced_at = time.monotonic()
+            if self._snapshot is None:
+                if generation == 0:
+                    generation = await self._migrate_file_to_backend()
+            elif generation == self._generation:
+                return
+            
+            remote = {session_id: int(rev) for session_id, rev in (await self.backend.hgetall("sessions:rev")).items()}
+            # 修订号全局递增，只取比本地更新的版本，避免覆盖本worker正在提交的写入
+            changed = [session_id for session_id, rev in remote.items() if rev > self._revisions.get(session_id, 0)]
+            values = await self.backend.hmget("sessions", changed)
+            
+            async with self._lock:
+                initial = self._snapshot is None
+                by_id = {} if initial else dict(self._snapshot.by_id)
+                changes: Dict[str, Optional[Dict[str, Any]]] = {}
+                for session_id, raw in zip(changed, values):
+                    # 本worker尚未提交的会话以本地版本为准；读取间隙被删除的会话留给下次同步
+                    if raw is None or session_id in self._dirty:
+                        continue
+                    by_id[session_id] = changes[session_id] = fast_json.loads(raw)
+                    self._revisions[session_id] = remote[session_id]
+                for session_id in [sid for sid in self._revisions if sid not in remote and sid not in self._dirty]:
+                    by_id.pop(session_id, None)
+                    self._revisions.pop(session_id)
+                    changes[session_id] = None
                 
-                logger.info(f"保存了 {len(sessions)} 个会话")
+                self._generation = generation
+                if not changes and not initial:
+                    return
                 
+                version = self._snapshot.version + 1 if self._snapshot else 1
+                self._snapshot = SessionSnapshot(version, by_id)
+                if not self._dirty:
+                    self._persisted_version = version
+                self._cache_time = datetime.now()
+                if initial or self._index is None:
+                    self._rebuild_index(self._snapshot.sessions)
+                else:
+                    for session_id, session in changes.items():
+                        if session is None:
+                            self._index_remove(session_id)
+                        else:
+                            self._index_put(self._summarize(session))
+            
+            if initial:
+                logger.info(f"从共享后端({self.backend.name})加载了 {len(by_id)} 个会话")
+            else:
+                logger.debug(f"同步了其他worker的 {len(changes)} 个会话变更 (代数 {generation})")
+                self._notify(changes)
+    
+    async def _migrate_file_to_backend(self) -> int:
+        """共享后端为空时导入本地会话文件（只由一个worker执行），返回导入后的代数"""
+        async with self.backend.lock("lock:sessions:migrate", timeout=self.lock_timeout, wait=self.lock_timeout):
+            generation = int(await self.backend.get("sessions:generation") or 0)
+            if generation or not self.db_file.exists():
+                return generation
+            
+            data = [s for s in await self._read_data() if s.get("id")]
+            if not data:
+                return generation
+            revision = await self.backend.incr("sessions:revision")
+            await self.backend.hupdate("sessions", {s["id"]: fast_json.dumpb(s, default=str) for s in data})
+            await self.backend.hupdate("sessions:rev", {s["id"]: str(revision).encode() for s in data})
+            generation = await self.backend.incr("sessions:generation")
+            logger.info(f"📦 已将 {len(data)} 个会话从 {self.db_file} 导入共享后端({self.backend.name})")
+            return generation
+    
+    async def _write_backend(self, snapshot: SessionSnapshot, dirty: set):
+        """
+        将变更的会话写入共享后端
+        
+        顺序为：分配修订号 → 写会话和修订号 → 递增代数，其他worker看到新代数时数据已经就绪
+        """
+        puts = {sid: fast_json.dumpb(snapshot.by_id[sid], default=str) for sid in dirty if sid in snapshot.by_id}
+        deletes = [sid for sid in dirty if sid not in snapshot.by_id]
+        revision = await self.backend.incr("sessions:revision")
+        await self.backend.hupdate("sessions", puts, deletes)
+        await self.backend.hupdate("sessions:rev", {sid: str(revision).encode() for sid in puts}, deletes)
+        generation = await self.backend.incr("sessions:generation")
+        
+        for session_id in puts:
+            self._revisions[session_id] = revision
+        for session_id in deletes:
+            self._revisions.pop(session_id, None)
+        # 期间没有其他worker提交时直接前进到新代数，否则留给下次同步
+        if generation == self._generation + 1:
+            self._generation = generation
+    
+    async def _publish(
+        self,
+        changes: Dict[str, Optional[Dict[str, Any]]],
+        archived: bool = False
+    ) -> SessionSnapshot:
+        """
+        基于当前快照发布新版本并持久化
+        
+        发布只在内存中切换快照，不等待文件写入，因此不同会话的写入互不阻塞；
+        随后的持久化会合并写入期间发布的所有版本
+        
+        Args:
+            changes: 会话ID → 新会话（None表示删除），新会话发布后不可再修改
+            archived: 会话在热存储与归档之间移动（移出的会话保留在摘要索引中，不通知监听器）
+        """
+        await self.snapshot()
+        async with self._lock:
+            by_id = dict(self._snapshot.by_id)
+            for session_id, session in changes.items():
+                if session is None:
+                    removed = by_id.pop(session_id, None)
+                    if archived and removed is not None and self._index is not None:
+                        self._index_put({**self._summarize(removed), "archived": True})
+                    else:
+                        self._index_remove(session_id)
+                else:
+                    by_id[session_id] = session
+                    if self._index is not None:
+                        self._index_put(self._summarize(session))
+                self._dirty.add(session_id)
+            
+            self._snapshot = SessionSnapshot(self._snapshot.version + 1, by_id)
+            self._cache_time = datetime.now()
+            snapshot = self._snapshot
+        
+        if not archived:
+            self._notify(changes)
+        await self._commit(snapshot.version)
+        return snapshot
+    
+    async def _commit(self, version: int):
+        """按持久化模式提交指定版本"""
+        # 共享模式下只写入变更的会话，且写入需在释放跨进程会话锁前对其他worker可见，因此立即提交；
+        # 并发的提交在写锁上排队时自然合并
+        if self.durability == "sync" or self.backend is not None:
+            await self._persist(version)
+            return
+        
+        self._ensure_commit_task()
+        if self.durability == "group":
+            await self._wait_persisted(version)
+    
+    async def _wait_persisted(self, version: int):
+        """等待指定版本由组提交任务落盘"""
+        task = self._ensure_commit_task()
+        # 提交任务可能在本版本发布前已开始写入，需等到本版本确实落盘
+        while self._persisted_version < version:
+            await asyncio.shield(task)
+            task = self._ensure_commit_task()
+    
+    def _ensure_commit_task(self) -> asyncio.Task:
+        """获取或创建后台组提交任务"""
+        if self._commit_task is None or self._commit_task.done():
+            self._commit_task = asyncio.create_task(self._group_commit())
+            self._commit_task.add_done_callback(self._on_commit_done)
+        return self._commit_task
+    
+    async def _group_commit(self):
+        """等待合并窗口后一次性写入窗口内发布的所有版本"""
+        while self._has_unpersisted():
+            await asyncio.sleep(self.group_commit_window)
+            await self._persist(self._snapshot.version)
+    
+    @staticmethod
+    def _on_commit_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            logger.error(f"后台提交会话失败: {task.exception()}")
+    
+    async def _persist(self, version: int):
+        """将不低于指定版本的快照写入文件，已被其他写入覆盖时直接返回"""
+        async with self._write_lock:
+            if self._persisted_version >= version:
+                return
+            
+            snapshot = self._snapshot
+            dirty, self._dirty = self._dirty, set()
+            start_time = time.perf_counter()
+            try:
+                merged = False
+                if self.backend is not None:
+                    await self._write_backend(snapshot, dirty)
+                else:
+                    merged = await self._write_file(snapshot, dirty)
             except Exception as e:
+                self._dirty |= dirty
                 logger.error(f"保存会话失败: {e}")
                 raise
+            
+            latency = time.perf_counter() - start_time
+            metrics_collector.record_commit(
+                sessions=len(dirty),
+                versions=snapshot.version - self._persisted_version,
+                latency=latency,
+                mode=self.durability
+            )
+            
+            self._persisted_version = snapshot.version
+            if merged:
+                # 本地索引缺少其他进程的会话，重新加载快照时重建
+                self._index = None
+            else:
+                if self._index is None:
+                    self._rebuild_index(snapshot.sessions)
+                await self._write_index()
+            
+            logger.debug(f"保存了 {len(snapshot.by_id)} 个会话 (版本 {snapshot.version}, 合并 {len(dirty)} 个会话, {latency * 1000:.1f}ms)")
+    
+    async def flush(self):
+        """等待所有已发布的版本落盘（关闭时调用）"""
+        if self._commit_task and not self._commit_task.done():
+            try:
+                await self._commit_task
+            except Exception:
+                pass
+        if self._deferred_releases:
+            await asyncio.gather(*self._deferred_releases, return_exceptions=True)
+        if self._has_unpersisted():
+            await self._persist(self._snapshot.version)
+            logger.info("💾 会话数据已全部写入磁盘")
+    
+    async def load_sessions(self) -> List[Dict[str, Any]]:
+        """
+        加载会话列表
+        
+        返回的会话字典来自共享快照，只能读取；需要修改时使用get_session_by_id或modify_session
+        """
+        snapshot = await self.snapshot()
+        return list(snapshot.sessions)
+    
+    async def save_sessions(self, sessions: List[Dict[str, Any]]):
+        """整体替换会话列表"""
+        await self.snapshot()
+        async with self._lock:
+            previous = self._snapshot.by_id
+            self._snapshot = SessionSnapshot(
+                self._snapshot.version + 1,
+                {s.get('id'): self._copy_session(s) for s in sessions}
+            )
+            self._cache_time = datetime.now()
+            self._rebuild_index(self._snapshot.sessions)
+            version = self._snapshot.version
+            
+            changes: Dict[str, Optional[Dict[str, Any]]] = dict(self._snapshot.by_id)
+            changes.update({session_id: None for session_id in previous if session_id not in changes})
+            self._dirty.update(changes)
+        
+        self._notify(changes)
+        await self._commit(version)
+    
+    async def get_session_view(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """获取会话的只读视图（零拷贝，调用方不得修改），已归档的会话自动恢复到热存储"""
+        return await self._session_view(session_id, locked=False)
+    
+    async def _session_view(self, session_id: str, locked: bool) -> Optional[Dict[str, Any]]:
+        """locked 表示调用方已持有该会话的会话锁（会话锁不可重入）"""
+        snapshot = await self.snapshot()
+        session = snapshot.by_id.get(session_id)
+        if session is None and self.archive is not None and self.archive.contains(session_id):
+            if locked:
+                session = await self._rehydrate(session_id)
+            else:
+                async with self.session_lock(session_id):
+                    session = await self._rehydrate(session_id)
+        return session
+    
+    async def _rehydrate(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """
+        将归档会话恢复到热存储（须持有该会话的会话锁）
+        
+        记录恢复时间，下一轮归档按恢复时间判断是否活跃，不会立即再次归档
+        """
+        # 等锁期间其他请求已恢复或写入该会话时以热存储中的版本为准
+        current = self._snapshot.by_id.get(session_id)
+        if current is not None or not self.archive.contains(session_id):
+            return current
+        
+        session = await self.archive.get(session_id)
+        if session is None:
+            return None
+        session = {**session, "rehydrated_at": datetime.now().isoformat()}
+        
+        await self._publish({session_id: session}, archived=True)
+        await self.archive.remove([session_id])
+        logger.info(f"📦 已从归档恢复会话: {session_id}")
+        return session
     
     async def get_session_by_id(self, session_id: str) -> Optional[Dict[str, Any]]:
-        """根据ID获取会话"""
-        sessions = await self.load_sessions()
-        for session in sessions:
-            if session.get('id') == session_id:
-                return session
+        """根据ID获取会话的可修改副本"""
+        session = await self.get_session_view(session_id)
+        return self._copy_session(session) if session else None
+    
+    async def get_session_messages(
+        self,
+        session_id: str,
+        before: Optional[int] = None,
+        after: Optional[int] = None,
+        limit: int = 100
+    ) -> Optional[Dict[str, Any]]:
+        """
+        按位置分页读取会话消息
+        
+        Args:
+            session_id: 会话ID
+            before: 返回该位置之前的消息（不含）
+            after: 返回该位置之后的消息（不含）
+            limit: 最多返回的消息数
+        
+        Returns:
+            {"session": 不含消息的会话信息, "messages": 消息切片, "start": 切片起始位置, "total": 消息总数}，
+            会话不存在时返回None。before/after均未提供时返回最新的一页
+        """
+        session = await self.get_session_view(session_id)
+        if not session:
+            return None
+        
+        messages = session.get("messages", [])
+        total = len(messages)
+        if after is not None:
+            start = min(max(after + 1, 0), total)
+            end = min(start + limit, total)
+        else:
+            end = total if before is None else min(max(before, 0), total)
+            start = max(0, end - limit)
+        
+        return {
+            "session": {k: v for k, v in session.items() if k != "messages"},
+            "messages": messages[start:end],
+            "start": start,
+            "total": total
+        }
+    
+    async def get_session_message(self, session_id: str, message_id: str) -> Optional[Dict[str, Any]]:
+        """根据ID获取会话中的单条完整消息"""
+        session = await self.get_session_view(session_id)
+        if not session:
+            return None
+        for message in session.get("messages", []):
+            if message.get("id") == message_id:
+                return message
         return None
     
+    @staticmethod
+    def _merge_session(current: Dict[str, Any], incoming: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        合并基于旧版本修改的会话：以调用方的字段为准，消息按ID合并追加
+        
+        其他写入者在此期间追加的消息被保留，调用方新增或修改的消息覆盖同ID消息
+        """
+        merged = dict(incoming)
+        incoming_messages = {m.get("id"): m for m in incoming.get("messages", []) if m.get("id")}
+        
+        messages = []
+        seen = set()
+        legacy = []  # 无ID的旧消息按内容比较
+        for message in current.get("messages", []):
+            message_id = message.get("id")
+            if message_id:
+                messages.append(incoming_messages.get(message_id, message))
+                seen.add(message_id)
+            else:
+                messages.append(message)
+                legacy.append(message)
+        messages.extend(
+            m for m in incoming.get("messages", [])
+            if (m.get("id") not in seen if m.get("id") else m not in legacy)
+        )
+        merged["messages"] = messages
+        
+        # 保留覆盖范围更大的摘要和较新的更新时间
+        current_digest = current.get("digest") or {}
+        if current_digest.get("message_count", 0) > (incoming.get("digest") or {}).get("message_count", 0):
+            merged["digest"] = current_digest
+        merged["updated_at"] = max(str(current.get("updated_at") or ""), str(incoming.get("updated_at") or "")) or None
+        return merged
+    
     async def update_session(self, session: Dict[str, Any]):
-        """更新单个会话"""
-        sessions = await self.load_sessions()
-        for i, s in enumerate(sessions):
-            if s.get('id') == session.get('id'):
-                sessions[i] = session
-                await self.save_sessions(sessions)
-                return
+        """
+        更新单个会话（不存在时新建）
+        
+        采用乐观版本控制：会话携带读取时的version，若期间已有其他写入，则与最新版本合并而不是覆盖。
+        写入后调用方会话的消息和version同步为新版本
+        """
+        session_id = session.get('id')
+        async with self.session_lock(session_id):
+            current = await self._session_view(session_id, locked=True)
+            updated = self._copy_session(session)
+            
+            if current is not None:
+                current_version = current.get("version", 0)
+                if session.get("version", current_version) != current_version:
+                    logger.info(f"会话 {session_id} 存在并发写入 (v{session.get('version')} → v{current_version})，合并消息")
+                    updated = self._merge_session(current, updated)
+                updated["version"] = current_version + 1
+            else:
+                updated["version"] = 1
+            
+            await self._publish({session_id: updated})
+            
+            # 调用方副本同步为合并后的版本，后续写入无需再次合并
+            session["messages"] = list(updated.get("messages", []))
+            session["version"] = updated["version"]
+    
+    async def upsert_sessions(self, sessions: List[Dict[str, Any]]) -> int:
+        """
+        批量幂等写入会话（用于导入）
+        
+        已存在的会话与导入数据按消息ID合并，同一批次在一次快照发布中提交
+        
+        Returns:
+            写入的会话数量
+        """
+        incoming_by_id = {s["id"]: s for s in sessions if s.get("id")}
+        if not incoming_by_id:
+            return 0
+        
+        # 已归档的会话先恢复，再与导入数据合并
+        if self.archive is not None:
+            for session_id in incoming_by_id:
+                if self.archive.contains(session_id):
+                    await self.get_session_view(session_id)
+        
+        await self.snapshot()
+        async with contextlib.AsyncExitStack() as stack:
+            for session_id in sorted(incoming_by_id):
+                await stack.enter_async_context(self.session_lock(session_id))
+            
+            changes = {}
+            for session_id, incoming in incoming_by_id.items():
+                current = self._snapshot.by_id.get(session_id)
+                updated = self._copy_session(incoming)
+                if current is not None:
+                    updated = self._merge_session(current, updated)
+                    updated["version"] = current.get("version", 0) + 1
+                else:
+                    updated["version"] = incoming.get("version") or 1
+                changes[session_id] = updated
+            
+            await self._publish(changes)
+        return len(changes)
+    
+    def archived_reader(self, exclude: Collection[str] = ()) -> Optional[Callable[[], Any]]:
+        """
+        返回按当前归档索引逐个读取归档会话的异步生成器函数
+        
+        索引在调用时固定，之后恢复或新归档的会话不影响本次读取
+        
+        Args:
+            exclude: 跳过的会话ID；与快照一起获取时传入快照中的会话，
+                     归档或恢复进行到一半、同时存在于两处的会话只导出一次
+        """
+        if self.archive is None:
+            return None
+        entries = [entry for session_id, entry in self.archive.entries().items() if session_id not in exclude]
+        
+        async def read_all():
+            for entry in entries:
+                try:
+                    yield await self.archive.read_entry(entry)
+                except Exception as e:
+                    logger.error(f"读取归档会话失败 ({entry.get('id')}): {e}")
+        
+        return read_all
+    
+    async def modify_session(
+        self,
+        session_id: str,
+        mutator: Callable[[Dict[str, Any]], Any],
+        default: Optional[Callable[[], Dict[str, Any]]] = None
+    ) -> Optional[Dict[str, Any]]:
+        """
+        在会话锁内对最新版本执行读-改-写
+        
+        Args:
+            session_id: 会话ID
+            mutator: 接收会话副本并原地修改的函数（可为协程函数）
+            default: 会话不存在时创建初始会话的函数，未提供时直接返回None
         
-        # 如果不存在，添加新会话
-        sessions.append(session)
-        await self.save_sessions(sessions)
+        Returns:
+            修改后会话的副本
+        """
+        async with self.session_lock(session_id):
+            current = await self._session_view(session_id, locked=True)
+            if current is None:
+                if default is None:
+                    return None
+                current = default()
+            
+            working = self._copy_session(current)
+            result = mutator(working)
+            if inspect.isawaitable(result):
+                await result
+            working["version"] = current.get("version", 0) + 1
+            
+            await self._publish({session_id: working})
+            return self._copy_session(working)
     
     async def delete_session(self, session_id: str) -> bool:
         """删除会话"""
-        sessions = await self.load_sessions()
-        original_count = len(sessions)
-        sessions = [s for s in sessions if s.get('id') != session_id]
+        async with self.session_lock(session_id):
+            if await self._session_view(session_id, locked=True) is None:
+                return False
+            await self._publish({session_id: None})
         
-        if len(sessions) < original_count:
-            await self.save_sessions(sessions)
-            logger.info(f"删除会话: {session_id}")
-            return True
-        return False
+        logger.info(f"删除会话: {session_id}")
+        return True
+    
+    @staticmethod
+    def _is_inactive(session: Dict[str, Any], cutoff_date: datetime) -> bool:
+        """会话最后更新（或从归档恢复）时间早于截止时间（时间缺失或无法解析也视为不活跃）"""
+        for key in ('updated_at', 'rehydrated_at'):
+            value = session.get(key)
+            if not value:
+                continue
+            if isinstance(value, str):
+                try:
+                    value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+                except ValueError:
+                    continue
+            if value.replace(tzinfo=None) > cutoff_date:
+                return False
+        return True
     
     async def cleanup_old_sessions(self, days: int = 30):
         """清理旧会话"""
         sessions = await self.load_sessions()
         cutoff_date = datetime.now() - timedelta(days=days)
         
-        active_sessions = []
-        for s in sessions:
-            updated_at = s.get('updated_at')
-            if updated_at:
-                if isinstance(updated_at, str):
-                    try:
-                        updated_at = datetime.fromisoformat(updated_at.replace('Z', '+00:00'))
-                    except:
-                        continue
-                if updated_at > cutoff_date:
-                    active_sessions.append(s)
+        expired = [s.get('id') for s in sessions if self._is_inactive(s, cutoff_date)]
+        if expired:
+            await self._publish({session_id: None for session_id in expired})
+            logger.info(f"清理了 {len(expired)} 个旧会话")
+    
+    async def archive_inactive_sessions(self, days: int = 30) -> int:
+        """
+        将超过指定天数未更新的会话移入归档
         
-        if len(active_sessions) < len(sessions):
-            await self.save_sessions(active_sessions)
-            removed_count = len(sessions) - len(active_sessions)
-            logger.info(f"清理了 {removed_count} 个旧会话")
+        会话先写入归档并落盘，再在会话锁内确认期间未被修改后从热存储移除
+        
+        Returns:
+            归档的会话数量
+        """
+        if self.archive is None:
+            return 0
+        
+        snapshot = await self.snapshot()
+        cutoff_date = datetime.now() - timedelta(days=days)
+        candidates = [s for s in snapshot.sessions if self._is_inactive(s, cutoff_date)]
+        if not candidates:
+            return 0
+        
+        await self.archive.archive(candidates)
+        
+        async with contextlib.AsyncExitStack() as stack:
+            for session_id in sorted(s["id"] for s in candidates):
+                await stack.enter_async_context(self.session_lock(session_id))
+            
+            # 快照中的会话不可变，对象未变说明归档期间没有新的写入
+            current = self._snapshot.by_id
+            moved = [s["id"] for s in candidates if current.get(s["id"]) is s]
+            stale = [s["id"] for s in candidates if current.get(s["id"]) is not s]
+            if stale:
+                await self.archive.remove(stale)
+            if moved:
+                await self._publish({session_id: None for session_id in moved}, archived=True)
+        
+        logger.info(f"📦 已归档 {len(moved)} 个不活跃会话")
+        return len(moved)
+    
+    async def archive_periodically(self, days: int, interval_seconds: float):
+        """后台定期归档不活跃会话"""
+        while True:
+            try:
+                await self.archive_inactive_sessions(days)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"归档会话失败: {e}")
+            await asyncio.sleep(interval_seconds)
+    
+    def archived_session_ids(self) -> set:
+        """已归档的会话ID"""
+        if self.archive is None:
+            return set()
+        return {summary["id"] for summary in self.archive.summaries()}
     
     def invalidate_cache(self):
         """使缓存失效"""
-        self._cache = None
         self._cache_time = None
+        self._index = None
+        self._synced_at = 0.0
+    
+    # ==================== 会话摘要索引 ====================
+    
+    @staticmethod
+    def _summarize(session: Dict[str, Any]) -> Dict[str, Any]:
+        """提取会话摘要（不含消息内容）"""
+        return {
+            "id": session.get("id"),
+            "title": session.get("title"),
+            "created_at": session.get("created_at"),
+            "updated_at": session.get("updated_at"),
+            "message_count": len(session.get("messages", [])),
+            "is_discussion": bool(session.get("is_discussion"))
+        }
+    
+    @staticmethod
+    def _order_key(summary: Dict[str, Any]) -> Tuple[str, str]:
+        return (str(summary.get("updated_at") or ""), str(summary.get("id") or ""))
+    
+    def _rebuild_index(self, sessions: List[Dict[str, Any]]):
+        """根据完整会话列表重建摘要索引"""
+        self._index = {}
+        if self.archive is not None:
+            for summary in self.archive.summaries():
+                self._index[summary["id"]] = summary
+        for session in sessions:
+            summary = self._summarize(session)
+            self._index[summary["id"]] = summary
+        self._index_order = sorted(self._order_key(s) for s in self._index.values())
+    
+    def _index_put(self, summary: Dict[str, Any]):
+        """增量插入或更新一条摘要"""
+        old = self._index.get(summary["id"])
+        if old is not None:
+            self._index_order_remove(self._order_key(old))
+        self._index[summary["id"]] = summary
+        bisect.insort(self._index_order, self._order_key(summary))
+    
+    def _index_remove(self, session_id: str):
+        """从索引中移除一条摘要"""
+        if self._index is None:
+            return
+        old = self._index.pop(session_id, None)
+        if old is not None:
+            self._index_order_remove(self._order_key(old))
+    
+    def _index_order_remove(self, key: Tuple[str, str]):
+        pos = bisect.bisect_left(self._index_order, key)
+        if pos < len(self._index_order) and self._index_order[pos] == key:
+            del self._index_order[pos]
+    
+    def _source_signature(self) -> Optional[Dict[str, int]]:
+        """数据文件签名，用于判断索引文件是否过期"""
+        try:
+            stat = self.db_file.stat()
+            return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+        except FileNotFoundError:
+            return None
+    
+    async def _write_index(self):
+        """持久化摘要索引，冷启动时列表接口无需解析消息内容（共享模式下索引由同步维护，不写文件）"""
+        if self.backend is not None:
+            return
+        try:
+            payload = {
+                "source": self._source_signature(),
+                "generation": self._file_generation or 0,  # 索引对应的数据文件代数，其他进程之后写过文件时作废
+                "sessions": list(self._index.values())
+            }
+            await asyncio.to_thread(atomic_write, self.index_file, fast_json.dumpb(payload, default=str))
+        except Exception as e:
+            logger.warning(f"写入会话索引失败: {e}")
+    
+    async def _ensure_index(self):
+        """确保摘要索引已加载且包含其他进程的写入：优先使用未过期的索引文件，否则从会话数据重建"""
+        if self._index is not None:
+            if not self._modified_externally():
+                return
+            # 重新加载快照时索引随之重建
+            await self.snapshot()
+            if self._index is not None:
+                return
+        
+        try:
+            if self.backend is None and self.index_file.exists():
+                async with aiofiles.open(self.index_file, 'r', encoding='utf-8') as f:
+                    payload = fast_json.loads(await f.read())
+                if (
+                    payload.get("source")
+                    and payload["source"] == self._source_signature()
+                    and payload.get("generation", 0) == self._file_lock.generation()
+                ):
+                    self._index = {s["id"]: s for s in payload.get("sessions", [])}
+                    self._index_order = sorted(self._order_key(s) for s in self._index.values())
+                    if self._file_generation is None:
+                        # 尚未加载快照时以索引对应的代数判断其他进程之后的写入
+                        self._file_generation = payload.get("generation", 0)
+                    return
+        except Exception as e:
+            logger.warning(f"读取会话索引失败，将重建: {e}")
+        
+        sessions = await self.load_sessions()
+        if self._index is None:
+            self._rebuild_index(sessions)
+        await self._write_index()
+    
+    @staticmethod
+    def encode_cursor(key: Tuple[str, str]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+    
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, str]:
+        updated_at, session_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        return (str(updated_at), str(session_id))
+    
+    async def list_session_summaries(
+        self,
+        limit: int = 50,
+        cursor: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        按更新时间降序分页获取会话摘要
+        
+        Args:
+            limit: 每页数量
+            cursor: 上一页返回的游标
+        
+        Returns:
+            (摘要列表, 下一页游标)，没有更多数据时游标为None
+        """
+        await self._ensure_index()
+        
+        # 游标之前（更旧）的位置
+        end = len(self._index_order)
+        if cursor:
+            end = bisect.bisect_left(self._index_order, self.decode_cursor(cursor))
+        start = max(0, end - limit)
+        
+        keys = self._index_order[start:end][::-1]
+        page = [dict(self._index[session_id]) for _, session_id in keys]
+        next_cursor = self.encode_cursor(keys[-1]) if start > 0 and keys else None
+        return page, next_cursor
 
 # 全局数据库管理器
-db_manager = DatabaseManager()
+db_manager = DatabaseManager(
+    durability=config.DB_DURABILITY,
+    group_commit_ms=config.DB_GROUP_COMMIT_MS,
+    # 归档索引只在各自进程内维护，共享后端下不启用归档
+    archive=SessionArchive(config.ARCHIVE_DIR) if config.ARCHIVE_ENABLED and not state_backend.shared else None,
+    backend=state_backend,
+    sync_interval_ms=config.STATE_SYNC_INTERVAL_MS,
+    lock_timeout=config.STATE_LOCK_TIMEOUT_SECONDS
+)
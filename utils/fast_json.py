@@ -0,0 +1,38 @@
+"""
+JSON序列化模块
+安装了 orjson 时在热点路径（流式事件、会话存储、导入导出、归档）使用 orjson，否则回退到标准库 json；
+两种实现的输出都不转义非ASCII字符，可互相解析
+"""
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖
+    orjson = None
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+# orjson.JSONDecodeError 继承自 json.JSONDecodeError，调用方统一捕获后者即可
+JSONDecodeError = json.JSONDecodeError
+
+def dumpb(obj: Any, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> bytes:
+    """序列化为UTF-8字节"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=default, option=option)
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, default=default).encode("utf-8")
+
+def dumps(obj: Any, indent: bool = False, default: Optional[Callable[[Any], Any]] = None) -> str:
+    """序列化为字符串"""
+    if orjson is not None:
+        return dumpb(obj, indent=indent, default=default).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2 if indent else None, default=default)
+
+def loads(data: Union[str, bytes]) -> Any:
+    """解析JSON字符串或字节"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -1,8 +1,11 @@
 """
 文件处理工具
+pdfplumber、python-docx 体积较大，只在首次处理对应类型的文件时导入；
+解析（包括首次导入）在线程中执行，不阻塞事件循环
 """
 import os
 import base64
+import asyncio
 from typing import Dict, Optional
 from utils.logger import app_logger
 
@@ -18,6 +21,9 @@ async def process_uploaded_file(file_path: str, file_type: str, filename: str) -
     Returns:
         包含文件信息和处理后内容的字典
     """
+    return await asyncio.to_thread(_process_file, file_path, file_type, filename)
+
+def _process_file(file_path: str, file_type: str, filename: str) -> Dict:
     result = {
         "filename": filename,
         "file_type": file_type,
@@ -0,0 +1,284 @@
+"""
+文件存储模块
+多个进程（多个uvicorn worker、维护脚本）同时读写同一个JSON文件时的安全保证：
+写入先落到唯一命名的临时文件并 fsync，再原子替换；读-改-写期间持有基于 fcntl.flock 的跨进程锁；
+锁文件中记录代数，每次写入递增，进程内缓存据此发现其他进程的修改
+"""
+import os
+import asyncio
+import hashlib
+import tempfile
+import threading
+import contextlib
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+from utils import fast_json
+
+try:
+    import fcntl
+except ImportError:  # Windows 无 fcntl，退化为进程内锁
+    fcntl = None
+
+_GENERATION_WIDTH = 20
+
+# 进程的 umask 只能通过设置来读取，在导入时（主线程）读取一次，避免工作线程中临时改动全局 umask
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def atomic_write(path: Union[str, Path], data: bytes):
+    """
+    原子写入文件：临时文件与目标在同一目录且名称唯一，写入并 fsync 后替换目标，
+    再 fsync 目录使替换本身落盘。读者看到的只会是旧文件或完整的新文件；文件权限与原文件一致
+    """
+    path = Path(path)
+    fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        os.fchmod(fd, _file_mode(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(temp_path)
+        raise
+    fsync_dir(path.parent)
+
+def _file_mode(path: Path) -> int:
+    """已有文件沿用其权限，新文件按 umask 取默认权限（mkstemp 创建的临时文件固定为0600）"""
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+def fsync_dir(directory: Union[str, Path]):
+    """fsync 目录，使其中的创建、替换和删除落盘（不支持的平台上忽略）"""
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def try_lock_fd(fd: int) -> bool:
+    """非阻塞地对已打开的文件加排他锁，已被其他进程持有时返回False"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+class FileLock:
+    """
+    数据文件的跨进程锁和代数计数
+    
+    锁加在旁边的 <文件名>.lock 上（数据文件会被原子替换，不能直接加锁）；
+    每次获取锁都重新打开锁文件，同一进程内的不同持有者之间同样互斥。
+    异步获取时先经过进程内的 asyncio.Lock，只有一个线程阻塞在 flock 上
+    """
+    
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self._thread_lock = threading.Lock()
+        self._async_lock: Optional[asyncio.Lock] = None
+        self._fd: Optional[int] = None
+    
+    def acquire(self):
+        self._thread_lock.acquire()
+        try:
+            self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            self._fd = fd
+        except BaseException:
+            self._thread_lock.release()
+            raise
+    
+    def release(self):
+        fd, self._fd = self._fd, None
+        try:
+            if fd is not None:
+                os.close(fd)  # 关闭即释放flock
+        finally:
+            self._thread_lock.release()
+    
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc):
+        self.release()
+    
+    async def __aenter__(self) -> "FileLock":
+        if self._async_lock is None:
+            self._async_lock = asyncio.Lock()
+        await self._async_lock.acquire()
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.acquire))
+        try:
+            await asyncio.shield(acquiring)
+        except BaseException:
+            # 等待期间被取消时线程仍可能拿到锁，拿到后立即释放
+            acquiring.add_done_callback(self._release_abandoned)
+            raise
+        return self
+    
+    def _release_abandoned(self, acquiring: asyncio.Future):
+        try:
+            if not acquiring.cancelled() and acquiring.exception() is None:
+                self.release()
+        finally:
+            self._async_lock.release()
+    
+    async def __aexit__(self, *exc):
+        try:
+            self.release()
+        finally:
+            self._async_lock.release()
+    
+    def generation(self) -> int:
+        """当前代数（不需要持有锁；锁文件不存在时为0）"""
+        try:
+            with open(self.lock_path, 'rb') as f:
+                raw = f.read(_GENERATION_WIDTH)
+        except FileNotFoundError:
+            return 0
+        try:
+            return int(raw)
+        except ValueError:
+            return 0
+    
+    def bump(self) -> int:
+        """代数加一并返回新值（须持有锁）；定长覆盖写，并发读取不会读到半截数字"""
+        generation = self.generation() + 1
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, str(generation).zfill(_GENERATION_WIDTH).encode())
+        return generation
+
+class KeyedFileLock:
+    """
+    按键区分的跨进程锁（如会话锁）
+    
+    所有键共用一个锁文件，每个键按哈希锁住文件中的一个字节（fcntl.lockf 记录锁），
+    不同键互不阻塞，也不需要为每个键创建文件。记录锁归属于进程：同一进程内同一键的互斥由调用方的进程内锁保证；
+    进程关闭该文件的任意描述符都会释放其全部记录锁，因此锁文件只由本类打开
+    """
+    
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._fd: Optional[int] = None
+        self._pid: Optional[int] = None
+    
+    @staticmethod
+    def _offset(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=7).digest(), 'big')
+    
+    def _open(self) -> int:
+        # fork 出的子进程不继承记录锁，使用自己打开的描述符
+        if self._fd is None or self._pid != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+    
+    def acquire(self, key: str, blocking: bool = True) -> bool:
+        flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+        try:
+            fcntl.lockf(self._open(), flags, 1, self._offset(key), os.SEEK_SET)
+            return True
+        except (BlockingIOError, PermissionError):
+            return False
+    
+    def release(self, key: str):
+        fcntl.lockf(self._open(), fcntl.LOCK_UN, 1, self._offset(key), os.SEEK_SET)
+    
+    @contextlib.asynccontextmanager
+    async def hold(self, key: str):
+        """持有指定键的锁（async with 使用）；未被争用时直接获得，否则在线程中等待"""
+        if fcntl is None:
+            yield
+            return
+        
+        if not self.acquire(key, blocking=False):
+            acquiring = asyncio.ensure_future(asyncio.to_thread(self.acquire, key))
+            try:
+                await asyncio.shield(acquiring)
+            except BaseException:
+                # 等待期间被取消时线程仍可能拿到锁，拿到后立即释放
+                acquiring.add_done_callback(
+                    lambda future: future.cancelled() or future.exception() is not None or self.release(key)
+                )
+                raise
+        try:
+            yield
+        finally:
+            self.release(key)
+
+class JsonFileStore:
+    """
+    跨进程安全的JSON文件
+    
+    load() 按代数和文件签名缓存解析结果（返回共享对象，只读），手工编辑文件同样会使缓存失效；
+    modify() 在锁内读取最新内容、修改并原子写回
+    """
+    
+    def __init__(self, path: Union[str, Path], indent: bool = True):
+        self.path = Path(path)
+        self.indent = indent
+        self.lock = FileLock(self.path)
+        self._cache: Any = None
+        self._cache_key: Optional[tuple] = None
+    
+    def _read(self, default: Callable[[], Any]) -> Any:
+        try:
+            content = self.path.read_bytes()
+        except FileNotFoundError:
+            return default()
+        return fast_json.loads(content) if content.strip() else default()
+    
+    def _write(self, data: Any):
+        atomic_write(self.path, fast_json.dumpb(data, indent=self.indent, default=str))
+        self.lock.bump()
+    
+    def _cache_key_now(self) -> tuple:
+        try:
+            stat = self.path.stat()
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            signature = None
+        return (self.lock.generation(), signature)
+    
+    async def load(self, default: Callable[[], Any] = list) -> Any:
+        """读取文件内容，未被修改时直接返回缓存（调用方不得修改）"""
+        key = self._cache_key_now()
+        if self._cache_key != key:
+            self._cache = await asyncio.to_thread(self._read, default)
+            self._cache_key = key
+        return self._cache
+    
+    async def modify(self, mutator: Callable[[Any], Any], default: Callable[[], Any] = list) -> Any:
+        """
+        在跨进程锁内读-改-写
+        
+        Args:
+            mutator: 接收最新内容（新解析的对象，可原地修改）的函数，返回值原样返回给调用方
+            default: 文件不存在或为空时的初始内容
+        
+        Returns:
+            mutator 的返回值
+        """
+        async with self.lock:
+            data = await asyncio.to_thread(self._read, default)
+            result = mutator(data)
+            await asyncio.to_thread(self._write, data)
+            self._cache = None
+            self._cache_key = None
+        return result
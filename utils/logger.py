@@ -1,27 +1,171 @@
 """
 日志配置模块
+业务代码只把日志记录放入队列，由后台线程统一格式化并写入控制台和文件，事件循环中不做同步磁盘写入；
+文件日志为每行一条的JSON记录，单进程时按时间或大小轮转，多进程时由外部工具轮转
 """
-import logging
+import os
 import sys
+import copy
+import queue
+import atexit
+import threading
+import random
+import logging
+import logging.handlers
 from datetime import datetime
 from pathlib import Path
+from typing import Optional
 from config import config
+from utils import fast_json
+
+# LogRecord 自带的属性，其余属性视为通过 extra 传入的结构化字段
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "sample"}
+
+class JsonFormatter(logging.Formatter):
+    """每条记录输出为一行JSON，extra 传入的字段原样保留"""
+    
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            "module": record.module,
+            "line": record.lineno,
+            "thread": record.threadName
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return fast_json.dumps(entry, default=str)
+
+class PayloadSamplingFilter(logging.Filter):
+    """
+    按比例采样标记为大段调试信息的记录（extra={"sample": True}，如请求消息结构），
+    其余记录全部保留
+    """
+    
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False) or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    在调用线程里只做必要的准备：合并消息参数、把异常渲染为文本，
+    保留 extra 字段和 exc_text，格式化交给后台线程
+    
+    后台线程由各worker在 lifespan 中调用 start_logging() 启动（导入时不创建线程，fork 出的子进程也不继承）；
+    本进程尚未启动线程时（导入阶段、fork 之后 lifespan 之前、命令行脚本）直接同步写入，记录不会积压在没有消费者的队列里
+    """
+    
+    def emit(self, record: logging.LogRecord):
+        if _listener_pid == os.getpid():
+            super().emit(record)
+            return
+        for handler in _handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+    
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _rotation_mode() -> str:
+    """
+    轮转方式：time / size 由进程自己轮转，只适合单进程；
+    external 不在进程内轮转（交给 logrotate 等外部工具），文件被移走后自动重新打开，多个worker可安全追加同一文件。
+    auto 在单进程部署（STATE_BACKEND=memory）时为 time，多worker部署时为 external
+    """
+    if config.LOG_ROTATION != "auto":
+        return config.LOG_ROTATION
+    return "time" if config.STATE_BACKEND == "memory" else "external"
+
+def _file_handler(path: Path) -> logging.Handler:
+    mode = _rotation_mode()
+    if mode == "external":
+        return logging.handlers.WatchedFileHandler(path, encoding='utf-8', delay=True)
+    if mode == "size":
+        return logging.handlers.RotatingFileHandler(
+            path,
+            maxBytes=config.LOG_MAX_BYTES,
+            backupCount=config.LOG_BACKUP_COUNT,
+            encoding='utf-8',
+            delay=True
+        )
+    return logging.handlers.TimedRotatingFileHandler(
+        path,
+        when="midnight",
+        backupCount=config.LOG_BACKUP_COUNT,
+        encoding='utf-8',
+        delay=True
+    )
+
+_queue_handler: Optional[_QueueHandler] = None
+_handlers: tuple = ()
+_listener: Optional[logging.handlers.QueueListener] = None
+_listener_pid: Optional[int] = None
+_listener_lock = threading.Lock()
+
+def start_logging():
+    """在当前进程启动后台写日志线程（已启动时不做任何事）"""
+    global _listener, _listener_pid
+    with _listener_lock:
+        if _listener_pid == os.getpid() or _queue_handler is None:
+            return
+        # 使用新队列：fork 前父进程队列中的记录由父进程自己写出，子进程不重复写
+        _queue_handler.queue = queue.SimpleQueue()
+        _listener = logging.handlers.QueueListener(_queue_handler.queue, *_handlers, respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+def _after_fork_in_child():
+    """子进程中没有父进程的写日志线程，标记为未启动，由子进程自己的 lifespan 重新启动"""
+    global _listener, _listener_pid, _listener_lock
+    _listener = None
+    _listener_pid = None
+    _listener_lock = threading.Lock()
+
+def stop_logging():
+    """停止本进程的后台写日志线程（会先写完队列中剩余的记录）"""
+    global _listener, _listener_pid
+    if _listener is not None and _listener_pid == os.getpid():
+        _listener.stop()
+    _listener = None
+    _listener_pid = None
 
 def setup_logging():
     """设置日志配置"""
+    global _queue_handler, _handlers
+    stop_logging()
     
-    # 创建logs目录
-    log_dir = Path("logs")
+    # 创建日志目录
+    log_dir = Path(config.LOG_DIR)
     log_dir.mkdir(exist_ok=True)
     
-    # 日志格式
-    formatter = logging.Formatter(
+    # 日志格式：控制台为文本，文件按 LOG_FORMAT 选择JSON或文本
+    text_formatter = logging.Formatter(
         '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
+    file_formatter = JsonFormatter() if config.LOG_FORMAT == "json" else text_formatter
     
     # 根日志器配置
     root_logger = logging.getLogger()
-    root_logger.setLevel(logging.DEBUG if config.DEBUG else logging.INFO)
+    root_logger.setLevel(logging.DEBUG if config.DEBUG else config.LOG_LEVEL.upper())
     
     # 清除已有的处理器，避免重复添加
     if root_logger.handlers:
@@ -29,30 +173,24 @@ def setup_logging():
     
     # 控制台处理器
     console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(formatter)
+    console_handler.setFormatter(text_formatter)
     console_handler.setLevel(logging.INFO)
     
-    # 文件处理器
-    today = datetime.now().strftime("%Y-%m-%d")
-    file_handler = logging.FileHandler(
-        log_dir / f"app_{today}.log",
-        encoding='utf-8'
-    )
-    file_handler.setFormatter(formatter)
+    # 文件处理器（按时间或大小轮转）
+    file_handler = _file_handler(log_dir / "app.log")
+    file_handler.setFormatter(file_formatter)
     file_handler.setLevel(logging.DEBUG)
     
     # 错误文件处理器
-    error_handler = logging.FileHandler(
-        log_dir / f"error_{today}.log",
-        encoding='utf-8'
-    )
-    error_handler.setFormatter(formatter)
+    error_handler = _file_handler(log_dir / "error.log")
+    error_handler.setFormatter(file_formatter)
     error_handler.setLevel(logging.ERROR)
     
-    # 添加处理器到根日志器
-    root_logger.addHandler(console_handler)
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(error_handler)
+    # 根日志器只挂队列处理器，实际写入由后台线程完成
+    _handlers = (console_handler, file_handler, error_handler)
+    _queue_handler = _QueueHandler(queue.SimpleQueue())
+    _queue_handler.addFilter(PayloadSamplingFilter(config.LOG_PAYLOAD_SAMPLE_RATE))
+    root_logger.addHandler(_queue_handler)
     
     # 第三方库日志级别
     logging.getLogger("openai").setLevel(logging.WARNING)
@@ -61,6 +199,10 @@ def setup_logging():
     
     return root_logger
 
+# 进程退出前写完队列中的日志
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
 # 应用日志器
 app_logger = logging.getLogger("multi_agent_chat")
-
@@ -0,0 +1,147 @@
+"""
+事件循环监控模块
+循环内的心跳任务持续测量调度延迟并写入指标；独立的看门狗线程在心跳停滞超过阈值时，
+抓取此刻占用事件循环的调用栈（即阻塞事件循环的同步调用）
+"""
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from typing import Any, AsyncIterator, Dict, List, Optional
+from config import config
+from utils.metrics import metrics_collector
+
+logger = logging.getLogger(__name__)
+
+class LoopMonitor:
+    """
+    事件循环延迟监控与阻塞调用检测
+    
+    心跳任务每 interval 秒醒来一次，实际唤醒时间与计划的差值即为循环延迟；
+    看门狗线程发现心跳超过 threshold 秒未更新时记录事件循环线程的当前调用栈，
+    每次停顿只抓取一次，循环恢复后补记停顿的总时长。
+    
+    心跳是进程内唯一的循环延迟计时器，采样分析等需要延迟数据的地方通过 measure() 读取
+    """
+    
+    def __init__(self, interval: float = 0.1, threshold: float = 0.1, max_depth: int = 30):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_depth = max_depth
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._heartbeat = time.monotonic()
+        self._pending: Optional[Dict[str, Any]] = None  # 看门狗已抓到、等待循环恢复后补记时长的阻塞
+        self._collectors: List[List[float]] = []  # measure() 调用方各自收集的延迟
+    
+    def start(self):
+        """在运行中的事件循环里启动心跳任务和看门狗线程"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        logger.info(f"🐶 事件循环监控已启动（阻塞阈值 {self.threshold * 1000:.0f}ms）")
+    
+    async def stop(self):
+        """停止心跳任务和看门狗线程"""
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, 1.0)
+            self._thread = None
+    
+    async def _ticks(self) -> AsyncIterator[float]:
+        """每 interval 秒产出一次调度延迟（秒）"""
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            yield max(0.0, loop.time() - expected)
+    
+    async def measure(self, seconds: float) -> List[float]:
+        """
+        收集接下来 seconds 秒内的循环延迟
+        
+        监控运行中时直接读取心跳的测量值；未启用监控时临时运行同样的心跳，不记入指标
+        """
+        lags: List[float] = []
+        if self._task is not None and not self._task.done():
+            self._collectors.append(lags)
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                self._collectors.remove(lags)
+            return lags
+        
+        deadline = time.monotonic() + seconds
+        async for lag in self._ticks():
+            lags.append(lag)
+            if time.monotonic() >= deadline:
+                break
+        return lags
+    
+    async def _run(self):
+        async for lag in self._ticks():
+            self._heartbeat = time.monotonic()
+            metrics_collector.record_loop_lag(lag)
+            for collector in self._collectors:
+                collector.append(lag)
+            
+            pending, self._pending = self._pending, None
+            if pending is not None:
+                pending["duration"] = lag
+                metrics_collector.record_blocking_call(**pending)
+                logger.warning(
+                    f"⚠️ 事件循环被阻塞 {lag * 1000:.0f}ms，任务: {pending['task']}\n{pending['stack'][-1] if pending['stack'] else ''}"
+                )
+    
+    def _watch(self):
+        """看门狗线程：心跳停滞时抓取事件循环线程的调用栈"""
+        check_interval = min(self.interval, self.threshold) / 2
+        captured_for = None
+        while not self._stop.wait(check_interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self.interval
+            if stalled < self.threshold or captured_for == heartbeat:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            captured_for = heartbeat
+            self._pending = {
+                "stack": traceback.format_stack(frame, limit=self.max_depth),
+                "task": self._current_task_name()
+            }
+    
+    def _current_task_name(self) -> Optional[str]:
+        """尽力获取当前占用事件循环的任务（跨线程读取，仅用于诊断）"""
+        try:
+            task = asyncio.current_task(self._loop)
+        except Exception:
+            return None
+        if task is None:
+            return None
+        coro = task.get_coro()
+        return f"{task.get_name()} ({getattr(coro, '__qualname__', coro)})"
+
+# 全局事件循环监控
+loop_monitor = LoopMonitor(
+    interval=config.LOOP_MONITOR_INTERVAL_MS / 1000,
+    threshold=config.LOOP_BLOCK_THRESHOLD_MS / 1000
+)
@@ -3,6 +3,8 @@
 """
 import time
 import asyncio
+import contextlib
+from collections import Counter, deque
 from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 from dataclasses import dataclass, field
@@ -22,6 +24,15 @@ class RequestMetric:
     model_name: Optional[str] = None
     tokens_used: Optional[int] = None
 
+@dataclass
+class StorageCommitMetric:
+    """会话持久化提交指标"""
+    timestamp: datetime
+    sessions: int
+    versions: int
+    latency: float
+    mode: str
+
 @dataclass
 class SystemMetrics:
     """系统指标"""
@@ -33,6 +44,17 @@ class SystemMetrics:
     tokens_used_today: int = 0
     last_updated: datetime = field(default_factory=datetime.now)
 
+@dataclass
+class BlockingCallMetric:
+    """事件循环阻塞记录"""
+    timestamp: datetime
+    duration: float
+    task: Optional[str]
+    stack: List[str]
+
+# 事件循环延迟直方图的桶上界（毫秒，累计计数）
+LOOP_LAG_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, float("inf"))
+
 class MetricsCollector:
     """指标收集器"""
     
@@ -41,6 +63,13 @@ class MetricsCollector:
         self.metrics: List[RequestMetric] = []
         self.system_metrics = SystemMetrics()
         self._lock = asyncio.Lock()
+        self.commits: deque = deque(maxlen=1000)  # 最近的会话持久化提交
+        self.stages: Dict[str, deque] = {}  # 流水线阶段 → 最近的耗时（秒）
+        self.loop_lags: deque = deque(maxlen=3000)  # 最近的事件循环调度延迟（秒）
+        self.loop_lag_buckets: Dict[float, int] = {bucket: 0 for bucket in LOOP_LAG_BUCKETS_MS}
+        self.loop_lag_count = 0
+        self.blocking_calls: deque = deque(maxlen=50)  # 最近的事件循环阻塞调用栈
+        self._shared_deltas: Counter = Counter()  # 尚未汇总到共享后端的计数增量
     
     async def record_request(
         self,
@@ -67,6 +96,16 @@ class MetricsCollector:
             
             self.metrics.append(metric)
             
+            # 跨worker的当日计数
+            day = metric.timestamp.strftime("%Y%m%d")
+            self._shared_deltas[f"{day}:requests"] += 1
+            if status_code >= 400:
+                self._shared_deltas[f"{day}:errors"] += 1
+            if endpoint.startswith('/api/'):
+                self._shared_deltas[f"{day}:api_calls"] += 1
+            if tokens_used:
+                self._shared_deltas[f"{day}:tokens"] += tokens_used
+            
             # 保持指标数量在限制内
             if len(self.metrics) > self.max_metrics:
                 self.metrics = self.metrics[-self.max_metrics:]
@@ -74,6 +113,150 @@ class MetricsCollector:
             # 更新系统指标
             await self._update_system_metrics()
     
+    def record_commit(self, sessions: int, versions: int, latency: float, mode: str):
+        """
+        记录一次会话持久化提交
+        
+        Args:
+            sessions: 本次提交合并的会话数
+            versions: 本次提交合并的快照版本数
+            latency: 写入耗时（秒）
+            mode: 持久化模式
+        """
+        self.commits.append(StorageCommitMetric(
+            timestamp=datetime.now(),
+            sessions=sessions,
+            versions=versions,
+            latency=latency,
+            mode=mode
+        ))
+    
+    def get_commit_stats(self) -> Dict:
+        """获取持久化提交的批量大小和延迟统计"""
+        if not self.commits:
+            return {"commits": 0}
+        
+        latencies = sorted(c.latency for c in self.commits)
+        return {
+            "commits": len(self.commits),
+            "mode": self.commits[-1].mode,
+            "avg_batch_sessions": sum(c.sessions for c in self.commits) / len(self.commits),
+            "max_batch_sessions": max(c.sessions for c in self.commits),
+            "avg_batch_versions": sum(c.versions for c in self.commits) / len(self.commits),
+            "avg_latency_ms": sum(latencies) / len(latencies) * 1000,
+            "p95_latency_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+            "max_latency_ms": latencies[-1] * 1000,
+            "last_commit": self.commits[-1].timestamp.isoformat()
+        }
+    
+    def record_stage(self, pipeline: str, stage: str, duration: float):
+        """记录流水线某个阶段的耗时（秒）"""
+        key = f"{pipeline}.{stage}"
+        samples = self.stages.get(key)
+        if samples is None:
+            samples = self.stages[key] = deque(maxlen=1000)
+        samples.append(duration)
+    
+    @contextlib.contextmanager
+    def time_stage(self, pipeline: str, stage: str):
+        """对 with 块计时并记录为流水线阶段耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(pipeline, stage, time.perf_counter() - start)
+    
+    def get_stage_stats(self) -> Dict:
+        """获取各流水线阶段的耗时统计（毫秒）"""
+        stats = {}
+        for key, samples in sorted(self.stages.items()):
+            if not samples:
+                continue
+            durations = sorted(samples)
+            stats[key] = {
+                "count": len(durations),
+                "avg_ms": sum(durations) / len(durations) * 1000,
+                "p95_ms": durations[min(len(durations) - 1, int(len(durations) * 0.95))] * 1000,
+                "max_ms": durations[-1] * 1000
+            }
+        return stats
+    
+    def record_loop_lag(self, lag: float):
+        """记录一次事件循环调度延迟（秒）"""
+        self.loop_lags.append(lag)
+        self.loop_lag_count += 1
+        lag_ms = lag * 1000
+        for bucket in LOOP_LAG_BUCKETS_MS:
+            if lag_ms <= bucket:
+                self.loop_lag_buckets[bucket] += 1
+    
+    def record_blocking_call(self, duration: float, task: Optional[str], stack: List[str]):
+        """记录一次阻塞事件循环的调用"""
+        self.blocking_calls.append(BlockingCallMetric(
+            timestamp=datetime.now(),
+            duration=duration,
+            task=task,
+            stack=stack
+        ))
+    
+    def get_loop_stats(self) -> Dict:
+        """获取事件循环延迟统计（最近样本的分位数 + 启动以来的累计直方图）"""
+        if not self.loop_lags:
+            return {"measurements": 0}
+        
+        lags = sorted(self.loop_lags)
+        return {
+            "measurements": self.loop_lag_count,
+            "avg_ms": sum(lags) / len(lags) * 1000,
+            "p50_ms": lags[len(lags) // 2] * 1000,
+            "p99_ms": lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000,
+            "max_ms": lags[-1] * 1000,
+            "histogram_ms": {
+                ("+Inf" if bucket == float("inf") else str(bucket)): count
+                for bucket, count in self.loop_lag_buckets.items()
+            },
+            "blocking_calls": len(self.blocking_calls),
+            "last_blocking_call": self.blocking_calls[-1].timestamp.isoformat() if self.blocking_calls else None
+        }
+    
+    def get_blocking_calls(self, limit: int = 20) -> List[Dict]:
+        """最近的阻塞调用（新的在前）"""
+        return [
+            {
+                "timestamp": call.timestamp.isoformat(),
+                "duration_ms": call.duration * 1000,
+                "task": call.task,
+                "stack": call.stack
+            }
+            for call in list(reversed(self.blocking_calls))[:limit]
+        ]
+    
+    async def flush_shared(self, backend):
+        """把本worker累计的计数增量汇总到共享后端"""
+        deltas, self._shared_deltas = self._shared_deltas, Counter()
+        for key, amount in deltas.items():
+            try:
+                await backend.incr(f"metrics:{key}", amount, ttl=3 * 86400)
+            except Exception as e:
+                self._shared_deltas[key] += amount
+                logger.warning(f"汇总指标到共享后端失败: {e}")
+    
+    async def sync_shared_periodically(self, backend, interval_seconds: float):
+        """后台定期汇总计数到共享后端"""
+        while True:
+            await asyncio.sleep(interval_seconds)
+            await self.flush_shared(backend)
+    
+    async def get_shared_stats(self, backend) -> Dict:
+        """所有worker的当日汇总计数（各worker最多滞后一个汇总间隔）"""
+        day = datetime.now().strftime("%Y%m%d")
+        stats = {}
+        for name in ("requests", "errors", "api_calls", "tokens"):
+            value = await backend.get(f"metrics:{day}:{name}")
+            stats[f"{name}_today"] = int(value) if value else 0
+        stats["error_rate_today"] = stats["errors_today"] / stats["requests_today"] if stats["requests_today"] else 0.0
+        return stats
+    
     async def _update_system_metrics(self):
         """更新系统指标"""
         now = datetime.now()
@@ -172,10 +355,14 @@ class MetricsCollector:
     async def get_health_status(self) -> Dict:
         """获取健康状态"""
         now = datetime.now()
-        recent_metrics = [
-            m for m in self.metrics 
-            if m.timestamp >= now - timedelta(minutes=5)
-        ]
+        cutoff = now - timedelta(minutes=5)
+        
+        # 指标按时间顺序追加，从尾部向前扫描到窗口边界即可
+        recent_metrics = []
+        for m in reversed(self.metrics):
+            if m.timestamp < cutoff:
+                break
+            recent_metrics.append(m)
         
         if not recent_metrics:
             return {"status": "unknown", "message": "没有最近的请求数据"}
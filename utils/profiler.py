@@ -0,0 +1,129 @@
+"""
+采样分析模块
+在独立线程中定期抓取所有线程（事件循环线程和线程池线程）的调用栈，输出可直接生成火焰图的折叠栈，
+同时汇总采样期间的事件循环调度延迟（取自事件循环监控的心跳，不另起计时器）
+"""
+import sys
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, Optional
+from utils.loop_monitor import loop_monitor
+
+logger = logging.getLogger(__name__)
+
+class ProfilerBusyError(Exception):
+    """已有采样在进行中"""
+    pass
+
+# 空闲等待的叶子帧：事件循环等待IO、线程池线程等待任务、线程等待条件变量
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("threading.py", "wait")
+}
+
+def _is_idle(frame) -> bool:
+    code = frame.f_code
+    return (code.co_filename.rsplit("/", 1)[-1], code.co_name) in _IDLE_LEAVES
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename.rsplit("/", 1)[-1]
+    return f"{code.co_name} ({filename}:{frame.f_lineno})"
+
+def _collapse(frame, thread_label: str, max_depth: int) -> str:
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_label)
+    return ";".join(reversed(labels))
+
+class StackSampler:
+    """
+    低开销的栈采样器
+    
+    采样线程每隔 interval 秒调用一次 sys._current_frames()，只在采样期间运行；
+    同一时间只允许一次采样
+    """
+    
+    def __init__(self, max_depth: int = 64):
+        self.max_depth = max_depth
+        self._running = False
+    
+    def _sample(self, seconds: float, interval: float, loop_thread_id: Optional[int], idle: bool) -> Dict[str, Any]:
+        counts: Counter = Counter()
+        own_id = threading.get_ident()
+        samples = 0
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id or (not idle and _is_idle(frame)):
+                    continue
+                if thread_id == loop_thread_id:
+                    label = "event-loop"
+                else:
+                    label = names.get(thread_id, f"thread-{thread_id}")
+                counts[_collapse(frame, label, self.max_depth)] += 1
+            samples += 1
+            time.sleep(interval)
+        return {"samples": samples, "stacks": counts}
+    
+    async def profile(
+        self,
+        seconds: float,
+        interval: float = 0.005,
+        idle: bool = False
+    ) -> Dict[str, Any]:
+        """
+        采样指定时长
+        
+        Args:
+            seconds: 采样时长（秒）
+            interval: 栈采样间隔（秒）
+            idle: 是否保留空闲等待的调用栈
+        
+        Raises:
+            ProfilerBusyError: 已有采样在进行中
+        """
+        if self._running:
+            raise ProfilerBusyError()
+        self._running = True
+        try:
+            loop_thread_id = threading.get_ident()
+            started = time.monotonic()
+            sampled, lags = await asyncio.gather(
+                asyncio.to_thread(self._sample, seconds, interval, loop_thread_id, idle),
+                loop_monitor.measure(seconds)
+            )
+        finally:
+            self._running = False
+        
+        lags.sort()
+        stacks = sampled["stacks"]
+        loop_samples = sum(count for stack, count in stacks.items() if stack.startswith("event-loop;"))
+        logger.info(f"🔬 采样完成: {sampled['samples']} 次，{len(stacks)} 个不同调用栈")
+        return {
+            "duration": round(time.monotonic() - started, 3),
+            "interval_ms": interval * 1000,
+            "samples": sampled["samples"],
+            "event_loop_samples": loop_samples,
+            "loop_lag": {
+                "measurements": len(lags),
+                "avg_ms": sum(lags) / len(lags) * 1000 if lags else 0.0,
+                "p95_ms": lags[min(len(lags) - 1, int(len(lags) * 0.95))] * 1000 if lags else 0.0,
+                "max_ms": lags[-1] * 1000 if lags else 0.0
+            },
+            "stacks": stacks
+        }
+
+def format_collapsed(stacks: Counter) -> str:
+    """折叠栈文本（每行“栈 次数”），可直接交给 flamegraph.pl / speedscope"""
+    return "\n".join(f"{stack} {count}" for stack, count in stacks.most_common()) + "\n"
+
+# 全局栈采样器
+stack_sampler = StackSampler()
@@ -0,0 +1,311 @@
+"""
+分层提示词构建模块
+按稳定程度从高到低组织提示词：静态Agent提示 → 长期记忆 → 文件 → 历史 → 当前轮次，
+使上游的提示词前缀缓存尽可能命中
+"""
+import json
+import time
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+from config import config
+
+logger = logging.getLogger(__name__)
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+def supports_cache_breakpoints(model: str) -> bool:
+    """上游是否支持显式缓存断点（cache_control）"""
+    prefixes = [p.strip().lower() for p in config.PROMPT_CACHE_BREAKPOINT_MODELS.split(",") if p.strip()]
+    return any(model.lower().startswith(p) for p in prefixes)
+
+def _content_size(content: Any) -> int:
+    """估算消息内容长度（字符数）"""
+    if isinstance(content, str):
+        return len(content)
+    size = 0
+    for part in content or []:
+        if part.get("type") == "text":
+            size += len(part.get("text", ""))
+        elif part.get("type") == "image_url":
+            size += len(part.get("image_url", {}).get("url", ""))
+    return size
+
+def _mark_breakpoint(message: Dict) -> Dict:
+    """在消息最后一个内容块上标记缓存断点"""
+    content = message["content"]
+    if isinstance(content, str):
+        parts = [{"type": "text", "text": content}]
+    else:
+        parts = [dict(part) for part in content]
+    parts[-1]["cache_control"] = CACHE_CONTROL
+    return {**message, "content": parts}
+
+def _as_parts(content: Any) -> List[Dict]:
+    return [{"type": "text", "text": content}] if isinstance(content, str) else list(content or [])
+
+def _merge_user_messages(messages: List[Dict]) -> List[Dict]:
+    """
+    合并相邻的user消息（如文件层之后紧跟的历史或当前轮次），避免连续出现两条user消息
+    
+    两者都是纯文本时以空行拼接；否则拼接内容块，各块上的缓存断点保持不变
+    """
+    merged: List[Dict] = []
+    for message in messages:
+        previous = merged[-1] if merged else None
+        if previous is None or previous["role"] != "user" or message["role"] != "user":
+            merged.append(message)
+            continue
+        first, second = previous["content"], message["content"]
+        if isinstance(first, str) and isinstance(second, str):
+            content = first + "\n\n" + second
+        else:
+            parts = _as_parts(second)
+            if parts and parts[0].get("type") == "text":
+                parts[0] = {**parts[0], "text": "\n\n" + parts[0]["text"]}
+            content = _as_parts(first) + parts
+        merged[-1] = {**previous, "content": content}
+    return merged
+
+def strip_cache_breakpoints(messages: List[Dict]) -> List[Dict]:
+    """移除缓存断点标记，供不支持cache_control的上游使用"""
+    stripped = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list) and any("cache_control" in part for part in content):
+            parts = [{k: v for k, v in part.items() if k != "cache_control"} for part in content]
+            if all(part.get("type") == "text" for part in parts):
+                content = "".join(part["text"] for part in parts)
+            else:
+                content = parts
+            message = {**message, "content": content}
+        stripped.append(message)
+    return stripped
+
+class _DigestCache:
+    """
+    按对象缓存内容摘要和长度：会话中已发布的消息内容、讨论问题与附件在多次构建间是同一对象，
+    只在第一次出现时序列化并哈希（缓存持有对象引用，id不会被复用；按条数和总字符数淘汰，
+    不会长期持有大量图片数据）
+    """
+    
+    def __init__(self, max_entries: int = 4096, max_chars: int = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self._entries: "OrderedDict[int, Tuple[Any, str, int]]" = OrderedDict()
+        self._chars = 0
+    
+    def get(self, content: Any) -> Tuple[str, int]:
+        """返回 (摘要, 字符数)"""
+        key = id(content)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is content:
+            self._entries.move_to_end(key)
+            return entry[1], entry[2]
+        
+        if isinstance(content, str):
+            raw = content.encode("utf-8")
+        else:
+            raw = json.dumps(content, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        digest = hashlib.sha1(raw).hexdigest()
+        size = _content_size(content)
+        if entry is not None:
+            self._chars -= entry[2]
+        self._entries[key] = (content, digest, size)
+        self._entries.move_to_end(key)
+        self._chars += size
+        while len(self._entries) > self.max_entries or (self._chars > self.max_chars and len(self._entries) > 1):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self._chars -= evicted
+        return digest, size
+
+class PrefixCacheTracker:
+    """前缀缓存命中统计：记录近期发送过的前缀哈希，估算上游缓存命中率"""
+    
+    def __init__(self, ttl: int = 300, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._stats: Dict[str, Dict[str, Any]] = {}
+    
+    def _model_stats(self, model: str) -> Dict[str, Any]:
+        if model not in self._stats:
+            self._stats[model] = {
+                "builds": 0,
+                "hit_builds": 0,
+                "prefix_chars": 0,
+                "cached_chars": 0,
+                "layer_hits": {},
+                "upstream_prompt_tokens": 0,
+                "upstream_cached_tokens": 0
+            }
+        return self._stats[model]
+    
+    def observe(self, model: str, boundaries: List[Tuple[str, str, int]]):
+        """
+        记录一次构建的前缀边界
+        
+        Args:
+            model: 模型名称
+            boundaries: (层名称, 累计哈希, 累计字符数) 列表，按前缀顺序排列
+        """
+        now = time.monotonic()
+        stats = self._model_stats(model)
+        stats["builds"] += 1
+        if not boundaries:
+            return
+        
+        # 最长的已缓存前缀
+        hit_layer, hit_chars = None, 0
+        for layer, digest, chars in boundaries:
+            seen_at = self._seen.get((model, digest))
+            if seen_at is not None and now - seen_at < self.ttl:
+                hit_layer, hit_chars = layer, chars
+        
+        stats["prefix_chars"] += boundaries[-1][2]
+        if hit_layer:
+            stats["hit_builds"] += 1
+            stats["cached_chars"] += hit_chars
+            stats["layer_hits"][hit_layer] = stats["layer_hits"].get(hit_layer, 0) + 1
+        
+        for _, digest, _ in boundaries:
+            key = (model, digest)
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+    
+    def record_upstream_usage(self, model: str, prompt_tokens: int, cached_tokens: int):
+        """记录上游返回的实际缓存token数（若上游提供）"""
+        stats = self._model_stats(model)
+        stats["upstream_prompt_tokens"] += prompt_tokens or 0
+        stats["upstream_cached_tokens"] += cached_tokens or 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各模型的前缀命中率"""
+        result = {}
+        for model, stats in self._stats.items():
+            builds = stats["builds"] or 1
+            result[model] = {
+                **stats,
+                "hit_rate": stats["hit_builds"] / builds,
+                "prefix_hit_ratio": stats["cached_chars"] / stats["prefix_chars"] if stats["prefix_chars"] else 0.0,
+                "upstream_cached_ratio": (
+                    stats["upstream_cached_tokens"] / stats["upstream_prompt_tokens"]
+                    if stats["upstream_prompt_tokens"] else None
+                )
+            }
+        return result
+
+class PromptBuilder:
+    """
+    分层提示词构建器
+    
+    层次（从稳定到易变）：
+        system  - Agent的静态系统提示
+        memory  - 长期记忆块
+        files   - 整个会话共享的文件/问题上下文（如讨论问题及附件）
+        history - 早期摘要与历史消息
+        turn    - 当前轮次的易变内容（不参与缓存）
+    """
+    
+    def __init__(self, model: str):
+        self.model = model
+        self._system = ""
+        self._memory = ""
+        self._digest = ""
+        self._files: Optional[Any] = None
+        self._history: List[Dict] = []
+        self._turn: List[Dict] = []
+    
+    def system(self, text: str) -> "PromptBuilder":
+        self._system = text
+        return self
+    
+    def memory(self, text: str) -> "PromptBuilder":
+        self._memory = text or ""
+        return self
+    
+    def files(self, content: Any) -> "PromptBuilder":
+        self._files = content
+        return self
+    
+    def digest(self, text: str) -> "PromptBuilder":
+        self._digest = text or ""
+        return self
+    
+    def history(self, role: str, content: Any) -> "PromptBuilder":
+        self._history.append({"role": role, "content": content})
+        return self
+    
+    def turn(self, content: Any, role: str = "user") -> "PromptBuilder":
+        self._turn.append({"role": role, "content": content})
+        return self
+    
+    def build(self) -> List[Dict]:
+        """按层次输出消息列表，并在支持的上游标记缓存断点"""
+        use_breakpoints = supports_cache_breakpoints(self.model)
+        
+        # 系统消息：静态提示 + 记忆 + 早期摘要，各自作为独立文本块
+        system_parts = [("system", self._system), ("memory", self._memory), ("history", self._digest)]
+        system_parts = [(layer, text) for layer, text in system_parts if text]
+        
+        segments: List[Tuple[str, Dict]] = []
+        if use_breakpoints:
+            parts = [{"type": "text", "text": text} for _, text in system_parts]
+            # 断点打在记忆块（或静态提示）之后，摘要变化不影响其前缀
+            stable = [i for i, (layer, _) in enumerate(system_parts) if layer != "history"]
+            if stable:
+                parts[stable[-1]]["cache_control"] = CACHE_CONTROL
+            system_message = {"role": "system", "content": parts}
+        else:
+            system_message = {"role": "system", "content": "".join(text for _, text in system_parts)}
+        
+        messages = [system_message]
+        if self._files is not None:
+            files_message = {"role": "user", "content": self._files}
+            messages.append(_mark_breakpoint(files_message) if use_breakpoints else files_message)
+            segments.append(("files", files_message))
+        
+        history = list(self._history)
+        if history and use_breakpoints:
+            history[-1] = _mark_breakpoint(history[-1])
+        messages.extend(history)
+        segments.extend(("history", message) for message in self._history)
+        
+        messages.extend(self._turn)
+        messages = [messages[0]] + _merge_user_messages(messages[1:])
+        
+        try:
+            prompt_cache_tracker.observe(self.model, self._boundaries(system_parts, segments))
+        except Exception as e:
+            logger.debug(f"前缀缓存统计失败: {e}")
+        
+        return messages
+    
+    def _boundaries(self, system_parts: List[Tuple[str, str]], segments: List[Tuple[str, Dict]]) -> List[Tuple[str, str, int]]:
+        """计算每个稳定层边界处的累计哈希（由各层内容的缓存摘要串联，不重新哈希完整提示词）"""
+        hasher = hashlib.sha1()
+        chars = 0
+        boundaries = []
+        
+        for layer, text in system_parts:
+            digest, size = _digest_cache.get(text)
+            hasher.update(f"{layer}:{digest};".encode())
+            chars += size
+            boundaries.append((layer, hasher.hexdigest(), chars))
+        
+        for layer, message in segments:
+            digest, size = _digest_cache.get(message["content"])
+            hasher.update(f"{message['role']}:{digest};".encode())
+            chars += size
+            boundaries.append((layer, hasher.hexdigest(), chars))
+        
+        return boundaries
+
+# 内容摘要缓存
+_digest_cache = _DigestCache()
+
+# 全局前缀缓存统计
+prompt_cache_tracker = PrefixCacheTracker(ttl=config.PROMPT_CACHE_TTL)
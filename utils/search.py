@@ -0,0 +1,462 @@
+"""
+全文搜索模块
+基于SQLite FTS5（trigram分词，支持中日韩文本）维护会话标题、消息内容和Agent名称的倒排索引，
+随会话写入增量更新；1~2个字符的查询词（常见的双字中文词）由并行的bigram索引匹配
+"""
+import os
+import re
+import html
+import asyncio
+import sqlite3
+import threading
+import logging
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# trigram分词器要求查询词至少3个字符，更短的词使用bigram索引匹配
+_MIN_TRIGRAM_CHARS = 3
+
+# bigram索引的词元只由文字字符组成，含标点等其他字符的短词只能逐行扫描
+_WORD_RUN = re.compile(r"\w+")
+
+# 索引结构版本（PRAGMA user_version），升级时补建新增的索引
+_SCHEMA_VERSION = 2
+
+# 片段中命中词的临时标记，HTML转义后再替换为<mark>标签
+_MARK_START, _MARK_END = "\x02", "\x03"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS search_rows (
+    rowid INTEGER PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    message_id TEXT,
+    role TEXT,
+    agent_name TEXT,
+    timestamp TEXT,
+    is_discussion INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_search_rows_session ON search_rows(session_id, position);
+CREATE INDEX IF NOT EXISTS idx_search_rows_agent ON search_rows(agent_name);
+CREATE INDEX IF NOT EXISTS idx_search_rows_timestamp ON search_rows(timestamp);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5(
+    content, title, agent_name, tokenize='trigram'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS search_bigrams USING fts5(
+    content, title, agent_name, tokenize="unicode61 remove_diacritics 0 tokenchars '_'", prefix='1'
+);
+CREATE TABLE IF NOT EXISTS indexed_sessions (
+    session_id TEXT PRIMARY KEY,
+    title TEXT,
+    version INTEGER,
+    message_count INTEGER NOT NULL
+);
+"""
+
+def _message_text(content: Any) -> str:
+    """提取消息文本（多模态消息只取文本部分）"""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        return " ".join(part.get("text", "") for part in content if isinstance(part, dict) and part.get("type") == "text")
+    return ""
+
+def _bigrams(text: Optional[str]) -> str:
+    """
+    将文本拆成相邻两字的词元，供bigram索引使用
+    
+    每段连续文字末尾的单字也作为词元，单字查询以前缀匹配即可覆盖所有出现位置
+    """
+    if not text:
+        return ""
+    grams = []
+    for run in _WORD_RUN.findall(text.lower()):
+        grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+        grams.append(run[-1])
+    return " ".join(grams)
+
+def _end_bound(end_date: str) -> Tuple[str, str]:
+    """结束时间条件：只有日期时包含当天全部时间，否则按时间点比较（含）"""
+    try:
+        day = date.fromisoformat(end_date)
+    except ValueError:
+        return "<=", end_date
+    return "<", (day + timedelta(days=1)).isoformat()
+
+class SearchIndex:
+    """会话全文索引"""
+    
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._conn_pid: Optional[int] = None
+        self._db_lock = threading.Lock()
+        self._pending: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._worker: Optional[asyncio.Task] = None
+    
+    def _connect(self) -> sqlite3.Connection:
+        # 连接在首次使用的进程中打开，fork 出的 worker 不沿用父进程的连接
+        if self._conn is None or self._conn_pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_SCHEMA)
+            self._migrate(conn)
+            self._conn = conn
+            self._conn_pid = os.getpid()
+        return self._conn
+    
+    @staticmethod
+    def _migrate(conn: sqlite3.Connection):
+        """旧版本的索引文件补建bigram索引"""
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= _SCHEMA_VERSION:
+            return
+        conn.create_function("bigrams", 1, _bigrams, deterministic=True)
+        with conn:
+            conn.execute("DELETE FROM search_bigrams")
+            conn.execute(
+                "INSERT INTO search_bigrams (rowid, content, title, agent_name) "
+                "SELECT rowid, bigrams(content), bigrams(title), bigrams(agent_name) FROM search_fts"
+            )
+            conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+        logger.info("🔎 搜索索引已补建bigram索引")
+    
+    # ==================== 索引维护 ====================
+    
+    def _delete_rows(self, conn: sqlite3.Connection, session_id: str, from_position: int = -1):
+        """删除会话中指定位置之后（含）的索引行"""
+        rowids = [row[0] for row in conn.execute(
+            "SELECT rowid FROM search_rows WHERE session_id = ? AND position >= ?",
+            (session_id, from_position)
+        )]
+        if rowids:
+            conn.executemany("DELETE FROM search_fts WHERE rowid = ?", [(r,) for r in rowids])
+            conn.executemany("DELETE FROM search_bigrams WHERE rowid = ?", [(r,) for r in rowids])
+            conn.executemany("DELETE FROM search_rows WHERE rowid = ?", [(r,) for r in rowids])
+    
+    def _insert_row(self, conn: sqlite3.Connection, row: Dict[str, Any], content: str, title: str):
+        cursor = conn.execute(
+            "INSERT INTO search_rows (session_id, position, kind, message_id, role, agent_name, timestamp, is_discussion) "
+            "VALUES (:session_id, :position, :kind, :message_id, :role, :agent_name, :timestamp, :is_discussion)",
+            row
+        )
+        agent_name = row["agent_name"] or ""
+        conn.execute(
+            "INSERT INTO search_fts (rowid, content, title, agent_name) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, content, title, agent_name)
+        )
+        conn.execute(
+            "INSERT INTO search_bigrams (rowid, content, title, agent_name) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, _bigrams(content), _bigrams(title), _bigrams(agent_name))
+        )
+    
+    def _index_session(self, conn: sqlite3.Connection, session_id: str, session: Optional[Dict[str, Any]]):
+        """
+        增量索引单个会话
+        
+        消息只会追加，因此只重新索引上次索引的最后一条消息（可能在流式保存中被更新）及之后的消息；
+        标题变化或消息变少时整体重建
+        """
+        state = conn.execute(
+            "SELECT title, version, message_count FROM indexed_sessions WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        
+        if session is None:
+            self._delete_rows(conn, session_id)
+            conn.execute("DELETE FROM indexed_sessions WHERE session_id = ?", (session_id,))
+            return
+        
+        messages = session.get("messages", [])
+        title = session.get("title") or ""
+        version = session.get("version")
+        if state is not None and state["version"] == version and state["message_count"] == len(messages) and version is not None:
+            return
+        
+        session_discussion = bool(session.get("is_discussion"))
+        if state is None or state["title"] != title or state["message_count"] > len(messages):
+            self._delete_rows(conn, session_id)
+            self._insert_row(conn, {
+                "session_id": session_id,
+                "position": -1,
+                "kind": "session",
+                "message_id": None,
+                "role": None,
+                "agent_name": None,
+                "timestamp": session.get("updated_at"),
+                "is_discussion": int(session_discussion)
+            }, "", title)
+            start = 0
+        else:
+            start = max(state["message_count"] - 1, 0)
+            self._delete_rows(conn, session_id, start)
+        
+        for position in range(start, len(messages)):
+            message = messages[position]
+            text = _message_text(message.get("content"))
+            if not text.strip():
+                continue
+            self._insert_row(conn, {
+                "session_id": session_id,
+                "position": position,
+                "kind": "message",
+                "message_id": message.get("id"),
+                "role": message.get("role"),
+                "agent_name": message.get("agent_name"),
+                "timestamp": message.get("timestamp"),
+                "is_discussion": int(session_discussion or bool(message.get("is_discussion")))
+            }, text, "")
+        
+        conn.execute(
+            "INSERT OR REPLACE INTO indexed_sessions (session_id, title, version, message_count) VALUES (?, ?, ?, ?)",
+            (session_id, title, version, len(messages))
+        )
+    
+    def _apply(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        """在单个事务中应用一批会话变更"""
+        with self._db_lock:
+            conn = self._connect()
+            with conn:
+                for session_id, session in changes.items():
+                    self._index_session(conn, session_id, session)
+    
+    def on_sessions_changed(self, changes: Dict[str, Optional[Dict[str, Any]]]):
+        """会话写入监听器：记录变更并由后台任务批量写入索引，不阻塞会话写入"""
+        self._pending.update(changes)
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.create_task(self._drain_pending())
+    
+    async def _drain_pending(self):
+        while self._pending:
+            changes, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._apply, changes)
+            except Exception as e:
+                logger.error(f"更新搜索索引失败: {e}")
+    
+    async def sync(self, sessions: List[Dict[str, Any]], keep: Optional[set] = None):
+        """
+        启动时与会话数据对齐：补充缺失或过期的会话，移除已删除的会话
+        
+        Args:
+            sessions: 热存储中的全部会话
+            keep: 不在sessions中但需保留索引的会话ID（如已归档的会话）
+        """
+        def run():
+            with self._db_lock:
+                conn = self._connect()
+                indexed = {
+                    row["session_id"]: (row["version"], row["message_count"])
+                    for row in conn.execute("SELECT session_id, version, message_count FROM indexed_sessions")
+                }
+            
+            changes: Dict[str, Optional[Dict[str, Any]]] = {}
+            for session in sessions:
+                state = indexed.pop(session.get("id"), None)
+                if state is None or state != (session.get("version"), len(session.get("messages", []))):
+                    changes[session.get("id")] = session
+            for session_id in indexed:
+                if not keep or session_id not in keep:
+                    changes[session_id] = None
+            
+            if changes:
+                self._apply(changes)
+            return len(changes)
+        
+        updated = await asyncio.to_thread(run)
+        if updated:
+            logger.info(f"🔎 搜索索引已同步 {updated} 个会话")
+    
+    # ==================== 查询 ====================
+    
+    @staticmethod
+    def _build_match(terms: List[str]) -> str:
+        """构建FTS5 MATCH表达式，每个词作为短语并以AND连接"""
+        return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+    
+    @staticmethod
+    def _build_bigram_match(terms: List[str]) -> str:
+        """构建bigram索引的MATCH表达式：双字词精确匹配词元，单字词前缀匹配"""
+        return " ".join('"' + term.lower() + '"' + ("*" if len(term) == 1 else "") for term in terms)
+    
+    def _search(
+        self,
+        query: str,
+        agent: Optional[str],
+        start_date: Optional[str],
+        end_date: Optional[str],
+        kind: Optional[str],
+        limit: int,
+        offset: int
+    ) -> Dict[str, Any]:
+        terms = query.split()
+        long_terms = [t for t in terms if len(t) >= _MIN_TRIGRAM_CHARS]
+        short_terms = [t for t in terms if len(t) < _MIN_TRIGRAM_CHARS]
+        bigram_terms = [t for t in short_terms if _WORD_RUN.fullmatch(t)]
+        
+        conditions, params = [], []
+        if long_terms:
+            conditions.append("search_fts MATCH ?")
+            params.append(self._build_match(long_terms))
+        if bigram_terms:
+            conditions.append("search_fts.rowid IN (SELECT rowid FROM search_bigrams WHERE search_bigrams MATCH ?)")
+            params.append(self._build_bigram_match(bigram_terms))
+        for term in short_terms:
+            if term not in bigram_terms:
+                conditions.append("(instr(search_fts.content, ?) > 0 OR instr(search_fts.title, ?) > 0)")
+                params.extend([term, term])
+        if agent:
+            conditions.append("r.agent_name = ?")
+            params.append(agent)
+        if start_date:
+            conditions.append("r.timestamp >= ?")
+            params.append(start_date)
+        if end_date:
+            operator, bound = _end_bound(end_date)
+            conditions.append(f"r.timestamp {operator} ?")
+            params.append(bound)
+        if kind in ("discussion", "chat"):
+            conditions.append("r.is_discussion = ?")
+            params.append(1 if kind == "discussion" else 0)
+        
+        # snippet()只对MATCH命中生效，只有短词时取原文手动截取
+        if long_terms:
+            rank = "bm25(search_fts, 1.0, 2.0, 0.5)"
+            content_expr = f"snippet(search_fts, 0, '{_MARK_START}', '{_MARK_END}', '…', 24)"
+            title_expr = f"snippet(search_fts, 1, '{_MARK_START}', '{_MARK_END}', '…', 24)"
+        else:
+            rank, content_expr, title_expr = "0", "search_fts.content", "search_fts.title"
+        sql = (
+            f"SELECT r.session_id, r.kind, r.position, r.message_id, r.role, r.agent_name, r.timestamp, r.is_discussion, "
+            f"{content_expr} AS content_snippet, "
+            f"{title_expr} AS title_snippet, "
+            f"{rank} AS score "
+            f"FROM search_fts JOIN search_rows r ON r.rowid = search_fts.rowid "
+            f"WHERE {' AND '.join(conditions)} "
+            f"ORDER BY score, r.timestamp DESC LIMIT ? OFFSET ?"
+        )
+        
+        with self._db_lock:
+            conn = self._connect()
+            rows = conn.execute(sql, params + [limit + 1, offset]).fetchall()
+            
+            # 附带会话标题
+            session_ids = list({row["session_id"] for row in rows})
+            titles = {}
+            if session_ids:
+                placeholders = ",".join("?" * len(session_ids))
+                titles = {
+                    row["session_id"]: row["title"]
+                    for row in conn.execute(
+                        f"SELECT session_id, title FROM indexed_sessions WHERE session_id IN ({placeholders})",
+                        session_ids
+                    )
+                }
+        
+        results = []
+        for row in rows[:limit]:
+            snippet = row["title_snippet"] if row["kind"] == "session" else row["content_snippet"]
+            if not long_terms:
+                snippet = self._highlight(snippet, short_terms)
+            results.append({
+                "type": row["kind"],
+                "session_id": row["session_id"],
+                "session_title": titles.get(row["session_id"]),
+                "message_id": row["message_id"],
+                "position": row["position"] if row["kind"] == "message" else None,
+                "role": row["role"],
+                "agent_name": row["agent_name"],
+                "timestamp": row["timestamp"],
+                "is_discussion": bool(row["is_discussion"]),
+                "snippet": self._render(snippet),
+                "score": row["score"]
+            })
+        
+        return {"results": results, "has_more": len(rows) > limit}
+    
+    @staticmethod
+    def _highlight(text: str, terms: List[str], context: int = 60) -> str:
+        """短词查询时手动截取片段并标记命中词（不区分大小写）"""
+        if not text:
+            return text
+        lowered = text.lower()
+        terms = [term.lower() for term in terms]
+        positions = [lowered.find(term) for term in terms if term in lowered]
+        if not positions:
+            return text[:context * 2]
+        start = max(min(positions) - context, 0)
+        end = start + context * 2
+        
+        # 收集命中区间并合并重叠部分
+        spans = []
+        for term in terms:
+            pos = lowered.find(term, start)
+            while pos != -1 and pos < end:
+                spans.append((pos, min(pos + len(term), end)))
+                pos = lowered.find(term, pos + 1)
+        merged: List[List[int]] = []
+        for span_start, span_end in sorted(spans):
+            if merged and span_start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], span_end)
+            else:
+                merged.append([span_start, span_end])
+        
+        parts, cursor = [], start
+        for span_start, span_end in merged:
+            parts.extend([text[cursor:span_start], _MARK_START, text[span_start:span_end], _MARK_END])
+            cursor = span_end
+        parts.append(text[cursor:end])
+        return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
+    
+    @staticmethod
+    def _render(snippet: Optional[str]) -> Optional[str]:
+        """HTML转义片段中的用户文本，再把命中标记替换为<mark>标签"""
+        if not snippet:
+            return snippet
+        return html.escape(snippet).replace(_MARK_START, "<mark>").replace(_MARK_END, "</mark>")
+    
+    async def search(
+        self,
+        query: str,
+        agent: Optional[str] = None,
+        start_date: Optional[str] = None,
+        end_date: Optional[str] = None,
+        kind: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0
+    ) -> Dict[str, Any]:
+        """
+        全文搜索
+        
+        Args:
+            query: 搜索词，空格分隔的多个词需同时匹配
+            agent: 按Agent名称过滤
+            start_date: 起始时间（ISO格式，含）
+            end_date: 结束时间（ISO格式，含；只有日期时包含当天全部时间）
+            kind: discussion（仅讨论）/ chat（仅普通对话）
+            limit: 返回数量
+            offset: 偏移量
+        
+        Returns:
+            {"results": 按相关度排序的结果（片段已做HTML转义，命中词以<mark>标记）, "has_more": 是否还有更多}
+        """
+        return await asyncio.to_thread(self._search, query, agent, start_date, end_date, kind, limit, offset)
+    
+    async def drain(self):
+        """等待待写入的索引变更完成（关闭时调用）"""
+        if self._worker and not self._worker.done():
+            await self._worker
+    
+    def close(self):
+        with self._db_lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+# 全局搜索索引
+search_index = SearchIndex(config.SEARCH_INDEX_FILE)
@@ -0,0 +1,490 @@
+"""
+共享状态后端模块
+多worker/多节点部署时，会话、限流计数和跨进程指标需要放在所有进程都能访问的存储中：
+memory 为单进程内存实现（默认，行为与单worker部署一致），sqlite 供同一台机器上的多个worker共享，
+redis 供多台机器共享
+"""
+import os
+import time
+import uuid
+import sqlite3
+import asyncio
+import logging
+import weakref
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+from limits.storage import Storage
+from config import config
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # 仅 redis 后端需要
+    aioredis = None
+
+logger = logging.getLogger(__name__)
+
+class StateLockTimeout(Exception):
+    """等待跨进程锁超时"""
+    pass
+
+class StateBackend:
+    """
+    共享状态后端接口
+    
+    提供键值、计数器、哈希表和互斥锁四类操作，值一律为字节串；
+    shared 为 True 的后端可被多个进程同时使用
+    """
+    
+    name = "base"
+    shared = False
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        raise NotImplementedError
+    
+    async def delete(self, *keys: str):
+        raise NotImplementedError
+    
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """原子自增并返回新值，ttl 只在计数器新建时设置"""
+        raise NotImplementedError
+    
+    async def hgetall(self, name: str) -> Dict[str, bytes]:
+        raise NotImplementedError
+    
+    async def hmget(self, name: str, fields: List[str]) -> List[Optional[bytes]]:
+        raise NotImplementedError
+    
+    async def hupdate(self, name: str, mapping: Dict[str, bytes], delete: Iterable[str] = ()):
+        """在一次原子操作中写入和删除哈希表的多个字段"""
+        raise NotImplementedError
+    
+    def lock(self, name: str, timeout: float = 30, wait: float = 30):
+        """
+        跨进程互斥锁（异步上下文管理器）
+        
+        Args:
+            name: 锁名称
+            timeout: 持有者崩溃时锁自动释放的时间（秒）
+            wait: 最长等待时间，超时抛出 StateLockTimeout
+        """
+        raise NotImplementedError
+    
+    def limiter_storage_uri(self) -> str:
+        """供 slowapi 限流器使用的存储URI"""
+        raise NotImplementedError
+    
+    async def close(self):
+        pass
+
+class MemoryStateBackend(StateBackend):
+    """单进程内存实现"""
+    
+    name = "memory"
+    shared = False
+    
+    def __init__(self):
+        self._values: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        self._hashes: Dict[str, Dict[str, bytes]] = {}
+        self._locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+    
+    def _live(self, key: str) -> bool:
+        expires = self._expires.get(key)
+        if expires is not None and expires <= time.monotonic():
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return key in self._values
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        if not self._live(key):
+            return None
+        value = self._values[key]
+        return str(value).encode() if isinstance(value, int) else value
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self._values[key] = value
+        if ttl:
+            self._expires[key] = time.monotonic() + ttl
+        else:
+            self._expires.pop(key, None)
+    
+    async def delete(self, *keys: str):
+        for key in keys:
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+            self._hashes.pop(key, None)
+    
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        if not self._live(key):
+            self._values[key] = 0
+            if ttl:
+                self._expires[key] = time.monotonic() + ttl
+        self._values[key] = int(self._values[key]) + amount
+        return self._values[key]
+    
+    async def hgetall(self, name: str) -> Dict[str, bytes]:
+        return dict(self._hashes.get(name, {}))
+    
+    async def hmget(self, name: str, fields: List[str]) -> List[Optional[bytes]]:
+        table = self._hashes.get(name, {})
+        return [table.get(field) for field in fields]
+    
+    async def hupdate(self, name: str, mapping: Dict[str, bytes], delete: Iterable[str] = ()):
+        table = self._hashes.setdefault(name, {})
+        table.update(mapping)
+        for field in delete:
+            table.pop(field, None)
+    
+    @contextlib.asynccontextmanager
+    async def lock(self, name: str, timeout: float = 30, wait: float = 30) -> AsyncIterator[None]:
+        lock = self._locks.get(name)
+        if lock is None:
+            lock = self._locks[name] = asyncio.Lock()
+        try:
+            await asyncio.wait_for(lock.acquire(), wait)
+        except asyncio.TimeoutError:
+            raise StateLockTimeout(name)
+        try:
+            yield
+        finally:
+            lock.release()
+    
+    def limiter_storage_uri(self) -> str:
+        return "memory://"
+
+def _open_sqlite(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@contextlib.contextmanager
+def _transaction(conn: sqlite3.Connection):
+    """写事务：开始时即获取数据库写锁，其他进程的写入在此期间等待"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+class SQLiteStateBackend(StateBackend):
+    """
+    SQLite实现，供同一台机器上的多个worker共享
+    
+    使用WAL模式，所有操作在单个后台线程中执行，不阻塞事件循环；
+    写操作使用 BEGIN IMMEDIATE 事务，跨进程互斥由数据库的写锁保证
+    """
+    
+    name = "sqlite"
+    shared = True
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL);
+        CREATE TABLE IF NOT EXISTS hashes (name TEXT, field TEXT, value BLOB, PRIMARY KEY (name, field));
+        CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL);
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid: Optional[int] = None
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _open_sqlite(self.path)
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+    
+    async def _run(self, fn, *args):
+        # 连接和线程在首次使用的进程中创建，fork 出的 worker 不沿用父进程的
+        if self._pid != os.getpid():
+            self._conn = None
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-sqlite")
+            self._pid = os.getpid()
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+    
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self._connection().execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires IS NULL OR expires > ?)", (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return str(row[0]).encode() if isinstance(row[0], int) else row[0]
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._run(self._get, key)
+    
+    def _set(self, key: str, value: bytes, ttl: Optional[float]):
+        with _transaction(self._connection()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl if ttl else None)
+            )
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self._run(self._set, key, value, ttl)
+    
+    def _delete(self, keys):
+        with _transaction(self._connection()) as conn:
+            conn.executemany("DELETE FROM kv WHERE key = ?", [(key,) for key in keys])
+            conn.executemany("DELETE FROM hashes WHERE name = ?", [(key,) for key in keys])
+    
+    async def delete(self, *keys: str):
+        await self._run(self._delete, keys)
+    
+    def _incr(self, key: str, amount: int, ttl: Optional[float]) -> int:
+        now = time.time()
+        with _transaction(self._connection()) as conn:
+            row = conn.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                value, expires = amount, (now + ttl if ttl else None)
+            else:
+                value, expires = int(row[0]) + amount, row[1]
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+        return value
+    
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return await self._run(self._incr, key, amount, ttl)
+    
+    def _hgetall(self, name: str) -> Dict[str, bytes]:
+        return dict(self._connection().execute("SELECT field, value FROM hashes WHERE name = ?", (name,)))
+    
+    async def hgetall(self, name: str) -> Dict[str, bytes]:
+        return await self._run(self._hgetall, name)
+    
+    def _hmget(self, name: str, fields: List[str]) -> List[Optional[bytes]]:
+        found = {}
+        conn = self._connection()
+        for start in range(0, len(fields), 500):
+            chunk = fields[start:start + 500]
+            found.update(conn.execute(
+                f"SELECT field, value FROM hashes WHERE name = ? AND field IN ({','.join('?' * len(chunk))})",
+                (name, *chunk)
+            ))
+        return [found.get(field) for field in fields]
+    
+    async def hmget(self, name: str, fields: List[str]) -> List[Optional[bytes]]:
+        if not fields:
+            return []
+        return await self._run(self._hmget, name, list(fields))
+    
+    def _hupdate(self, name: str, mapping: Dict[str, bytes], delete: List[str]):
+        with _transaction(self._connection()) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes (name, field, value) VALUES (?, ?, ?)",
+                [(name, field, value) for field, value in mapping.items()]
+            )
+            conn.executemany("DELETE FROM hashes WHERE name = ? AND field = ?", [(name, field) for field in delete])
+    
+    async def hupdate(self, name: str, mapping: Dict[str, bytes], delete: Iterable[str] = ()):
+        await self._run(self._hupdate, name, mapping, list(delete))
+    
+    def _try_lock(self, name: str, owner: str, timeout: float) -> bool:
+        now = time.time()
+        with _transaction(self._connection()) as conn:
+            row = conn.execute("SELECT expires FROM locks WHERE name = ?", (name,)).fetchone()
+            acquired = row is None or row[0] <= now
+            if acquired:
+                conn.execute("INSERT OR REPLACE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, owner, now + timeout))
+        return acquired
+    
+    def _unlock(self, name: str, owner: str):
+        with _transaction(self._connection()) as conn:
+            conn.execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, owner))
+    
+    @contextlib.asynccontextmanager
+    async def lock(self, name: str, timeout: float = 30, wait: float = 30) -> AsyncIterator[None]:
+        owner = uuid.uuid4().hex
+        deadline = time.monotonic() + wait
+        delay = 0.005
+        while not await self._run(self._try_lock, name, owner, timeout):
+            if time.monotonic() >= deadline:
+                raise StateLockTimeout(name)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            yield
+        finally:
+            await asyncio.shield(self._run(self._unlock, name, owner))
+    
+    def limiter_storage_uri(self) -> str:
+        return f"sqlite:///{os.path.abspath(self.path)}"
+    
+    async def close(self):
+        if self._executor is None or self._pid != os.getpid():
+            return
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await self._run(_close)
+        self._executor.shutdown(wait=False)
+        self._executor = None
+        self._pid = None
+
+class RedisStateBackend(StateBackend):
+    """Redis实现，供多台机器上的worker共享（需要安装 redis）"""
+    
+    name = "redis"
+    shared = True
+    
+    def __init__(self, url: str, prefix: str = ""):
+        if aioredis is None:
+            raise RuntimeError("STATE_BACKEND=redis 需要安装 redis")
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._pid: Optional[int] = None
+    
+    @property
+    def client(self):
+        """连接池在首次使用的进程中创建，fork 出的 worker 不沿用父进程的连接"""
+        if self._client is None or self._pid != os.getpid():
+            self._client = aioredis.from_url(self.url)
+            self._pid = os.getpid()
+        return self._client
+    
+    def _key(self, key: str) -> str:
+        return self.prefix + key
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self._key(key))
+    
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        await self.client.set(self._key(key), value, px=int(ttl * 1000) if ttl else None)
+    
+    async def delete(self, *keys: str):
+        if keys:
+            await self.client.delete(*(self._key(key) for key in keys))
+    
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        key = self._key(key)
+        value = await self.client.incrby(key, amount)
+        if ttl and value == amount:
+            await self.client.pexpire(key, int(ttl * 1000))
+        return value
+    
+    async def hgetall(self, name: str) -> Dict[str, bytes]:
+        return {field.decode(): value for field, value in (await self.client.hgetall(self._key(name))).items()}
+    
+    async def hmget(self, name: str, fields: List[str]) -> List[Optional[bytes]]:
+        if not fields:
+            return []
+        return await self.client.hmget(self._key(name), fields)
+    
+    async def hupdate(self, name: str, mapping: Dict[str, bytes], delete: Iterable[str] = ()):
+        delete = list(delete)
+        async with self.client.pipeline(transaction=True) as pipe:
+            if mapping:
+                pipe.hset(self._key(name), mapping=mapping)
+            if delete:
+                pipe.hdel(self._key(name), *delete)
+            await pipe.execute()
+    
+    @contextlib.asynccontextmanager
+    async def lock(self, name: str, timeout: float = 30, wait: float = 30) -> AsyncIterator[None]:
+        lock = self.client.lock(self._key(name), timeout=timeout, blocking_timeout=wait)
+        if not await lock.acquire():
+            raise StateLockTimeout(name)
+        try:
+            yield
+        finally:
+            try:
+                await lock.release()
+            except Exception as e:
+                # 持有时间超过 timeout，锁已被自动释放
+                logger.warning(f"释放锁 {name} 失败: {e}")
+    
+    def limiter_storage_uri(self) -> str:
+        return self.url
+    
+    async def close(self):
+        client, self._client = self._client, None
+        if client is not None and self._pid == os.getpid():
+            await client.aclose()
+
+class SQLiteLimitStorage(Storage):
+    """
+    slowapi（limits）的SQLite存储，使多个worker共享限流计数（URI: sqlite:///路径）
+    
+    slowapi 同步调用存储，每次计数是一次本地SQLite事务（WAL模式下通常远小于1毫秒）
+    """
+    
+    STORAGE_SCHEME = ["sqlite"]
+    
+    def __init__(self, uri: str, wrap_exceptions: bool = False, **options):
+        super().__init__(uri, wrap_exceptions=wrap_exceptions, **options)
+        self.path = uri.split("://", 1)[1] or ":memory:"
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+    
+    @property
+    def base_exceptions(self):
+        return sqlite3.Error
+    
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = _open_sqlite(self.path)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS rate_limits (key TEXT PRIMARY KEY, value INTEGER, expires REAL)")
+        return self._conn
+    
+    def incr(self, key: str, expiry: int, amount: int = 1) -> int:
+        now = time.time()
+        with self._lock, _transaction(self._connection()) as conn:
+            row = conn.execute("SELECT value, expires FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            if row is None or row[1] <= now:
+                value, expires = amount, now + expiry
+            else:
+                value, expires = row[0] + amount, row[1]
+            conn.execute("INSERT OR REPLACE INTO rate_limits (key, value, expires) VALUES (?, ?, ?)", (key, value, expires))
+        return value
+    
+    def get(self, key: str) -> int:
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT value FROM rate_limits WHERE key = ? AND expires > ?", (key, time.time())
+            ).fetchone()
+            return row[0] if row else 0
+    
+    def get_expiry(self, key: str) -> float:
+        with self._lock:
+            row = self._connection().execute("SELECT expires FROM rate_limits WHERE key = ?", (key,)).fetchone()
+            return row[0] if row and row[0] > time.time() else time.time()
+    
+    def check(self) -> bool:
+        try:
+            with self._lock:
+                self._connection().execute("SELECT 1")
+            return True
+        except sqlite3.Error:
+            return False
+    
+    def reset(self) -> Optional[int]:
+        with self._lock:
+            return self._connection().execute("DELETE FROM rate_limits").rowcount
+    
+    def clear(self, key: str) -> None:
+        with self._lock:
+            self._connection().execute("DELETE FROM rate_limits WHERE key = ?", (key,))
+
+def create_state_backend(kind: str) -> StateBackend:
+    """根据 STATE_BACKEND 配置创建后端"""
+    if kind == "memory":
+        return MemoryStateBackend()
+    if kind == "sqlite":
+        return SQLiteStateBackend(config.STATE_SQLITE_PATH)
+    if kind == "redis":
+        return RedisStateBackend(config.STATE_REDIS_URL, prefix=config.STATE_KEY_PREFIX)
+    raise ValueError(f"不支持的共享状态后端: {kind}")
+
+# 全局共享状态后端
+state_backend = create_state_backend(config.STATE_BACKEND)
@@ -0,0 +1,404 @@
+"""
+流式传输模块
+为流式接口提供SSE/NDJSON两种传输格式，负责事件编号、心跳、断线检测，
+并为每条生成中的消息保留有界的重放缓冲区，断线的客户端可凭消息ID和最后事件ID重新接入
+"""
+import time
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import Request
+from config import config
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+SSE_MEDIA_TYPE = "text/event-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+# 禁止代理缓冲和缓存，保证事件及时送达
+STREAM_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no"
+}
+
+_END = object()
+
+def wants_sse(request: Request) -> bool:
+    """客户端是否请求SSE格式（Accept头或 ?transport=sse）"""
+    if request.query_params.get("transport") == "sse":
+        return True
+    return SSE_MEDIA_TYPE in request.headers.get("accept", "")
+
+def format_sse(data: Dict[str, Any], event_id: Optional[int] = None, event: Optional[str] = None) -> str:
+    """编码一条SSE事件"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event:
+        lines.append(f"event: {event}")
+    lines.append(f"data: {fast_json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+def format_ndjson(data: Dict[str, Any]) -> str:
+    """编码一行NDJSON"""
+    return fast_json.dumps(data) + "\n"
+
+async def coalesce_chunks(
+    chunks: AsyncIterator[str],
+    max_bytes: Optional[int] = None,
+    max_ms: Optional[float] = None
+) -> AsyncIterator[str]:
+    """
+    合并上游的细碎增量
+    
+    累积的文本达到 max_bytes，或自第一段待发送文本起超过 max_ms 毫秒时输出一帧；
+    等待上游期间到期也会输出，不会因上游停顿而延迟。max_ms 为0时不合并
+    
+    Args:
+        chunks: 上游文本增量
+        max_bytes: 单帧最大字节数（按字符数近似）
+        max_ms: 单帧最长等待时间（毫秒）
+    """
+    max_bytes = max_bytes or config.STREAM_FLUSH_MAX_BYTES
+    max_ms = config.STREAM_FLUSH_MAX_MS if max_ms is None else max_ms
+    if max_ms <= 0:
+        async for chunk in chunks:
+            yield chunk
+        return
+    
+    loop = asyncio.get_running_loop()
+    iterator = chunks.__aiter__()
+    pending: List[str] = []
+    size = 0
+    deadline = None
+    # 下一段增量的等待任务跨越多次flush保留，超时只触发flush而不取消上游
+    next_chunk: Optional[asyncio.Future] = None
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(deadline - loop.time(), 0)
+            done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+            
+            if done:
+                finished, next_chunk = next_chunk, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    # 上游中途出错时先交出已缓冲的文本，调用方据此保存不完整回复
+                    if pending:
+                        yield "".join(pending)
+                        pending = []
+                    raise
+                if chunk:
+                    if not pending:
+                        deadline = loop.time() + max_ms / 1000
+                    pending.append(chunk)
+                    size += len(chunk)
+            
+            if pending and (size >= max_bytes or loop.time() >= deadline):
+                yield "".join(pending)
+                pending, size, deadline = [], 0, None
+        
+        if pending:
+            yield "".join(pending)
+    finally:
+        if next_chunk is not None and not next_chunk.done():
+            next_chunk.cancel()
+            try:
+                await next_chunk
+            except (asyncio.CancelledError, StopAsyncIteration, Exception):
+                pass
+        if hasattr(iterator, "aclose"):
+            await iterator.aclose()
+
+class ReplayGapError(Exception):
+    """请求的事件已被淘汰出重放缓冲区，无法无损续传"""
+    pass
+
+def _event_size(event: Dict[str, Any]) -> int:
+    """粗略估算事件占用的内存（字节）"""
+    return 64 + sum(len(value) for value in event.values() if isinstance(value, str))
+
+class ReplayBuffer:
+    """
+    单条消息的重放缓冲区
+    
+    事件按序号（从1开始，即SSE事件ID）保存；实时订阅者各自持有一个队列接收新事件，
+    重连的订阅者先重放序号大于 Last-Event-ID 的缓冲事件，再无缝衔接实时尾部
+    """
+    
+    def __init__(self, message_id: str):
+        self.message_id = message_id
+        self.events: List[Tuple[int, Dict[str, Any]]] = []
+        self.seq = 0
+        self.size = 0
+        self.truncated = False
+        self.done = False
+        self.updated_at = time.monotonic()
+        self.task: Optional[asyncio.Task] = None
+        self.handed_out = False  # 是否已有事件（含携带消息ID的meta事件）发给客户端，未发出时客户端无从续传
+        self._subscribers: List[asyncio.Queue] = []
+        self._cancel_handle: Optional[asyncio.TimerHandle] = None
+    
+    @property
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+    
+    def append(self, event: Dict[str, Any]) -> int:
+        """追加事件并推送给所有实时订阅者，返回新增的字节数"""
+        self.seq += 1
+        self.updated_at = time.monotonic()
+        for queue in self._subscribers:
+            queue.put_nowait((self.seq, event))
+        if self.truncated:
+            return 0
+        self.events.append((self.seq, event))
+        added = _event_size(event)
+        self.size += added
+        return added
+    
+    def finish(self):
+        self.done = True
+        self.updated_at = time.monotonic()
+        for queue in self._subscribers:
+            queue.put_nowait(_END)
+    
+    def drop_events(self) -> int:
+        """清空缓冲事件（实时订阅者不受影响，但之后无法续传），返回释放的字节数"""
+        freed = self.size
+        self.events = []
+        self.size = 0
+        self.truncated = True
+        return freed
+    
+    async def subscribe(self, after: int = 0) -> AsyncIterator[Tuple[int, Dict[str, Any]]]:
+        """
+        订阅序号大于 after 的事件
+        
+        Raises:
+            ReplayGapError: 所需事件已被淘汰
+        """
+        if self.truncated and after < self.seq:
+            raise ReplayGapError(self.message_id)
+        # 快照缓冲与注册队列之间没有await，不会漏掉或重复事件
+        backlog = [item for item in self.events if item[0] > after]
+        queue: asyncio.Queue = asyncio.Queue()
+        if self.done:
+            queue.put_nowait(_END)
+        else:
+            self._subscribers.append(queue)
+            if self._cancel_handle:
+                self._cancel_handle.cancel()
+                self._cancel_handle = None
+        try:
+            for item in backlog:
+                self.handed_out = True
+                yield item
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                self.handed_out = True
+                yield item
+        finally:
+            if queue in self._subscribers:
+                self._subscribers.remove(queue)
+                if not self._subscribers and not self.done:
+                    self._schedule_cancel()
+    
+    def _schedule_cancel(self):
+        """
+        最后一个订阅者离开后，宽限期内无人重连则取消生成任务
+        
+        宽限期越长，短暂断网的客户端越能续传，但被放弃的生成也会继续消耗上游token越久；
+        客户端从未收到任何事件（不知道消息ID）或缓冲已被清空（无法无损续传）时没有续传的可能，立即取消
+        """
+        if self.task is None or self.task.done():
+            return
+        grace = config.STREAM_RESUME_GRACE_SECONDS
+        if grace <= 0 or not self.handed_out or self.truncated:
+            self.task.cancel()
+            return
+        loop = asyncio.get_running_loop()
+        self._cancel_handle = loop.call_later(grace, self._cancel_if_abandoned)
+    
+    def _cancel_if_abandoned(self):
+        self._cancel_handle = None
+        if not self._subscribers and self.task and not self.task.done():
+            logger.info(f"🔌 消息 {self.message_id} 宽限期内无客户端重连，取消生成")
+            self.task.cancel()
+
+class StreamRegistry:
+    """
+    生成中/刚完成消息的重放缓冲区注册表
+    
+    生成任务独立于HTTP连接运行；缓冲区在完成后保留 ttl 秒，
+    所有缓冲区合计超过 max_bytes 时优先淘汰最早完成的，其次清空最早开始的进行中缓冲
+    """
+    
+    def __init__(self, ttl: float, max_bytes: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._buffers: Dict[str, ReplayBuffer] = {}
+        self._total_bytes = 0
+    
+    def start(self, message_id: str, producer: AsyncIterator[Dict[str, Any]]) -> ReplayBuffer:
+        """创建缓冲区并在后台任务中运行生产者"""
+        self._expire()
+        buffer = ReplayBuffer(message_id)
+        self._buffers[message_id] = buffer
+        buffer.task = asyncio.create_task(self._run(buffer, producer))
+        return buffer
+    
+    def get(self, message_id: str) -> Optional[ReplayBuffer]:
+        self._expire()
+        return self._buffers.get(message_id)
+    
+    async def _run(self, buffer: ReplayBuffer, producer: AsyncIterator[Dict[str, Any]]):
+        try:
+            async for event in producer:
+                self._total_bytes += buffer.append(event)
+                if self._total_bytes > self.max_bytes:
+                    self._evict()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"流式生成任务异常: {e}")
+        finally:
+            buffer.finish()
+    
+    def _remove(self, message_id: str):
+        buffer = self._buffers.pop(message_id, None)
+        if buffer:
+            self._total_bytes -= buffer.size
+    
+    def _expire(self):
+        now = time.monotonic()
+        expired = [
+            message_id for message_id, buffer in self._buffers.items()
+            if buffer.done and now - buffer.updated_at > self.ttl
+        ]
+        for message_id in expired:
+            self._remove(message_id)
+    
+    def _evict(self):
+        """超出内存上限时淘汰缓冲"""
+        self._expire()
+        for message_id, buffer in sorted(self._buffers.items(), key=lambda item: (not item[1].done, item[1].updated_at)):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if buffer.done:
+                self._remove(message_id)
+            elif not buffer.truncated:
+                self._total_bytes -= buffer.drop_events()
+                logger.warning(f"⚠️ 重放缓冲超出上限，消息 {message_id} 将无法续传")
+    
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffers": len(self._buffers),
+            "active": sum(1 for buffer in self._buffers.values() if not buffer.done),
+            "bytes": self._total_bytes,
+            "max_bytes": self.max_bytes
+        }
+
+async def stream_events(
+    request: Request,
+    events: AsyncIterator[Tuple[int, Dict[str, Any]]],
+    sse: bool = True,
+    heartbeat_interval: Optional[float] = None,
+    poll_interval: Optional[float] = None
+) -> AsyncIterator[str]:
+    """
+    将带序号的事件流包装为带心跳和断线检测的传输流
+    
+    事件在独立任务中读取并通过有界队列交付；客户端断开或响应被关闭时取消读取任务，
+    订阅随之释放（生成任务是否取消由重放缓冲区的宽限期决定）
+    
+    Args:
+        request: 当前请求，用于检测客户端是否断开
+        events: 产生 (序号, 事件字典) 的异步迭代器
+        sse: True输出SSE（序号作为事件ID），False输出NDJSON（序号写入seq字段）
+        heartbeat_interval: 空闲多久发送一次心跳（秒）
+        poll_interval: 断线检测间隔（秒）
+    """
+    heartbeat_interval = heartbeat_interval or config.STREAM_HEARTBEAT_SECONDS
+    poll_interval = poll_interval or config.STREAM_DISCONNECT_POLL_SECONDS
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+    
+    async def pump():
+        try:
+            async for item in events:
+                await queue.put(item)
+        except asyncio.CancelledError:
+            raise
+        except ReplayGapError:
+            await queue.put((None, {"type": "error", "error": "重放缓冲已失效，无法续传"}))
+        except Exception as e:
+            logger.error(f"流式传输异常: {e}")
+        finally:
+            # 及时释放订阅，避免被取消时停在队列写入处的生成器延迟到GC才清理
+            await events.aclose()
+        await queue.put(_END)
+    
+    task = asyncio.create_task(pump())
+    last_sent = last_poll = loop.time()
+    
+    try:
+        while True:
+            now = loop.time()
+            timeout = min(poll_interval - (now - last_poll), heartbeat_interval - (now - last_sent))
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=max(timeout, 0.01))
+            except asyncio.TimeoutError:
+                item = None
+            
+            now = loop.time()
+            if now - last_poll >= poll_interval:
+                last_poll = now
+                if await request.is_disconnected():
+                    logger.info("🔌 客户端已断开，停止推送")
+                    return
+            
+            if item is None:
+                if now - last_sent >= heartbeat_interval:
+                    yield ": ping\n\n" if sse else format_ndjson({"type": "ping"})
+                    last_sent = now
+                continue
+            
+            # 已就绪的事件合并为一次写出（重放积压时尤其明显）
+            frames = []
+            while item is not _END:
+                seq, event = item
+                if sse:
+                    frames.append(format_sse(event, seq))
+                else:
+                    frames.append(format_ndjson(event if seq is None else {**event, "seq": seq}))
+                if queue.empty():
+                    break
+                item = queue.get_nowait()
+            
+            if frames:
+                yield "".join(frames)
+                last_sent = now
+            if item is _END:
+                return
+    
+    finally:
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+# 全局重放缓冲注册表
+stream_registry = StreamRegistry(
+    ttl=config.STREAM_REPLAY_TTL_SECONDS,
+    max_bytes=config.STREAM_REPLAY_MAX_BYTES
+)
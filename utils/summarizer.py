@@ -0,0 +1,254 @@
+"""
+上下文压缩工具
+提供本地抽取式摘要和基于模型的摘要，用于压缩长讨论记录和会话早期历史
+"""
+import re
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 句子切分：中文标点、换行以及英文句末标点
+_SENTENCE_SPLIT = re.compile(r'(?<=[。！？；!?;\n])|(?<=\.)\s+')
+# 词元：连续的中日韩字符或英文/数字单词
+_TOKEN_RE = re.compile(r'[一-鿿぀-ヿ가-힯]+|[A-Za-z0-9_]+')
+
+_STOPWORDS = {
+    "the", "a", "an", "and", "or", "of", "to", "in", "is", "are", "for", "on", "with",
+    "我们", "你们", "他们", "这个", "那个", "一个", "可以", "需要", "进行", "以及", "因此",
+}
+
+def _tokenize(text: str) -> List[str]:
+    """切分词元，中文按二元组切分，英文按单词切分"""
+    tokens = []
+    for run in _TOKEN_RE.findall(text):
+        if run.isascii():
+            word = run.lower()
+            if word not in _STOPWORDS and len(word) > 1:
+                tokens.append(word)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(
+                bigram for bigram in (run[i:i + 2] for i in range(len(run) - 1))
+                if bigram not in _STOPWORDS
+            )
+    return tokens
+
+def _split_sentences(text: str) -> List[str]:
+    """切分句子并去除空白和Markdown装饰"""
+    sentences = []
+    for raw in _SENTENCE_SPLIT.split(text):
+        sentence = raw.strip().lstrip('#>*-• ').strip()
+        if len(sentence) >= 4:
+            sentences.append(sentence)
+    return sentences
+
+def extractive_summary(entries: List[Tuple[str, str]], max_chars: int) -> str:
+    """
+    本地抽取式摘要
+    
+    Args:
+        entries: (标签, 文本) 列表，例如 ("【技术总监】(第1轮)", "...")
+        max_chars: 摘要最大字符数
+    
+    Returns:
+        按原始顺序拼接的关键句摘要，每个条目一行
+    """
+    entries = [(label, text) for label, text in entries if text and text.strip()]
+    if not entries or max_chars <= 0:
+        return ""
+    
+    # 全局词频作为句子重要性依据
+    entry_sentences = [_split_sentences(text) for _, text in entries]
+    frequencies = Counter()
+    for sentences in entry_sentences:
+        for sentence in sentences:
+            frequencies.update(set(_tokenize(sentence)))
+    
+    # 每个条目平均分配预算，保证每位发言者都有代表性内容
+    budget = max(max_chars // len(entries), 40)
+    lines = []
+    for (label, _), sentences in zip(entries, entry_sentences):
+        scored = []
+        for index, sentence in enumerate(sentences):
+            tokens = _tokenize(sentence)
+            if not tokens:
+                continue
+            score = sum(frequencies[t] for t in set(tokens)) / (len(tokens) ** 0.5)
+            scored.append((score, index, sentence))
+        
+        remaining = budget - len(label) - 2
+        chosen = []
+        for score, index, sentence in sorted(scored, key=lambda s: s[0], reverse=True):
+            if len(sentence) > remaining:
+                continue
+            chosen.append((index, sentence))
+            remaining -= len(sentence) + 1
+            if remaining <= 10:
+                break
+        
+        if chosen:
+            lines.append(f"{label}: " + " ".join(s for _, s in sorted(chosen)))
+        elif sentences:
+            lines.append(f"{label}: {sentences[0][:max(budget - len(label) - 2, 10)]}")
+    
+    return "\n".join(lines)[:max_chars]
+
+async def summarize_entries(
+    entries: List[Tuple[str, str]],
+    max_chars: int,
+    model: Optional[str] = None
+) -> str:
+    """
+    压缩条目为有界摘要，配置了模型时调用模型，失败时回退到抽取式摘要
+    """
+    if model:
+        transcript = "\n\n".join(f"{label}:\n{text}" for label, text in entries if text)
+        try:
+            from utils.api_client import poe_client
+            summary = await poe_client.chat_completion(
+                model=model,
+                messages=[
+                    {"role": "system", "content": "你是一位专业的会议记录者，擅长在有限篇幅内提炼讨论要点。"},
+                    {"role": "user", "content": (
+                        f"请将以下内容压缩为不超过{max_chars}字的要点摘要，"
+                        f"保留每位发言者的核心观点、关键数据、共识与分歧，不要添加新观点：\n\n{transcript}"
+                    )}
+                ],
+                max_tokens=max(max_chars, 200)
+            )
+            summary = (summary or "").strip()
+            if summary:
+                return summary[:max_chars]
+        except Exception as e:
+            logger.warning(f"模型摘要失败，回退到抽取式摘要: {e}")
+    
+    return extractive_summary(entries, max_chars)
+
+class TranscriptCompressor:
+    """讨论记录滚动压缩器：将较早的轮次折叠进有界摘要"""
+    
+    def __init__(self, max_chars: int, model: Optional[str] = None):
+        self.max_chars = max_chars
+        self.model = model
+        self.digest = ""
+        self.digested_rounds = 0
+    
+    async def compress_round(self, round_num: int, entries: List[Tuple[str, str]]):
+        """将一轮发言折叠进摘要（已有摘要作为首个条目一起压缩）"""
+        if round_num <= self.digested_rounds:
+            return
+        
+        to_compress = list(entries)
+        if self.digest:
+            to_compress.insert(0, (f"前{self.digested_rounds}轮摘要", self.digest))
+        
+        self.digest = await summarize_entries(to_compress, self.max_chars, self.model)
+        self.digested_rounds = round_num
+        logger.info(f"🗜️ 已压缩前 {round_num} 轮讨论，摘要长度: {len(self.digest)} 字符")
+
+class SessionDigester:
+    """会话摘要维护器：在后台增量压缩滑出历史窗口的消息"""
+    
+    def __init__(
+        self,
+        window: int,
+        max_chars: int,
+        min_batch: int,
+        model: Optional[str] = None,
+        enabled: bool = True
+    ):
+        self.window = window
+        self.max_chars = max_chars
+        self.min_batch = min_batch
+        self.model = model
+        self.enabled = enabled
+        self._tasks: Dict[str, asyncio.Task] = {}
+    
+    def _target_count(self, messages: List[Dict]) -> int:
+        """下一轮对话时将滑出窗口的消息数量"""
+        return max(0, len(messages) - (self.window - 1))
+    
+    def format_digest(self, session: Dict) -> str:
+        """构建摘要上下文块，仅当历史确实超出窗口时返回"""
+        digest = session.get("digest") or {}
+        if not digest.get("content") or len(session.get("messages", [])) <= self.window:
+            return ""
+        return "\n\n【早期对话摘要】\n以下是本会话较早内容的摘要，请在回答时保持上下文连贯：\n" + digest["content"]
+    
+    def schedule(self, session: Dict):
+        """检查是否需要刷新摘要，需要时创建后台任务（不阻塞请求）"""
+        if not self.enabled:
+            return
+        
+        session_id = session.get("id")
+        covered = (session.get("digest") or {}).get("message_count", 0)
+        if self._target_count(session.get("messages", [])) - covered < self.min_batch:
+            return
+        if session_id in self._tasks:
+            return
+        
+        task = asyncio.create_task(self._refresh(session_id))
+        self._tasks[session_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(session_id, None))
+    
+    async def _refresh(self, session_id: str):
+        """增量刷新会话摘要：已有摘要 + 新滑出窗口的消息"""
+        from utils.database import db_manager
+        
+        try:
+            session = await db_manager.get_session_view(session_id)
+            if not session:
+                return
+            
+            messages = session.get("messages", [])
+            digest = session.get("digest") or {}
+            covered = digest.get("message_count", 0)
+            target = self._target_count(messages)
+            if target <= covered:
+                return
+            
+            entries = []
+            if digest.get("content"):
+                entries.append(("早期摘要", digest["content"]))
+            for msg in messages[covered:target]:
+                content = msg.get("content")
+                if not isinstance(content, str) or not content.strip():
+                    continue
+                label = "用户" if msg.get("role") == "user" else msg.get("agent_name") or "助手"
+                entries.append((label, content[:2000]))
+            
+            summary = await summarize_entries(entries, self.max_chars, self.model)
+            
+            # 在会话锁内基于最新版本写回，避免覆盖摘要期间产生的新消息
+            def apply_digest(latest: Dict):
+                latest["digest"] = {
+                    "content": summary,
+                    "message_count": target,
+                    "updated_at": datetime.now().isoformat()
+                }
+            
+            if await db_manager.modify_session(session_id, apply_digest):
+                logger.info(f"🗜️ 会话摘要已更新: {session_id}, 覆盖 {target} 条消息")
+        
+        except Exception as e:
+            logger.error(f"会话摘要刷新失败 ({session_id}): {e}")
+    
+    async def drain(self, timeout: float = 10.0):
+        """等待进行中的摘要任务完成（关闭时调用）"""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks.values()), timeout=timeout)
+
+# 全局会话摘要维护器
+session_digester = SessionDigester(
+    window=config.CHAT_HISTORY_WINDOW,
+    max_chars=config.SESSION_DIGEST_MAX_CHARS,
+    min_batch=config.SESSION_DIGEST_MIN_BATCH,
+    model=config.SUMMARY_MODEL or None,
+    enabled=config.SESSION_DIGEST_ENABLED
+)
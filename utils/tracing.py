@@ -0,0 +1,259 @@
+"""
+请求追踪模块
+进程内的轻量span记录器：span通过contextvars在协程和子任务间传递，使用单调时钟计时，
+按采样率记录并保存在有界缓冲区中，可导出为OTLP兼容的JSON，无需外部采集器
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import contextlib
+import contextvars
+from collections import deque
+from typing import Any, Dict, List, Optional
+from config import config
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+class Trace:
+    """一次请求的全部span"""
+    
+    def __init__(self, name: str):
+        self.trace_id = os.urandom(16).hex()
+        self.name = name
+        self.wall_start_ns = time.time_ns()
+        self.mono_start_ns = time.monotonic_ns()
+        self.spans: List["Span"] = []
+        self.open = 0
+        self.dropped = 0
+        self.exported = False
+    
+    @property
+    def duration_ms(self) -> float:
+        """从第一个span开始到最后一个span结束（仍在进行的span按当前时间计）"""
+        now = time.monotonic_ns()
+        end = max((span.end_ns or now) for span in self.spans) if self.spans else now
+        return (end - self.mono_start_ns) / 1e6
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "start_time": self.wall_start_ns / 1e9,
+            "duration_ms": round(self.duration_ms, 3),
+            "in_progress": self.open > 0,
+            "dropped_spans": self.dropped,
+            "spans": [span.to_dict() for span in self.spans]
+        }
+
+class Span:
+    """一个计时区间"""
+    
+    def __init__(self, trace: Trace, name: str, parent: Optional["Span"], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.start_ns = time.monotonic_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+    
+    def set(self, key: str, value: Any):
+        self.attributes[key] = value
+    
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.monotonic_ns()
+            self.trace.open -= 1
+            if self.trace.open == 0:
+                tracer._on_trace_complete(self.trace)
+    
+    @property
+    def duration_ms(self) -> Optional[float]:
+        return (self.end_ns - self.start_ns) / 1e6 if self.end_ns is not None else None
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "offset_ms": round((self.start_ns - self.trace.mono_start_ns) / 1e6, 3),
+            "duration_ms": round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+class _NoopSpan:
+    """未采样时使用的空span"""
+    
+    def set(self, key: str, value: Any):
+        pass
+    
+    def end(self):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+class Tracer:
+    """
+    进程内span记录器
+    
+    根span按采样率决定是否记录整条trace，未采样的请求只付出一次随机数的开销；
+    子span数量有上限，完成的trace进入有界缓冲区，配置了导出文件时按OTLP JSON逐行追加
+    """
+    
+    def __init__(
+        self,
+        enabled: bool = True,
+        sample_rate: float = 1.0,
+        buffer_size: int = 200,
+        max_spans: int = 256,
+        export_file: str = ""
+    ):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.max_spans = max_spans
+        self.export_file = export_file
+        self.traces: deque = deque(maxlen=buffer_size)
+    
+    def start_span(self, name: str, root: bool = False, **attributes) -> Any:
+        """
+        开始一个span（不设为当前span），需调用 end() 结束
+        
+        Args:
+            name: span名称
+            root: 无当前span时是否开启新trace；False时没有父span则不记录
+            attributes: span属性
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        parent = _current_span.get()
+        if parent is None:
+            if not root or random.random() >= self.sample_rate:
+                return NOOP_SPAN
+            trace = Trace(name)
+            self.traces.append(trace)
+        elif parent is NOOP_SPAN:
+            return NOOP_SPAN
+        else:
+            trace = parent.trace
+            if len(trace.spans) >= self.max_spans:
+                trace.dropped += 1
+                return NOOP_SPAN
+        
+        span = Span(trace, name, parent, attributes)
+        trace.spans.append(span)
+        trace.open += 1
+        return span
+    
+    @contextlib.contextmanager
+    def activate(self, span: Any):
+        """在 with 块内把span设为当前span（子任务创建时会继承）"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+    
+    @contextlib.contextmanager
+    def span(self, name: str, root: bool = False, **attributes):
+        """记录 with 块的耗时，块内开始的span和创建的任务都成为其子span"""
+        span = self.start_span(name, root=root, **attributes)
+        if span is NOOP_SPAN:
+            if root and _current_span.get() is None:
+                # 未采样的请求把空span设为当前span，其子span直接跳过
+                with self.activate(NOOP_SPAN):
+                    yield span
+            else:
+                yield span
+            return
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+    
+    def current(self) -> Any:
+        return _current_span.get() or NOOP_SPAN
+    
+    def _on_trace_complete(self, trace: Trace):
+        if not self.export_file or trace.exported:
+            return
+        trace.exported = True
+        line = fast_json.dumpb(self.to_otlp([trace])) + b"\n"
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._append_export, line)
+        except RuntimeError:
+            self._append_export(line)
+    
+    def _append_export(self, line: bytes):
+        try:
+            with open(self.export_file, 'ab') as f:
+                f.write(line)
+        except Exception as e:
+            logger.warning(f"导出trace失败: {e}")
+    
+    def recent(self, min_ms: float = 0, limit: int = 50) -> List[Trace]:
+        """最近的trace（新的在前），只返回耗时不小于 min_ms 的"""
+        result = []
+        for trace in reversed(self.traces):
+            if trace.duration_ms >= min_ms:
+                result.append(trace)
+                if len(result) >= limit:
+                    break
+        return result
+    
+    @staticmethod
+    def to_otlp(traces: List[Trace]) -> Dict[str, Any]:
+        """转换为OTLP/JSON（ExportTraceServiceRequest）格式"""
+        spans = []
+        for trace in traces:
+            for span in trace.spans:
+                start_ns = trace.wall_start_ns + (span.start_ns - trace.mono_start_ns)
+                end_ns = start_ns + ((span.end_ns or time.monotonic_ns()) - span.start_ns)
+                otlp_span = {
+                    "traceId": trace.trace_id,
+                    "spanId": span.span_id,
+                    "name": span.name,
+                    "kind": 2 if span.parent_id is None else 1,
+                    "startTimeUnixNano": str(start_ns),
+                    "endTimeUnixNano": str(end_ns),
+                    "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+                    "status": {"code": 2, "message": span.error} if span.error else {}
+                }
+                if span.parent_id:
+                    otlp_span["parentSpanId"] = span.parent_id
+                spans.append(otlp_span)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "multi-agent-chat"}}]},
+                "scopeSpans": [{"scope": {"name": "utils.tracing"}, "spans": spans}]
+            }]
+        }
+
+# 全局追踪器
+tracer = Tracer(
+    enabled=config.TRACING_ENABLED,
+    sample_rate=config.TRACE_SAMPLE_RATE,
+    buffer_size=config.TRACE_BUFFER_SIZE,
+    max_spans=config.TRACE_MAX_SPANS,
+    export_file=config.TRACE_EXPORT_FILE
+)
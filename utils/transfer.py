@@ -0,0 +1,246 @@
+"""
+数据导入导出模块
+以NDJSON流的形式导出/导入会话、消息、记忆和上传文件元数据，全程按记录流式处理
+"""
+import os
+import zlib
+import logging
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+from utils import fast_json
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT_VERSION = 1
+
+def list_upload_metadata(upload_dir: str) -> List[Dict[str, Any]]:
+    """上传文件元数据（不含文件内容）"""
+    uploads = []
+    if not os.path.isdir(upload_dir):
+        return uploads
+    for entry in os.scandir(upload_dir):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        file_id, file_ext = os.path.splitext(entry.name)
+        uploads.append({
+            "file_id": file_id,
+            "filename": entry.name,
+            "file_type": file_ext.lstrip(".").lower(),
+            "size": stat.st_size,
+            "modified_at": datetime.fromtimestamp(stat.st_mtime).isoformat()
+        })
+    return uploads
+
+def _session_records(session: Dict[str, Any], archived: bool = False):
+    """拆分会话为一条会话记录和若干消息记录"""
+    header = {k: v for k, v in session.items() if k != "messages"}
+    yield {"type": "session", "archived": archived, "session": header}
+    for position, message in enumerate(session.get("messages", [])):
+        yield {"type": "message", "session_id": session.get("id"), "position": position, "message": message}
+
+async def iter_export_records(
+    sessions: List[Dict[str, Any]],
+    memories: List[Dict[str, Any]],
+    uploads: List[Dict[str, Any]],
+    archived_reader: Optional[Callable[[], AsyncIterator[Dict[str, Any]]]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    生成导出记录
+    
+    Args:
+        sessions: 时间点快照中的会话（只读）
+        memories: 记忆列表
+        uploads: 上传文件元数据
+        archived_reader: 逐个读取已归档会话的异步生成器函数
+    """
+    yield {
+        "type": "meta",
+        "format_version": EXPORT_FORMAT_VERSION,
+        "exported_at": datetime.now().isoformat(),
+        "sessions": len(sessions),
+        "memories": len(memories),
+        "uploads": len(uploads)
+    }
+    for session in sessions:
+        for record in _session_records(session):
+            yield record
+    if archived_reader is not None:
+        async for session in archived_reader():
+            for record in _session_records(session, archived=True):
+                yield record
+    for memory in memories:
+        yield {"type": "memory", "memory": memory}
+    for upload in uploads:
+        yield {"type": "upload", "upload": upload}
+
+async def encode_ndjson(
+    records: AsyncIterator[Dict[str, Any]],
+    compress: bool = False,
+    chunk_size: int = 64 * 1024
+) -> AsyncIterator[bytes]:
+    """将记录编码为NDJSON字节流，可选gzip压缩，按块输出"""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer: List[bytes] = []
+    size = 0
+    async for record in records:
+        line = fast_json.dumpb(record, default=str) + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            data = b"".join(buffer)
+            buffer, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b"".join(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+def _parse_record(line: bytes) -> Dict[str, Any]:
+    record = fast_json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError(f"记录必须是JSON对象: {line[:50]!r}")
+    return record
+
+async def iter_ndjson_records(
+    chunks: AsyncIterator[bytes],
+    max_line_bytes: int = 16 * 1024 * 1024,
+    max_total_bytes: int = 1024 * 1024 * 1024,
+    decompress_step: int = 1024 * 1024
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    从字节流解析NDJSON记录，自动识别gzip压缩
+    
+    解压按 decompress_step 分步输出，缓冲的未完成行超过 max_line_bytes、
+    解压后总量超过 max_total_bytes 时抛出 ValueError，压缩炸弹或没有换行的数据不会被整体读入内存
+    """
+    decompressor = None
+    pending = bytearray()
+    total = 0
+    head = b""
+    detecting = True
+    
+    def feed(data: bytes) -> List[bytes]:
+        nonlocal total
+        total += len(data)
+        if total > max_total_bytes:
+            raise ValueError(f"导入数据超过 {max_total_bytes} 字节上限")
+        # 只在新数据中查找换行，长行跨多个分块时不会反复复制和扫描已缓冲的部分
+        lines = []
+        begin = 0
+        search_from = len(pending)
+        pending.extend(data)
+        newline = pending.find(b"\n", search_from)
+        while newline != -1:
+            lines.append(bytes(pending[begin:newline]))
+            begin = newline + 1
+            newline = pending.find(b"\n", begin)
+        if begin:
+            del pending[:begin]
+        if len(pending) > max_line_bytes:
+            raise ValueError(f"单条记录超过 {max_line_bytes} 字节上限")
+        return lines
+    
+    def consume(chunk: bytes) -> Iterator[Dict[str, Any]]:
+        while chunk:
+            if decompressor:
+                data = decompressor.decompress(chunk, decompress_step)
+                chunk = decompressor.unconsumed_tail
+            else:
+                data, chunk = chunk, b""
+            for line in feed(data):
+                if line.strip():
+                    yield _parse_record(line)
+    
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        if detecting:
+            # 凑够两个字节再判断是否为gzip，首个分块可能只有一个字节
+            head += chunk
+            if len(head) < 2:
+                continue
+            detecting = False
+            if head[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(wbits=47)
+            chunk, head = head, b""
+        for record in consume(chunk):
+            yield record
+    for record in consume(head):
+        yield record
+    if decompressor:
+        for line in feed(decompressor.flush()):
+            if line.strip():
+                yield _parse_record(line)
+    if pending.strip():
+        yield _parse_record(bytes(pending))
+
+async def import_records(
+    records: AsyncIterator[Dict[str, Any]],
+    upsert_sessions: Callable[[List[Dict[str, Any]]], Awaitable[int]],
+    upsert_memories: Callable[[List[Dict[str, Any]]], Awaitable[int]],
+    batch_size: int = 100
+) -> Dict[str, int]:
+    """
+    批量导入记录
+    
+    同一会话的消息紧随会话记录之后，会话在遇到下一条非消息记录时完成组装；
+    会话和记忆均按ID幂等写入，重复导入不会产生重复数据
+    
+    Returns:
+        各类记录的导入计数
+    """
+    stats = {"sessions": 0, "messages": 0, "memories": 0, "uploads_skipped": 0, "invalid": 0}
+    session_batch: List[Dict[str, Any]] = []
+    memory_batch: List[Dict[str, Any]] = []
+    current: Optional[Dict[str, Any]] = None
+    
+    async def flush_sessions():
+        if session_batch:
+            stats["sessions"] += await upsert_sessions(list(session_batch))
+            session_batch.clear()
+    
+    async def flush_memories():
+        if memory_batch:
+            stats["memories"] += await upsert_memories(list(memory_batch))
+            memory_batch.clear()
+    
+    async def finish_current():
+        nonlocal current
+        if current is not None:
+            session_batch.append(current)
+            current = None
+            if len(session_batch) >= batch_size:
+                await flush_sessions()
+    
+    async for record in records:
+        record_type = record.get("type")
+        if record_type == "message":
+            if current is not None and record.get("session_id") == current.get("id") and isinstance(record.get("message"), dict):
+                current["messages"].append(record["message"])
+                stats["messages"] += 1
+            else:
+                stats["invalid"] += 1
+            continue
+        
+        await finish_current()
+        if record_type == "session" and isinstance(record.get("session"), dict) and record["session"].get("id"):
+            current = {**record["session"], "messages": []}
+        elif record_type == "memory" and isinstance(record.get("memory"), dict) and record["memory"].get("id"):
+            memory_batch.append(record["memory"])
+            if len(memory_batch) >= batch_size:
+                await flush_memories()
+        elif record_type == "upload":
+            # 只导出了元数据，文件内容需单独迁移
+            stats["uploads_skipped"] += 1
+        elif record_type != "meta":
+            stats["invalid"] += 1
+    
+    await finish_current()
+    await flush_sessions()
+    await flush_memories()
+    logger.info(f"📥 导入完成: {stats}")
+    return stats